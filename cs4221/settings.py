@@ -41,6 +41,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'hello.instrumentation.ServerTimingMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -55,7 +56,6 @@ TEMPLATES = [
     {
         'BACKEND': 'django.template.backends.django.DjangoTemplates',
         'DIRS': [os.path.join(BASE_DIR, 'hello/templates')],
-        'APP_DIRS': True,
         'OPTIONS': {
             'context_processors': [
                 'django.template.context_processors.debug',
@@ -63,9 +63,17 @@ TEMPLATES = [
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
             ],
+            'loaders': [
+                'django.template.loaders.filesystem.Loader',
+                'django.template.loaders.app_directories.Loader',
+            ],
         },
     },
 ]
+if not DEBUG:
+    # templates are compiled once per process and kept, see WARMUP
+    TEMPLATES[0]['OPTIONS']['loaders'] = [('django.template.loaders.cached.Loader',
+                                           TEMPLATES[0]['OPTIONS']['loaders'])]
 
 WSGI_APPLICATION = 'cs4221.wsgi.application'
 
@@ -130,3 +138,105 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/1.10/howto/static-files/
 
 STATIC_URL = '/cs4221/static/'
+
+# ./manage.py collectstatic copies the assets here with a content hash in their names, plus gzip copies,
+# for Apache to serve with far-future expiry (see conf/httpd-app.conf)
+STATIC_ROOT = os.path.join(BASE_DIR, 'static')
+STATICFILES_STORAGE = 'hello.storage.CompressedManifestStaticFilesStorage'
+
+
+# Uploads
+# Largest ER XML accepted, in bytes. Uploads bigger than FILE_UPLOAD_MAX_MEMORY_SIZE are spooled to disk
+# by Django and parsed as a stream, so workers only ever hold one copy of the content.
+
+ER_MAX_UPLOAD_SIZE = 20 * 1024 * 1024
+
+
+# Workspaces
+# State of each diagram being converted. Only the workspace id is kept in the session.
+# 'memory' keeps workspaces inside the worker process (development server only),
+# 'file' shares them between the worker processes of a host, 'sqlite' stands in for shared storage.
+# Workspaces not touched for WORKSPACE_TTL seconds are removed.
+
+WORKSPACE_STORE = 'file'
+
+WORKSPACE_DIR = os.path.join(BASE_DIR, 'workspaces')
+
+WORKSPACE_SQLITE_PATH = os.path.join(BASE_DIR, 'workspaces.sqlite3')
+
+WORKSPACE_MEMORY_ENTRIES = 256
+
+WORKSPACE_TTL = 24 * 60 * 60
+
+
+# Conversion result cache
+# Finished JSON Schema output is cached per worker, keyed by a hash of the diagram and applied decisions.
+# Results are also kept on disk in CONVERSION_CACHE_DIR, shared by all daemon processes like JOB_DIR, so a
+# schema permalink is found whichever process converted it. None keeps them in the worker's memory only.
+
+CONVERSION_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+CONVERSION_CACHE_DIR = os.path.join(BASE_DIR, 'conversions')
+
+
+# Background jobs
+# Diagrams with at least JOB_MIN_OBJECTS entities and relationships are converted by a pool of
+# JOB_WORKERS processes per daemon process instead of the request thread, the page polls for the result.
+# Jobs not finished after JOB_TIMEOUT seconds are reported as failed, results are kept for JOB_TTL seconds.
+
+JOB_MIN_OBJECTS = 500
+
+JOB_WORKERS = 2
+
+JOB_DIR = os.path.join(BASE_DIR, 'jobs')
+
+JOB_TIMEOUT = 10 * 60
+
+JOB_TTL = 24 * 60 * 60
+
+# Smaller diagrams of at least OFFLOAD_MIN_BYTES of XML are validated and converted by the same pool while
+# the request thread waits. The thread does not hold the GIL meanwhile, so the other threads of the daemon
+# process keep serving pages. None validates and converts every diagram below JOB_MIN_OBJECTS in the request thread.
+
+OFFLOAD_MIN_BYTES = 32 * 1024
+
+
+# Warm-up
+# With WARMUP, cs4221/wsgi.py imports the views, compiles the templates and the XML Schema, converts
+# hello/data/full_sample.xml and starts the job workers before a process takes requests, see hello/warmup.py.
+# A warning is logged when importing takes more than WARMUP_IMPORT_BUDGET seconds or the whole start more than
+# WARMUP_STARTUP_BUDGET seconds; ./manage.py check_startup measures both in a new process.
+
+WARMUP = True
+
+WARMUP_IMPORT_BUDGET = 2.0
+
+WARMUP_STARTUP_BUDGET = 5.0
+
+
+# Instrumentation
+# Every response carries a Server-Timing header with the time spent per conversion stage.
+# Histograms of the stage timings of each worker are served at /hello/metrics to METRICS_ALLOWED_IPS only.
+
+METRICS_ALLOWED_IPS = ['127.0.0.1', '::1']
+
+
+# Logging
+# Converter and view logs go to the console (the Apache error log under mod_wsgi).
+# Set HELLO_LOG_LEVEL=DEBUG to trace the conversion of each table.
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'hello': {
+            'handlers': ['console'],
+            'level': os.environ.get('HELLO_LOG_LEVEL', 'INFO'),
+        },
+    },
+}
@@ -7,7 +7,8 @@ For more information on this file, see
 https://docs.djangoproject.com/en/1.10/howto/deployment/wsgi/
 """
 
-import os, sys
+import os, sys, time
+started = time.time()
 sys.path.append('/Applications/djangostack-1.10.6-0/apps/django/django_projects/cs4221')
 os.environ.setdefault("PYTHON_EGG_CACHE", "/Applications/djangostack-1.10.6-0/apps/django/django_projects/cs4221/egg_cache")
 
@@ -17,3 +18,9 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "cs4221.settings")
 
 application = get_wsgi_application()
+
+# do what the first requests would do for the first time before taking any, see hello/warmup.py
+from django.conf import settings
+if getattr(settings, 'WARMUP', False):
+    from hello.warmup import warm_up
+    warm_up(started)
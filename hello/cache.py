@@ -0,0 +1,176 @@
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+import lxml.etree as etree
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from instrumentation import timed
+
+"""
+cache.py
+content-addressed cache for finished JSON Schema output, shared by all threads of a worker
+"""
+
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+# compressed copies of schemas served by permalink, only in memory so they never push out a conversion
+ENCODED_SCHEMA_MAX_BYTES = 16 * 1024 * 1024
+
+
+class ConversionCache(object):
+    """
+    Size-bounded LRU cache of JSON Schema output keyed by content hash.
+    When a directory is given, entries are also written there so they survive worker restarts.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, directory=None):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        if directory is not None and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.pop(key, None)
+            if value is not None:
+                self.entries[key] = value  # most recently used goes last
+                return value
+
+        value = self.read_from_disk(key)
+        if value is not None:
+            self.put_in_memory(key, value)
+        return value
+
+    def set(self, key, value):
+        self.put_in_memory(key, value)
+        self.write_to_disk(key, value)
+
+    def put_in_memory(self, key, value):
+        if len(value) > self.max_bytes:
+            return
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous)
+            self.entries[key] = value
+            self.size += len(value)
+            while self.size > self.max_bytes:
+                evicted_key, evicted_value = self.entries.popitem(last=False)
+                self.size -= len(evicted_value)
+
+    def get_path(self, key):
+        return os.path.join(self.directory, key + '.json')
+
+    def read_from_disk(self, key):
+        if self.directory is None:
+            return None
+        try:
+            with open(self.get_path(key), 'rb') as cached_file:
+                return cached_file.read()
+        except IOError:
+            return None
+
+    def write_to_disk(self, key, value):
+        if self.directory is None:
+            return
+        # write to a temporary file first, so other threads and processes never read a partial entry
+        fd, temp_path = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, 'wb') as temp_file:
+            temp_file.write(value)
+        os.rename(temp_path, self.get_path(key))
+
+
+class LRUCache(object):
+    """
+    Thread-safe LRU cache of Python objects, bounded by number of entries
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.pop(key, None)
+            if value is not None:
+                self.entries[key] = value
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+_conversion_cache = None
+_table_cache = LRUCache(16)
+_diagram_cache = LRUCache(16)
+_encoded_schema_cache = ConversionCache(ENCODED_SCHEMA_MAX_BYTES)
+_conversion_cache_lock = threading.Lock()
+
+
+def get_conversion_cache():
+    """
+    Conversion cache of this worker, configured by CONVERSION_CACHE_MAX_BYTES and CONVERSION_CACHE_DIR
+    """
+    global _conversion_cache
+    if _conversion_cache is None:
+        with _conversion_cache_lock:
+            if _conversion_cache is None:
+                _conversion_cache = ConversionCache(getattr(settings, 'CONVERSION_CACHE_MAX_BYTES', DEFAULT_MAX_BYTES),
+                                                    getattr(settings, 'CONVERSION_CACHE_DIR', None))
+    return _conversion_cache
+
+
+@receiver(setting_changed)
+def reset_conversion_cache(setting, **kwargs):
+    """
+    Start a new conversion cache when its settings are overridden, e.g. by tests
+    """
+    global _conversion_cache
+    if setting in ['CONVERSION_CACHE_MAX_BYTES', 'CONVERSION_CACHE_DIR']:
+        with _conversion_cache_lock:
+            _conversion_cache = None
+
+
+def get_table_cache():
+    """
+    Recently converted tables of this worker, kept as objects so a later decision can reuse the unaffected ones
+    """
+    return _table_cache
+
+
+def get_diagram_cache():
+    """
+    Diagrams compiled while an upload was streamed, by workspace id, so the first decisions are found
+    without parsing the upload again
+    """
+    return _diagram_cache
+
+
+def get_encoded_schema_cache():
+    """
+    Compressed JSON Schema by output key and content encoding, e.g. <key>.gzip
+    """
+    return _encoded_schema_cache
+
+
+@timed('hash')
+def get_cache_key(tree):
+    """
+    Canonical hash of the ER XML. Key and merge decisions are applied to the tree before conversion
+    (chosen keys, checked/merged flags, merged relation attributes), so the hash covers them too.
+    :param tree: XML parsed as lxml tree
+    :return: hex digest
+    """
+    return hashlib.sha1(etree.tostring(tree, method='c14n')).hexdigest()
@@ -1,14 +1,30 @@
+import io
 import json
-import xml.etree.ElementTree as ET
+import logging
+import os
+import tempfile
+import threading
+import lxml.etree as etree
 from django.shortcuts import render, redirect
 from django.http import HttpResponse
 from django.http import JsonResponse
+from django.conf import settings
+from graph import resolve_order, connected_components
+from cache import get_conversion_cache, get_table_cache, get_cache_key
+from workspace import get_session_workspace, save_workspace, OP_PRIMARY_KEY, OP_MERGE
+from instrumentation import timed
+from jobs import submit_job, submit_split_job, get_worker_count, run_in_worker, get_job_result, JobError
+from model import Attribute, Key, Entity, Relationship, Table
+from json_writer import iter_schema_json, join_schema_json, dumps_table
+from versions import get_table_delta
 
 """
 converter.py
 main class for handling ER to JSON Schema conversion logic
 """
 
+logger = logging.getLogger(__name__)
+
 # =================
 #  CONSTANTS
 # =================
@@ -16,6 +32,9 @@ main class for handling ER to JSON Schema conversion logic
 TYPE_STRONG = 'strong'
 TYPE_WEAK = 'weak'
 
+# parts a split diagram is cut into per worker process, so a slow part does not keep the others idle
+PARTS_PER_WORKER = 4
+
 # keys used in JSON Schema
 TABLE_NAME = 'name'
 TABLE_ATTRIBUTES = 'attributes'
@@ -45,106 +64,804 @@ XML_ATTRIBUTES = 'attributes'
 XML_CHECKED = 'checked'
 XML_MERGED = 'merged'
 
+# format of the uploaded XML, see validate_tree
+# ids of the background jobs started by a session, only their results are shown to it (see job_display)
+SESSION_JOB_IDS = 'job_ids'
+MAX_SESSION_JOBS = 20
+
+XML_SCHEMA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'xsd', 'er_diagram.xsd')
+
+_schema_local = threading.local()
+
 
 # =================
 #  VALIDATION
 # =================
-def validate_xml(request, tree):
+def validate_xml(request, tree, changed_names=None):
     """
     Before converting to JSON Schema, validate the input XML
     :param request: request sent from UI which contains the XML content
     :param tree: XML parsed as ElementTree
+    :param changed_names: tables changed by decisions since the last conversion, if only those should be redone
     :return: processed JSON tables if valid, otherwise response with error message
     """
     try:
-        xml_content = request.session.get('xmlContent')
-
-        # basic check:
-        for child in tree:
-            # only entity and relationship object is recognised
-            if child.tag != 'entity' and child.tag != 'relationship':
-                return render_error_message(request,
-                                            'Invalid object type [' + child.tag + ']. This file can only contain '
-                                                                                  'entity or relationship object ')
-
-            # each object contains only valid tags ['attribute', 'key', 'uniqueKey', 'foreignKey']
-            for element in child:
-                if element.tag not in [XML_ATTRIBUTE, XML_KEY, XML_UNIQUE_KEY, XML_FOREIGN_KEY]:
-                    return render_error_message(request,
-                                                '[' + child.attrib[XML_NAME] + '] has invalid tag ' + element.tag + '!')
-
-        # select primary key
-        entities = convert_from_xml_nodes(tree.findall(XML_OBJ_ENTITY))
-        relationships = convert_from_xml_nodes(tree.findall(XML_OBJ_RELATIONSHIP))
-        for entity in entities.values():
-            if len(entity[XML_KEYS]) > 1:
-                return prompt_choose_key_option(request, entity[XML_NAME], xml_content,
-                                                get_primary_key_display_options(entity, relationships))
-            elif len(entity[XML_KEYS]) == 0:
-                return render_error_message(request, entity[XML_NAME] + " has no primary key")
-
-        # merge 1-1 table
-        for relationship in relationships.values():
-            if relationship["checked"] == "1":
-                continue  # skip relationship object checked
-            for attribute in relationship[XML_ATTRIBUTES].values():
-                if XML_MIN in attribute and XML_MAX in attribute \
-                        and attribute[XML_MIN] == "1" and attribute[XML_MAX] == "1":
-                    merge_from = relationship[XML_NAME]
-                    merge_to = entities[attribute[XML_ENTITY_ID]][XML_NAME]
-                    return prompt_merge_option(request, merge_to, merge_from)
-
+        # converting again only the tables affected by a decision is quick, so it stays in this thread
+        workspace = get_session_workspace(request)
+        incremental = changed_names is not None and workspace is not None and \
+            get_previous_tables(workspace, changed_names)[0] is not None
+
+        content = None if incremental else get_offloaded_content(tree)
+        if content is not None:
+            return convert_xml_in_worker(request, tree, content)
+
+        # a diagram converted before has nothing left to validate or decide
+        output_json = get_conversion_cache().get(get_cache_key(tree))
+        if output_json is not None:
+            return render_result(request, output_json, get_cache_key(tree))
+
+        # basic check happens while compiling, so the tree is only walked once
+        diagram = compile_diagram(tree)
+
+        # collect every primary key and merge choice up front, so they can be answered on one page
+        key_choices, merge_choices = discover_decisions(diagram)
+        if len(key_choices) > 0 or len(merge_choices) > 0:
+            return prompt_decisions(request, key_choices, merge_choices)
+
+        # large diagrams are converted in a worker process, while the page polls for the result
+        if is_large_diagram(diagram) and not incremental:
+            return start_conversion_job(request, tree, diagram)
+
+    except DiagramError as e:
+        return render_error_message(request, str(e))
     except Exception:
         return render_error_message(request, 'Unexpected error occurred!')
 
-    return convert_xml_to_json(request, tree)
+    return convert_xml_to_json(request, tree, diagram, changed_names)
+
+
+def get_xml_schema():
+    """
+    Compiled XML Schema of the ER diagram format. It is compiled once per thread, since lxml keeps
+    the errors of the last validation on the schema object.
+    """
+    schema = getattr(_schema_local, 'schema', None)
+    if schema is None:
+        schema = _schema_local.schema = etree.XMLSchema(etree.parse(XML_SCHEMA_PATH))
+    return schema
+
+
+def parse_xml(content):
+    """
+    Parse ER XML, comments and processing instructions are left out so only objects remain under the root
+    :param content: XML string
+    :return: root element, raises etree.XMLSyntaxError for malformed XML
+    """
+    return etree.fromstring(content, etree.XMLParser(remove_comments=True, remove_pis=True))
+
+
+def validate_tree(tree):
+    """
+    Check a parsed diagram against the XML Schema, raises DiagramError with every violation found
+    :param tree: XML parsed with parse_xml
+    """
+    schema = get_xml_schema()
+    if not schema.validate(etree.ElementTree(tree)):
+        raise_schema_errors(schema.error_log)
+
+
+def raise_schema_errors(error_log):
+    """
+    Raise a DiagramError listing the XML Schema violations of an error log, if there are any
+    """
+    problems = []
+    for error in error_log:
+        if error.domain != etree.ErrorDomains.SCHEMASV:
+            continue  # malformed XML is reported by the parser
+        # lines are not known when validating while streaming
+        problems.append(('Line ' + str(error.line) + ': ' if error.line > 0 else '') + error.message)
+    if len(problems) > 0:
+        raise DiagramError('The xml is not a valid ER diagram. ' + ' '.join(problems), problems)
+
+
+@timed('validate')
+def check_diagram(diagram):
+    """
+    Referential integrity of a compiled diagram in one pass over its objects: references to unknown
+    entities and relationships, relationships not connecting two objects, weak entities without an owner,
+    entities without a primary key and circular references. Raises DiagramError listing all of them.
+    :param diagram: compiled Diagram
+    """
+    problems = []
+    for name in diagram.names:
+        diagram_object = diagram.objects[name]
+        if isinstance(diagram_object, Entity):
+            problems.extend(check_entity(diagram_object, diagram))
+        else:
+            problems.extend(check_relationship(diagram_object, diagram))
+
+    missing_keys = [name for name in diagram.entity_names if len(diagram.objects[name].keys) == 0]
+    if len(missing_keys) == 1:
+        problems.append(missing_keys[0] + " has no primary key")
+    elif len(missing_keys) > 1:
+        problems.append(', '.join(missing_keys) + " have no primary key")
+
+    if len(diagram.cycles) > 0:
+        problems.append(get_circular_reference_message(diagram.cycles))
+
+    if len(problems) > 0:
+        raise DiagramError('; '.join(problems), problems)
+
+
+def check_entity(entity, diagram):
+    if entity.relation_id is None:
+        return []
+    relationship = diagram.relationships.get(entity.relation_id)
+    if relationship is None:
+        return ['[' + entity.name + '] refers to unknown relationship ' + entity.relation_id]
+    if get_dependent_entity_id(entity, relationship) not in diagram.entities:
+        return ['[' + entity.name + '] is weak, but [' + relationship.name + '] connects it to no other entity']
+    return []
+
+
+def check_relationship(relationship, diagram):
+    if relationship.merged == "1":
+        return []  # merged into another table, it is not converted
+    problems = []
+    dependency_count = 0
+    for attribute in relationship.attributes.values():
+        if attribute.entity_id is not None:
+            dependency_count += 1
+            if attribute.entity_id not in diagram.entities:
+                problems.append('[' + relationship.name + '] refers to unknown entity ' + attribute.entity_id)
+        if attribute.relation_id is not None:
+            dependency_count += 1
+            if attribute.relation_id not in diagram.relationships:
+                problems.append('[' + relationship.name + '] refers to unknown relationship ' + attribute.relation_id)
+    if dependency_count != 2:
+        problems.append('[' + relationship.name + '] connects ' + str(dependency_count) +
+                        ' entities or relationships instead of two')
+    return problems
+
+
+def discover_decisions(diagram):
+    """
+    Find every decision the user has to make before the diagram can be converted
+    :param diagram: compiled Diagram
+    :return: (key_choices, merge_choices), raises DiagramError for every problem check_diagram finds
+    """
+    check_diagram(diagram)
+
+    key_choices = []
+    for name in diagram.entity_names:
+        entity = diagram.objects[name]
+        if len(entity.keys) > 1:
+            key_choices.append({
+                'table_name': name,
+                'options': get_primary_key_display_options(entity, diagram.relationships)
+            })
+
+    # merge 1-1 table
+    merge_choices = []
+    for name in diagram.relationship_names:
+        relationship = diagram.objects[name]
+        if relationship.checked == "1":
+            continue  # skip relationship object checked
+        merge_to = get_merge_target(relationship, diagram.entities)
+        if merge_to is not None:
+            merge_choices.append({
+                'merge_from': name,
+                'merge_to': merge_to
+            })
+
+    return key_choices, merge_choices
+
+
+def apply_decision_map(tree, diagram, decision_map):
+    """
+    Apply decisions given as {"primary_keys": {table name: option index}, "merges": {relationship name: true/false}}
+    :param tree: XML parsed as ElementTree
+    :param diagram: compiled Diagram of the tree
+    :param decision_map: decisions, e.g. decoded from a JSON request
+    :return: updated tree, raises DiagramError listing every decision that does not fit the diagram
+    """
+    key_decisions, merge_decisions = check_decision_map(diagram, decision_map)
+    return apply_decisions_in_xml(tree, key_decisions, merge_decisions)
+
+
+def check_decision_map(diagram, decision_map):
+    """
+    Check decisions against the diagram they are made on, the table a relationship is merged into is
+    worked out from the diagram rather than taken from the input
+    :param diagram: compiled Diagram
+    :param decision_map: see apply_decision_map
+    :return: (dict of table name -> primary key option, list of (merge_table, merge_from, merge_to)),
+    raises DiagramError listing every decision that does not fit the diagram
+    """
+    errors = []
+    key_decisions = {}
+    for table_name, primary_key_option in decision_map.get('primary_keys', {}).items():
+        if table_name not in diagram.objects:
+            errors.append('Unknown table [' + table_name + ']')
+            continue
+        primary_key_option = get_key_option(primary_key_option)
+        if primary_key_option is None or primary_key_option >= len(diagram.objects[table_name].keys):
+            errors.append('Invalid primary key option for [' + table_name + ']')
+            continue
+        key_decisions[table_name] = primary_key_option
+
+    merge_decisions = []
+    relationship_names = set(diagram.relationship_names)
+    for merge_from, merge_table in decision_map.get('merges', {}).items():
+        if merge_from not in relationship_names:
+            errors.append('Unknown relationship [' + merge_from + ']')
+            continue
+        merge_to = get_merge_target(diagram.objects[merge_from], diagram.entities)
+        if merge_to is None:
+            errors.append('[' + merge_from + '] cannot be merged into another table')
+            continue
+        merge_table = get_merge_flag(merge_table)
+        if merge_table is None:
+            errors.append('Invalid merge decision for [' + merge_from + ']')
+            continue
+        merge_decisions.append((merge_table, merge_from, merge_to))
+
+    if len(errors) > 0:
+        raise DiagramError(', '.join(errors))
+    return key_decisions, merge_decisions
+
+
+def get_key_option(value):
+    """
+    :return: primary key option given as an integer or a string of digits (a form field), otherwise None
+    """
+    if isinstance(value, (int, long)) and not isinstance(value, bool) and value >= 0:
+        return value
+    if isinstance(value, basestring) and value.isdigit():
+        return int(value)
+    return None
+
+
+def get_merge_flag(value):
+    """
+    :return: "1" to merge and "0" not to for a boolean, 0 or 1 (also as a form field), otherwise None
+    """
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, (int, long, basestring)) and value in [0, 1, "0", "1"]:
+        return str(value)
+    return None
+
+
+def get_merge_target(relationship, entities):
+    """
+    A relationship with [1,1] participation of an entity can be merged into that entity's table
+    :return: name of the entity table, or None if the relationship cannot be merged
+    """
+    attributes = relationship.attributes
+    for attribute_id in sorted(attributes):
+        attribute = attributes[attribute_id]
+        if attribute.entity_id is not None and attribute.min_participation == "1" and \
+                attribute.max_participation == "1":
+            return entities[attribute.entity_id].name
+    return None
 
 
 # =================
 #  CONVERSION
 # =================
-def convert_xml_to_json(request, tree):
+def convert_xml_to_json(request, tree, diagram=None, changed_names=None):
     """
     Main method for converting ER XML to JSON Schema
     :param request: request sent from UI
     :param tree: XML parsed as ElementTree
+    :param diagram: compiled Diagram of the tree, compiled here when not given
+    :param changed_names: tables changed since the last conversion in this workspace, None to convert everything
     :return: processed JSON tables, otherwise error message when data violates the rule
     """
+    if diagram is None:
+        content = get_offloaded_content(tree)
+        if content is not None:
+            return convert_xml_in_worker(request, tree, content)
+
     try:
-        # Prep Data
-        entities = convert_from_xml_nodes(tree.findall(XML_OBJ_ENTITY))
-        entities_list = sort_entities_into_weak_and_strong(entities)
-        weak_entities = entities_list[TYPE_WEAK]
-        strong_entities = entities_list[TYPE_STRONG]
+        previous_tables = None
+        workspace = get_session_workspace(request)
+        if changed_names is not None and workspace is not None:
+            previous_tables, changed_names = get_previous_tables(workspace, changed_names)
+        cache_key, output_json = convert_tree(tree, diagram, previous_tables, changed_names)
+    except DiagramError as e:
+        return render_error_message(request, str(e))
+    except DecisionRequired as e:
+        # return to UI, ask user to choose primary key or whether to merge relationship into another table
+        return prompt_decisions(request, e.key_choices, e.merge_choices)
+    except Exception:
+        return render(request, 'upload.html', {
+            'uploaded_file_error': "Unexpected error"
+        })
+
+    return render_result(request, output_json, cache_key)
+
+
+def get_previous_tables(workspace, changed_names):
+    """
+    Tables of the workspace's last conversion, or of the previous version's when this version has no result yet
+    :param workspace: Workspace
+    :param changed_names: tables changed by decisions since
+    :return: (dict of table name -> Table or None when not in the table cache, names of all tables changed since)
+    """
+    if workspace.output_key is not None:
+        return get_table_cache().get(workspace.output_key), changed_names
+    if workspace.base_key is not None:
+        return get_table_cache().get(workspace.base_key), set(changed_names) | set(workspace.stale_names)
+    return None, changed_names
+
 
-        relationships = convert_from_xml_nodes(tree.findall(XML_OBJ_RELATIONSHIP))
+def convert_xml_in_worker(request, tree, content):
+    """
+    Same as validate_xml, but the diagram is compiled, checked and converted in a worker process
+    while this request thread waits without holding the GIL, see convert_in_worker
+    :param request: request sent from UI
+    :param tree: XML parsed as ElementTree
+    :param content: the tree serialized, see get_offloaded_content
+    :return: response with the result, the decisions to make or the error message
+    """
+    cache_key = get_cache_key(tree)
+    output_json = get_conversion_cache().get(cache_key)
+    if output_json is None:
+        try:
+            key_choices, merge_choices, output_json = convert_in_worker(content)
+        except DiagramError as e:
+            return render_error_message(request, str(e))
+        except Exception:
+            return render_error_message(request, 'Unexpected error occurred!')
+        if output_json is None:
+            return prompt_decisions(request, key_choices, merge_choices)
+        get_conversion_cache().set(cache_key, output_json)
+    return render_result(request, output_json, cache_key)
+
+
+def convert_tree(tree, diagram=None, previous_tables=None, changed_names=None):
+    """
+    Serialized JSON Schema of a tree with all decisions applied, from the conversion cache when possible
+    :param tree: XML parsed as ElementTree
+    :param diagram: compiled Diagram of the tree, compiled here when needed
+    :param previous_tables: see convert_diagram
+    :param changed_names: see convert_diagram
+    :return: (cache key, JSON Schema string)
+    """
+    cache_key = get_cache_key(tree)
+    output_json = get_conversion_cache().get(cache_key)
+    if output_json is None:
+        if diagram is None:
+            diagram = compile_diagram(tree)
+        processed_tables = convert_diagram(diagram, previous_tables, changed_names)
+        get_table_cache().set(cache_key, processed_tables)
+        with timed('serialize'):
+            output_json = dumps_schema(processed_tables)
+        get_conversion_cache().set(cache_key, output_json)
+    return cache_key, output_json
+
+
+def is_large_diagram(diagram):
+    """
+    Whether the diagram is converted as a background job rather than inline, see JOB_MIN_OBJECTS
+    """
+    return len(diagram.objects) >= settings.JOB_MIN_OBJECTS
 
-        # Start Processing
-        processed_tables = process_strong_entities(request, strong_entities, {})
 
-        processed_tables = process_weak_entities(request, weak_entities, entities, relationships, processed_tables)
-        if isinstance(processed_tables, HttpResponse):
-            return processed_tables
+def get_offloaded_content(tree):
+    """
+    Serialize a tree that should be converted in a worker process, see OFFLOAD_MIN_BYTES. Large diagrams
+    are not, they become background jobs instead.
+    :param tree: XML parsed as ElementTree
+    :return: serialized XML, or None to convert in the request thread
+    """
+    min_bytes = getattr(settings, 'OFFLOAD_MIN_BYTES', None)
+    if min_bytes is None or len(tree) >= settings.JOB_MIN_OBJECTS:
+        return None
+    content = etree.tostring(tree)
+    return content if len(content) >= min_bytes else None
+
 
-        processed_tables = process_relationships(request, relationships, entities, processed_tables)
-        if isinstance(processed_tables, HttpResponse):
-            return processed_tables
+def is_offloaded_upload(size):
+    """
+    Whether an upload of size bytes is validated in a worker process, see OFFLOAD_MIN_BYTES
+    """
+    min_bytes = getattr(settings, 'OFFLOAD_MIN_BYTES', None)
+    return min_bytes is not None and size >= min_bytes
 
-        for table in processed_tables.values():
-            table["type"] = "object"
-            table.pop(TABLE_NAME)  # Remove the table name we stored for convenience during processing
 
-        output_json = json.dumps(processed_tables, indent=4)
-        request.session['output_json'] = output_json
-        request.session.save()
+@timed('worker')
+def convert_in_worker(content, compact=False):
+    """
+    Compile, check and convert a diagram in a worker process of jobs.py and wait for it
+    :param content: serialized XML
+    :param compact: serialize the schema without whitespace, see iter_schema_json
+    :return: see convert_offloaded_job, raises DiagramError
+    """
+    return run_in_worker(convert_offloaded_job, (content, compact))
+
+
+def convert_offloaded_job(content, compact=False):
+    """
+    Compile, check and convert a diagram, runs in a worker process for a request waiting for it.
+    Only picklable exceptions may leave it, DecisionRequired is returned as the open choices instead.
+    The tables stay in the worker: a dict unpickled in another process may iterate in another order,
+    which would change the JSON serialized from it.
+    :param content: serialized XML
+    :param compact: see convert_in_worker
+    :return: (key choices, merge choices, JSON Schema string), the schema is None while a decision is open
+    """
+    try:
+        diagram = compile_diagram(etree.fromstring(content))
+        key_choices, merge_choices = discover_decisions(diagram)
+        if len(key_choices) > 0 or len(merge_choices) > 0:
+            return key_choices, merge_choices, None
+        return [], [], ''.join(iter_schema_json(convert_diagram(diagram), compact))
+    except DecisionRequired as e:
+        return e.key_choices, e.merge_choices, None
+    except DiagramError:
+        raise
     except Exception:
-        return render(request, 'upload.html', {
-            'uploaded_file_error': "Unexpected error"
-        })
+        logger.exception('conversion in worker process failed')
+        raise JobError('Unexpected error occurred!')
 
-    return render(request, 'display_result.html', {
-        'output_json': output_json
-    })
+
+@timed('worker')
+def check_upload_in_worker(er_file):
+    """
+    Validate an upload in a worker process of jobs.py and wait for it, the same checks the upload view
+    makes in its own thread for small files. The worker streams the upload from disk, so it is never read
+    whole or pickled: a large upload is already in a temporary file, a smaller one is written to one.
+    :param er_file: UploadedFile
+    :return: raises DiagramError for an invalid diagram and JobError for malformed XML
+    """
+    if hasattr(er_file, 'temporary_file_path'):
+        run_in_worker(check_upload_job, (er_file.temporary_file_path(),))
+        return
+
+    fd, path = tempfile.mkstemp(suffix='.upload.xml', dir=settings.FILE_UPLOAD_TEMP_DIR)
+    try:
+        with os.fdopen(fd, 'wb') as upload_file:
+            for chunk in er_file.chunks():
+                upload_file.write(chunk)
+        run_in_worker(check_upload_job, (path,))
+    finally:
+        os.remove(path)
+
+
+def check_upload_job(path):
+    """
+    Validate an upload, runs in a worker process for a request waiting for it
+    :param path: file name of the uploaded XML
+    """
+    try:
+        check_diagram(compile_diagram_from_stream(path))
+    except DiagramError:
+        raise
+    except Exception:
+        # lxml's parse errors do not survive pickling
+        raise JobError('The uploaded xml is invalid.')
+
+
+def convert_job(content):
+    """
+    Background job converting a diagram, runs in a worker process (see jobs.py)
+    :param content: serialized XML with all decisions applied
+    :return: JSON Schema string
+    """
+    try:
+        diagram = compile_diagram(etree.fromstring(content))
+        return dumps_schema(convert_diagram(diagram))
+    except DiagramError as e:
+        raise JobError(str(e))
+    except DecisionRequired:
+        raise JobError('Some primary key or merge decisions are still open.')
+
+
+def submit_conversion_job(tree, diagram):
+    """
+    Convert a large diagram in the background. A diagram made of independent components is split into parts,
+    so that all worker processes convert it at the same time.
+    :param tree: XML parsed as ElementTree, with all decisions applied
+    :param diagram: compiled Diagram of the tree
+    :return: job id, the cache key of the tree
+    """
+    job_id = get_cache_key(tree)
+    parts = split_diagram(tree, diagram, get_worker_count() * PARTS_PER_WORKER)
+    if len(parts) > 1:
+        return submit_split_job(job_id, convert_part_job, parts, merge_part_tables, (get_table_order(diagram),))
+    return submit_job(job_id, convert_job, (etree.tostring(tree),))
+
+
+def split_diagram(tree, diagram, part_count):
+    """
+    Split a diagram into parts that do not reference each other, each part being one or more connected
+    components of the diagram. Components are handed out largest first to the part with the fewest objects.
+    :param tree: XML parsed as ElementTree
+    :param diagram: compiled Diagram of the tree
+    :param part_count: most parts to split into
+    :return: list of serialized XML, one per part with its objects in document order, empty if there is only one
+    """
+    if len(diagram.cycles) > 0 or part_count < 2:
+        return []  # converted in one go, so the error lists every circular reference
+
+    # a weak entity needs the relationship it depends through, not only the entity on the other side
+    links = dict((name, list(dependencies)) for name, dependencies in diagram.dependencies.items())
+    for entity in diagram.entities.values():
+        if entity.relation_id is not None and entity.relation_id in diagram.relationships:
+            links[entity.name].append(diagram.relationships[entity.relation_id].name)
+    components = connected_components(diagram.names, links)
+    if len(components) < 2:
+        return []
+
+    part_sizes = [0] * min(part_count, len(components))
+    part_of_name = {}
+    for component in sorted(components, key=len, reverse=True):
+        part = part_sizes.index(min(part_sizes))
+        part_sizes[part] += len(component)
+        for name in component:
+            part_of_name[name] = part
+
+    parts = [[] for _ in part_sizes]
+    for child in tree:
+        parts[part_of_name[child.attrib[XML_NAME]]].append(etree.tostring(child, with_tail=False))
+    return ['<' + tree.tag + '>' + ''.join(part) + '</' + tree.tag + '>' for part in parts]
+
+
+def convert_part_job(content):
+    """
+    Convert one part of a split diagram, runs in a worker process
+    :param content: serialized XML of the part, see split_diagram
+    :return: (error message or None, dict of table name -> JSON of the table)
+    """
+    try:
+        processed_tables = convert_diagram(compile_diagram(etree.fromstring(content)))
+    except DiagramError as e:
+        return str(e), None
+    except DecisionRequired:
+        return 'Some primary key or merge decisions are still open.', None
+    return None, dict((table_name, dumps_table(table.to_json(), False))
+                      for table_name, table in processed_tables.items())
+
+
+def merge_part_tables(results, table_order):
+    """
+    JSON Schema of a split diagram from the tables of its parts. The tables are put together in the order
+    convert_diagram adds them, so the output is byte for byte the one of a conversion in one go.
+    :param results: results of convert_part_job, in the order of the parts
+    :param table_order: see get_table_order
+    :return: JSON Schema string
+    """
+    serialized_tables = {}
+    for error, part_tables in results:
+        if error is not None:
+            raise JobError(error)  # the first error in document order, like a conversion in one go
+        serialized_tables.update(part_tables)
+
+    ordered_tables = {}
+    for table_name in table_order:
+        if table_name in serialized_tables:
+            ordered_tables[table_name] = serialized_tables[table_name]
+    return ''.join(join_schema_json(ordered_tables.items()))
+
+
+def get_table_order(diagram):
+    """
+    Names of the objects in the order convert_diagram converts them into tables
+    """
+    entities_list = sort_entities_into_weak_and_strong(diagram.entities)
+    weak_entity_names = set(weak_entity.name for weak_entity in entities_list[TYPE_WEAK])
+    relationship_names = set(diagram.relationship_names)
+    return ([strong_entity.name for strong_entity in entities_list[TYPE_STRONG]] +
+            [name for name in diagram.order if name in weak_entity_names] +
+            [name for name in diagram.order if name in relationship_names])
+
+
+def convert_diagram(diagram, previous_tables=None, changed_names=None):
+    """
+    Convert a compiled diagram into JSON Schema tables, without any UI interaction
+    :param diagram: compiled Diagram, with all primary key and merge decisions applied
+    :param previous_tables: result of an earlier conversion of the same diagram, to be reused where possible
+    :param changed_names: objects changed since previous_tables, only they and the tables depending on them
+    are converted again
+    :return: dict of table name -> Table, see dumps_schema for the JSON Schema
+    """
+    if len(diagram.cycles) > 0:
+        raise DiagramError(get_circular_reference_message(diagram.cycles))
+
+    # Prep Data
+    entities_list = sort_entities_into_weak_and_strong(diagram.entities)
+    weak_entities = entities_list[TYPE_WEAK]
+    strong_entities = entities_list[TYPE_STRONG]
+
+    processed_tables = {}
+    if previous_tables is not None and changed_names is not None:
+        processed_tables = get_reusable_tables(diagram, previous_tables, changed_names)
+
+    # Start Processing
+    processed_tables = process_strong_entities(strong_entities, processed_tables)
+    processed_tables = process_weak_entities(weak_entities, diagram, processed_tables)
+    processed_tables = process_relationships(diagram, processed_tables)
+
+    if previous_tables is not None and changed_names is not None:
+        # the reused tables went in first, so a dict built in the order of a full conversion is needed
+        # for the JSON Schema to come out byte for byte the same
+        ordered_tables = {}
+        for table_name in get_table_order(diagram):
+            if table_name in processed_tables:
+                ordered_tables[table_name] = processed_tables[table_name]
+        processed_tables = ordered_tables
+    return processed_tables
+
+
+def dumps_schema(processed_tables):
+    """
+    JSON Schema of converted tables, as one string
+    :param processed_tables: dict of table name -> Table
+    """
+    return ''.join(iter_schema_json(processed_tables))
+
+
+def get_affected_tables(diagram, changed_names):
+    """
+    Follow the reverse dependency edges from the changed objects, e.g. a new primary key of an entity
+    changes the foreign keys of every weak entity and relationship referencing it
+    :param diagram: compiled Diagram
+    :param changed_names: names of objects changed by a decision
+    :return: set of names of all tables that have to be converted again
+    """
+    affected = set()
+    stack = [name for name in changed_names if name in diagram.objects]
+    while len(stack) > 0:
+        name = stack.pop()
+        if name in affected:
+            continue
+        affected.add(name)
+        stack.extend(diagram.dependents[name])
+    return affected
+
+
+def get_reusable_tables(diagram, previous_tables, changed_names):
+    """
+    Previous tables not affected by the changes. Tables are never modified once converted, so they are shared.
+    """
+    affected = get_affected_tables(diagram, changed_names)
+    processed_tables = {}
+    for table_name, table in previous_tables.items():
+        if table_name in diagram.objects and table_name not in affected:
+            processed_tables[table_name] = table
+    return processed_tables
+
+
+class DiagramError(Exception):
+    """
+    Raised when the uploaded XML does not describe a valid ER diagram
+    """
+
+    def __init__(self, message, problems=None):
+        super(DiagramError, self).__init__(message)
+        self.problems = problems if problems is not None else [message]  # each problem on its own
+
+
+class DecisionRequired(Exception):
+    """
+    Raised when conversion cannot go on until the user chooses a primary key or whether to merge a relationship
+    """
+
+    def __init__(self, key_choices, merge_choices):
+        super(DecisionRequired, self).__init__('Decision required')
+        self.key_choices = key_choices
+        self.merge_choices = merge_choices
+
+
+class Diagram(object):
+    """
+    Indexed in-memory ER model, compiled once from the parsed XML and shared by
+    validation, key option generation and table processing.
+    """
+
+    def __init__(self):
+        self.names = []  # object names in document order
+        self.entity_names = []  # entity names in document order
+        self.relationship_names = []  # relationship names in document order
+        self.entities = {}  # entity id -> Entity
+        self.relationships = {}  # relationship id -> Relationship
+        self.objects = {}  # object name -> entity or relationship
+        self.dependencies = {}  # object name -> names of objects it references
+        self.dependents = {}  # object name -> names of objects referencing it (reverse edges)
+        self.order = None  # object names, dependencies first
+        self.cycles = None  # circular references, each a list of object names
+
+    def add_dependency(self, name, dependency_name):
+        self.dependencies[name].append(dependency_name)
+        self.dependents[dependency_name].append(name)
+
+
+@timed('compile')
+def compile_diagram(tree):
+    """
+    Compile the parsed XML into an indexed Diagram in a single pass over the tree.
+    The tree is expected to be valid against the XML Schema (see validate_tree), which allows no other tags.
+    :param tree: XML parsed as ElementTree
+    :return: Diagram
+    """
+    diagram = Diagram()
+    for child in tree:
+        add_diagram_node(diagram, child)
+    link_diagram(diagram)
+    return diagram
+
+
+@timed('compile')
+def compile_diagram_from_stream(source):
+    """
+    Compile ER XML into a Diagram while it is being parsed, so memory stays flat regardless of the diagram size.
+    Every entity and relationship is dropped from the parsed tree as soon as it has been added to the model.
+    The XML is validated against the XML Schema in the same pass.
+    :param source: file-like object or file name
+    :return: Diagram, raises DiagramError for invalid objects and etree.XMLSyntaxError for malformed XML
+    """
+    diagram = Diagram()
+    context = etree.iterparse(source, remove_comments=True, remove_pis=True, schema=get_xml_schema())
+    try:
+        for event, element in context:
+            parent = element.getparent()
+            if parent is None or parent.getparent() is not None:
+                continue  # only objects directly under the root are compiled, their children come with them
+
+            add_diagram_node(diagram, element)
+            element.clear()
+            # the root still references objects consumed before, drop them as well
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+    except Exception:
+        # the parser validates ahead of the objects compiled, so an object that could not be compiled
+        # has already been reported by the schema
+        raise_schema_errors(context.error_log)
+        raise
+    link_diagram(diagram)
+    return diagram
+
+
+def add_diagram_node(diagram, child):
+    """
+    Add an entity or relationship node to the diagram indexes, the XML Schema allows no other objects
+    """
+    if child.tag == XML_OBJ_ENTITY:
+        result = diagram.entities
+        result_names = diagram.entity_names
+    else:
+        result = diagram.relationships
+        result_names = diagram.relationship_names
+    node = convert_from_xml_node(child)
+    result[node.id] = node
+    diagram.names.append(node.name)
+    result_names.append(node.name)
+    diagram.objects[node.name] = node
+    diagram.dependencies[node.name] = []
+    diagram.dependents[node.name] = []
+
+
+def link_diagram(diagram):
+    """
+    Resolve dependency edges once all ids are known, then order the objects and find circular references
+    """
+    for entity in diagram.entities.values():
+        if entity.relation_id is None or entity.relation_id not in diagram.relationships:
+            continue
+        dependent_entity_id = get_dependent_entity_id(entity, diagram.relationships[entity.relation_id])
+        if dependent_entity_id in diagram.entities:
+            diagram.add_dependency(entity.name, diagram.entities[dependent_entity_id].name)
+    for relationship in diagram.relationships.values():
+        for attribute in relationship.attributes.values():
+            if attribute.entity_id is not None and attribute.entity_id in diagram.entities:
+                diagram.add_dependency(relationship.name, diagram.entities[attribute.entity_id].name)
+            if attribute.relation_id is not None and attribute.relation_id in diagram.relationships:
+                diagram.add_dependency(relationship.name, diagram.relationships[attribute.relation_id].name)
+
+    diagram.order, diagram.cycles = resolve_order(diagram.names, diagram.dependencies)
 
 
 def convert_from_xml_nodes(nodes):
@@ -155,38 +872,60 @@ def convert_from_xml_nodes(nodes):
     """
     result = {}
     for node in nodes:
-        node_id = node.attrib[XML_ID]
-        node_name = node.attrib[XML_NAME]
-        node_checked = '0'
-        node_merged = '0'
-        attributes = {}
-        keys = []
-        unique_keys = []
-
-        for attribute in node.findall(XML_ATTRIBUTE):
-            attributes[attribute.attrib[XML_ID]] = attribute.attrib
-        for key in node.findall(XML_KEY):
-            keys.append(key.text)
-        for key in node.findall(XML_UNIQUE_KEY):
-            unique_keys.append(key.text)
-
-        if XML_CHECKED in node.attrib.keys():
-            node_checked = node.attrib[XML_CHECKED]
-        if XML_MERGED in node.attrib.keys():
-            node_merged = node.attrib[XML_MERGED]
-
-        result[node_id] = {
-            "id": node_id,
-            "name": node_name,
-            "checked": node_checked,
-            "merged": node_merged,
-            "attributes": attributes,
-            "keys": keys,
-            "uniqueKeys": unique_keys
-        }
+        converted = convert_from_xml_node(node)
+        result[converted.id] = converted
     return result
 
 
+def convert_from_xml_node(node):
+    """
+    Convert a single entity or relationship node, visiting each of its children once.
+    Only the needed fields are copied, nothing refers back to the tree.
+    :param node: object under XML root data
+    :return: Entity or Relationship
+    """
+    node_id = node.attrib[XML_ID]
+    node_name = node.attrib[XML_NAME]
+    attributes = {}
+    key_ids = []
+    unique_key_ids = []
+    relation_id = None
+
+    for element in node:
+        # the XML Schema allows ['attribute', 'key', 'uniqueKey', 'foreignKey'], foreign keys are derived instead
+        if element.tag == XML_ATTRIBUTE:
+            attrib = element.attrib
+            attribute = Attribute(attrib[XML_ID], attrib.get(XML_NAME), attrib.get(XML_ATTRIBUTE_TYPE),
+                                  attrib.get(XML_ENTITY_ID), attrib.get(XML_RELATION_ID),
+                                  attrib.get(XML_MIN), attrib.get(XML_MAX))
+            attributes[attribute.id] = attribute
+            if relation_id is None and attribute.relation_id is not None:
+                relation_id = attribute.relation_id
+        elif element.tag == XML_KEY:
+            key_ids.append(element.text.split(","))  # [1] or [2, 3]
+        elif element.tag == XML_UNIQUE_KEY:
+            unique_key_ids.append(element.text.split(","))
+
+    object_class = Entity if node.tag == XML_OBJ_ENTITY else Relationship
+    return object_class(node_id, node_name, node.attrib.get(XML_CHECKED, '0'), node.attrib.get(XML_MERGED, '0'),
+                        attributes, get_keys(node_name, key_ids, attributes),
+                        get_keys(node_name, unique_key_ids, attributes), relation_id)
+
+
+def get_keys(node_name, key_ids, attributes):
+    """
+    Resolve the attribute ids of keys
+    :return: list of Key, raises DiagramError for a key referring to an unknown attribute
+    """
+    keys = []
+    for ids in key_ids:
+        for attribute_id in ids:
+            if attribute_id not in attributes:
+                raise DiagramError('[' + node_name + '] has a key with unknown attribute ' + attribute_id + '!')
+        keys.append(Key(attributes[attribute_id] for attribute_id in ids))
+    return keys
+
+
 def sort_entities_into_weak_and_strong(entities):
     """
     Classify entities into weak and strong type
@@ -197,15 +936,10 @@ def sort_entities_into_weak_and_strong(entities):
     result = {TYPE_WEAK: [], TYPE_STRONG: []}
     for entity_id in entities:
         entity = entities[entity_id]
-        relation_id = None
-        for attribute in entity[XML_ATTRIBUTES].values():
-            if XML_RELATION_ID in attribute:
-                relation_id = attribute[XML_RELATION_ID]
-                print entity[XML_NAME] + ' has relation_id ' + relation_id
-                break
+        relation_id = entity.relation_id
 
         if relation_id is not None:
-            print 'weak: ' + entity[XML_NAME]
+            logger.debug('weak: %s has relation_id %s', entity.name, relation_id)
             result[TYPE_WEAK].append(entity)
         else:
             result[TYPE_STRONG].append(entity)
@@ -215,137 +949,115 @@ def sort_entities_into_weak_and_strong(entities):
 # ----------------------------------
 #  CONVERSION -> PROCESS ENTITIES
 # ----------------------------------
-def process_strong_entities(request, strong_entities, processed_tables):
+@timed('strong')
+def process_strong_entities(strong_entities, processed_tables):
     """
     Process all strong entities
-    :param request: HttpRequest
     :param strong_entities: entity list
     :param processed_tables: list of tables already converted to JSON Schema
     :return:
     """
     for strong_entity in strong_entities:
-        processed_tables = process_strong_entity(request, strong_entity, processed_tables)
-        if isinstance(processed_tables, HttpResponse):
-            return processed_tables
+        if is_processed(strong_entity, processed_tables):
+            continue
+        processed_tables = process_strong_entity(strong_entity, processed_tables)
     return processed_tables
 
 
-def process_strong_entity(request, strong_entity, processed_tables):
+def process_strong_entity(strong_entity, processed_tables):
     """
     Process single strong entity
-    :param request:
     :param strong_entity:
     :param processed_tables:
     :return:
     """
-    table_name = strong_entity[XML_NAME]
+    table_name = strong_entity.name
 
     primary_key_options = get_primary_key_options(strong_entity)
     assert len(primary_key_options) == 1
 
-    processed_table = process_entity_into_table(request, strong_entity, primary_key_options)
-    if isinstance(processed_table, HttpResponse):
-        return processed_table
+    processed_table = process_entity_into_table(strong_entity, primary_key_options)
 
     processed_tables[table_name] = processed_table
     return processed_tables
 
 
-def process_weak_entities(request, weak_entities, entities, relationships, processed_tables):
+@timed('weak')
+def process_weak_entities(weak_entities, diagram, processed_tables):
     """
     Process all weak entities
-    :param request: HttpRequest
     :param weak_entities: weak entity list
-    :param entities: total entity list
-    :param relationships: relationship list
+    :param diagram: compiled Diagram
     :param processed_tables: list of tables already converted to JSON Schema
     :return:
     """
-    for weak_entity in weak_entities:
-        if is_processed(weak_entity, processed_tables):
+    # weak entities are visited in dependency order, so the dependent table is always processed first
+    weak_entity_names = set(weak_entity.name for weak_entity in weak_entities)
+    for name in diagram.order:
+        if name not in weak_entity_names or is_processed(diagram.objects[name], processed_tables):
             continue
-        stack = [weak_entity]
-        while len(stack) > 0:
-            current_entity = stack.pop()
-
-            dependent_entity = get_dependent_entity(current_entity, entities, relationships)
-            if is_processed(dependent_entity, processed_tables):
-                dependent_entity_table = processed_tables[dependent_entity[TABLE_NAME]]
-                processed_tables = process_weak_entity(request, current_entity, dependent_entity_table,
-                                                       processed_tables)
-            else:
-                if dependent_entity in stack:
-                    return render_error_message(request, 'Circular reference is detected in uploaded xml!')
-                else:
-                    stack.append(current_entity)
-                    stack.append(dependent_entity)
+        weak_entity = diagram.objects[name]
+        dependent_entity = get_dependent_entity(weak_entity, diagram)
+        dependent_entity_table = processed_tables[dependent_entity.name]
+        processed_tables = process_weak_entity(weak_entity, dependent_entity_table, processed_tables)
     return processed_tables
 
 
-def get_dependent_entity(weak_entity, entities, relationships):
+def get_dependent_entity(weak_entity, diagram):
     """
     For an entity with relation_id as attribute, find the other entity in that relationship
     :param weak_entity:
-    :param entities:
-    :param relationships:
+    :param diagram:
     :return:
     """
-    relationship_id = None
-    for attribute in weak_entity[XML_ATTRIBUTES].values():
-        if XML_RELATION_ID in attribute:
-            relationship_id = attribute[XML_RELATION_ID]
-            break
+    relationship_id = weak_entity.relation_id
     assert relationship_id is not None
 
-    relationship = relationships[relationship_id]
-
-    dependent_entity_id = None
-    for attribute in relationship[TABLE_ATTRIBUTES].values():
-        if attribute[XML_ENTITY_ID] != weak_entity[XML_ID]:
-            dependent_entity_id = attribute[XML_ENTITY_ID]
-            break
+    relationship = diagram.relationships[relationship_id]
 
+    dependent_entity_id = get_dependent_entity_id(weak_entity, relationship)
     assert dependent_entity_id is not None
 
-    dependent_entity = entities[dependent_entity_id]
+    dependent_entity = diagram.entities[dependent_entity_id]
     assert dependent_entity is not None
 
     return dependent_entity
 
 
-def process_weak_entity(request, weak_entity, dependent_entity_table, processed_tables):
+def get_dependent_entity_id(weak_entity, relationship):
+    for attribute in relationship.attributes.values():
+        if attribute.entity_id is not None and attribute.entity_id != weak_entity.id:
+            return attribute.entity_id
+    return None
+
+
+def process_weak_entity(weak_entity, dependent_entity_table, processed_tables):
     """
     Process single weak entity
-    :param request:
     :param weak_entity:
     :param dependent_entity_table:
     :param processed_tables:
     :return:
     """
-    table_name = weak_entity[XML_NAME]
+    table_name = weak_entity.name
     primary_key_options = get_primary_key_options(weak_entity, dependent_entity_table)
-    processed_table = process_entity_into_table(request, weak_entity, primary_key_options, dependent_entity_table)
-    if isinstance(processed_table, HttpResponse):
-        return processed_table
+    processed_table = process_entity_into_table(weak_entity, primary_key_options, dependent_entity_table)
 
     processed_tables[table_name] = processed_table
     return processed_tables
 
 
-def process_entity_into_table(request, entity, primary_key_options, dependent_table=None):
+def process_entity_into_table(entity, primary_key_options, dependent_table=None):
     """
     Convert entity data into JSON object
-    :param request:
     :param entity:
     :param primary_key_options:
     :param dependent_table:
     :return:
     """
-    table_name = entity[XML_NAME]
+    table_name = entity.name
 
-    primary_key_index = get_primary_key_index(request, primary_key_options, table_name)  # prompt user if necessary
-    if isinstance(primary_key_index, HttpResponse):
-        return primary_key_index
+    primary_key_index = get_primary_key_index(primary_key_options, table_name)  # prompt user if necessary
 
     primary_key = primary_key_options[primary_key_index]
     assert len(primary_key) > 0
@@ -363,62 +1075,39 @@ def process_entity_into_table(request, entity, primary_key_options, dependent_ta
             if fkKey not in attribute_list:
                 attribute_list[fkKey] = fkValue
 
-    processed_table = {
-        TABLE_NAME: table_name,
-        TABLE_ATTRIBUTES: attribute_list,
-        TABLE_PRIMARY_KEY: primary_key,
-        # TABLE_FOREIGN_KEYS: foreign_keys,
-        TABLE_UNIQUE: unique
-    }
-    return processed_table
+    return Table(table_name, attribute_list, primary_key, unique)
 
 
 # -------------------------------------
 #  CONVERSION -> PROCESS RELATIONSHIPS
 # -------------------------------------
-def process_relationships(request, relationships, entities, processed_tables):
+@timed('relationships')
+def process_relationships(diagram, processed_tables):
     """
     Process all relationships
-    :param request:
-    :param relationships:
-    :param entities:
+    :param diagram:
     :param processed_tables:
     :return:
     """
-    for relationship in relationships.values():
-        if is_processed(relationship, processed_tables):
+    entities = diagram.entities
+    relationships = diagram.relationships
+    # relationships are visited in dependency order, so referenced tables are always processed first
+    relationship_names = set(diagram.relationship_names)
+    for name in diagram.order:
+        if name not in relationship_names or is_processed(diagram.objects[name], processed_tables):
             continue
+        relationship = diagram.objects[name]
 
-        if relationship["merged"] == "1":
-            print 'skip relationship ' + relationship[XML_NAME]
+        if relationship.merged == "1":
+            logger.debug('skip relationship %s', relationship.name)
             continue
 
         if not is_valid_relationship(relationship, relationships, entities):
-            return render(request, 'upload.html', {
-                'uploaded_file_error': "Relationship " + relationship[XML_NAME] + 'is invalid! Please make sure it is '
-                                                                                  'connecting the correct entity or '
-                                                                                  'relationship! '
-            })
+            raise DiagramError("Relationship " + relationship.name + ' is invalid! Please make sure it is '
+                                                                          'connecting the correct entity or '
+                                                                          'relationship! ')
 
-        stack = [relationship]
-        while len(stack) > 0:
-            current = stack.pop()
-
-            dependent_relationship = get_dependent_relationship(current, relationships)
-            if dependent_relationship is None or is_processed(dependent_relationship, processed_tables):
-                processed_tables = process_relationship_into_table(request, current, processed_tables, entities,
-                                                                   relationships)
-                # return to UI, ask user whether to merge relationship into another table
-                if isinstance(processed_tables, HttpResponse):
-                    return processed_tables
-            else:
-                if dependent_relationship in stack:
-                    return render(request, 'upload.html', {
-                        'uploaded_file_error': "Circular reference is detected in uploaded xml!"
-                    })
-                else:
-                    stack.append(current)
-                    stack.append(dependent_relationship)
+        processed_tables = process_relationship_into_table(relationship, processed_tables, entities, relationships)
     return processed_tables
 
 
@@ -431,118 +1120,94 @@ def is_valid_relationship(relationship, relationships, entities):
     :return:
     """
     dependency_count = 0
-    for attribute in relationship[XML_ATTRIBUTES].values():
-        if XML_RELATION_ID in attribute:
-            if attribute[XML_RELATION_ID] not in relationships.keys():
+    for attribute in relationship.attributes.values():
+        if attribute.relation_id is not None:
+            if attribute.relation_id not in relationships:
                 return False
             dependency_count += 1
-        if XML_ENTITY_ID in attribute:
-            if attribute[XML_ENTITY_ID] not in entities.keys():
+        if attribute.entity_id is not None:
+            if attribute.entity_id not in entities:
                 return False
             dependency_count += 1
     # relationship should connect to only two foreign tables
     return dependency_count == 2
 
 
-def get_dependent_relationship(relationship, relationships):
-    """
-    For a relationship with relation_id as attribute, find the other relationship
-    :param relationship:
-    :param relationships:
-    :return:
-    """
-    for attribute in relationship[XML_ATTRIBUTES].values():
-        if XML_RELATION_ID in attribute:
-            relationship_id = attribute[XML_RELATION_ID]
-            return relationships[relationship_id]
-    return None
-
-
-def process_relationship_into_table(request, relationship, processed_tables, entities, relationships):
+def process_relationship_into_table(relationship, processed_tables, entities, relationships):
     """
     Convert relationship data into JSON object
-    :param request:
     :param relationship:
     :param processed_tables:
     :param entities:
     :param relationships:
     :return:
     """
-    table_name = relationship[XML_NAME]
+    table_name = relationship.name
     attributes = {}
     primary_key = []
     foreign_keys = []
     unique = []
-    for attribute in relationship[XML_ATTRIBUTES].values():
-        if XML_ENTITY_ID in attribute:
-            entity_table = processed_tables[entities[attribute[XML_ENTITY_ID]][XML_NAME]]
-            entity_name = entity_table[TABLE_NAME]
+    for attribute in relationship.attributes.values():
+        if attribute.entity_id is not None:
+            entity_table = processed_tables[entities[attribute.entity_id].name]
+            entity_name = entity_table.name
 
             # if relationship has [1,1] we can consider merge to entity
             # print '------------------------ ' + table_name + ' to ' + entity_name
-            if relationship["checked"] != "1" and attribute[XML_MIN] == "1" and attribute[XML_MAX] == "1":
-                return prompt_merge_option(request, entity_name, table_name)
+            if relationship.checked != "1" and attribute.min_participation == "1" and \
+                    attribute.max_participation == "1":
+                raise DecisionRequired([], [{'merge_from': table_name, 'merge_to': entity_name}])
 
             foreign_key = {
                 TABLE_ENTITY: entity_name,
                 TABLE_REFERENCES: {}
             }
             
-            for key in entity_table[TABLE_PRIMARY_KEY]:
-                new_key_name = format_foreign_key(entity_table[TABLE_NAME], key)
+            for key in entity_table.primary_key:
+                new_key_name = format_foreign_key(entity_table.name, key)
                 primary_key.append(new_key_name)
                 foreign_key[TABLE_REFERENCES][new_key_name] = key
 
-                attr_type = attribute[XML_ATTRIBUTE_TYPE] if XML_ATTRIBUTE_TYPE in attribute else "string"
                 attributes[new_key_name] = {
-                    "type": attr_type,
+                    "type": attribute.get_type(),
                     "references": {
-                        entity_table[TABLE_NAME]: key
+                        entity_table.name: key
                     }
                 }
             foreign_keys.append(foreign_key)
 
-        if XML_RELATION_ID in attribute:
-            relationship_table = processed_tables[relationships[attribute[XML_RELATION_ID]][XML_NAME]]
-            relationship_name = relationship_table[TABLE_NAME]
+        if attribute.relation_id is not None:
+            relationship_table = processed_tables[relationships[attribute.relation_id].name]
+            relationship_name = relationship_table.name
 
             # if relationship has [1,1] we can consider merge to entity
-            if relationship["checked"] != "1" and attribute[XML_MIN] == 1 and attribute[XML_MAX] == 1:
-                return prompt_merge_option(request, relationship_name, table_name)
+            if relationship.checked != "1" and attribute.min_participation == 1 and attribute.max_participation == 1:
+                raise DecisionRequired([], [{'merge_from': table_name, 'merge_to': relationship_name}])
 
             foreign_key = {
                 TABLE_ENTITY: relationship_name,
                 TABLE_REFERENCES: {}
             }
 
-            for key in relationship_table[TABLE_PRIMARY_KEY]:
-                new_key_name = format_foreign_key(relationship_table[TABLE_NAME], key)
+            for key in relationship_table.primary_key:
+                new_key_name = format_foreign_key(relationship_table.name, key)
                 primary_key.append(new_key_name)
                 foreign_key[TABLE_REFERENCES][new_key_name] = key
 
-                attr_type = attribute[XML_ATTRIBUTE_TYPE] if XML_ATTRIBUTE_TYPE in attribute else "string"
                 attributes[new_key_name] = {
-                    "type": attr_type,
+                    "type": attribute.get_type(),
                     "references": {
-                        relationship_table[TABLE_NAME]: key
+                        relationship_table.name: key
                     }
                 }
             foreign_keys.append(foreign_key)
 
-        if XML_NAME in attribute:
-            attr_type = attribute[XML_ATTRIBUTE_TYPE] if XML_ATTRIBUTE_TYPE in attribute else "string"
-            attributes[attribute[XML_NAME]] = {
-                "type": attr_type
+        if attribute.name is not None:
+            attributes[attribute.name] = {
+                "type": attribute.get_type()
             }
 
-    processed_table = {
-        TABLE_NAME: table_name,
-        TABLE_ATTRIBUTES: attributes,
-        TABLE_PRIMARY_KEY: primary_key,
-        # TABLE_FOREIGN_KEYS: foreign_keys,
-        TABLE_UNIQUE: unique
-    }
-    processed_tables[table_name] = processed_table
+    processed_tables[table_name] = Table(table_name, attributes, primary_key, unique)
     return processed_tables
 
 
@@ -550,7 +1215,17 @@ def process_relationship_into_table(request, relationship, processed_tables, ent
 #  CONVERSION -> UTILS
 # ----------------------
 def is_processed(entity, processed_tables):
-    return entity[XML_NAME] in processed_tables.keys()
+    return entity.name in processed_tables
+
+
+def get_circular_reference_message(cycles):
+    """
+    Describe every circular reference found in the diagram, e.g. [A -> B -> A], [C -> C]
+    """
+    descriptions = []
+    for cycle in cycles:
+        descriptions.append('[' + ' -> '.join(cycle + [cycle[0]]) + ']')
+    return 'Circular reference is detected in uploaded xml: ' + ', '.join(descriptions) + '!'
 
 
 def get_name_attributes(entity):
@@ -560,22 +1235,21 @@ def get_name_attributes(entity):
     :return:
     """
     entity_attribute_names = {}
-    for attribute in entity[TABLE_ATTRIBUTES].values():
-        if XML_NAME in attribute:
-            attr_type = attribute[XML_ATTRIBUTE_TYPE] if XML_ATTRIBUTE_TYPE in attribute else "string"
-            entity_attribute_names[attribute[XML_NAME]] = {"type": attr_type}
+    for attribute in entity.attributes.values():
+        if attribute.name is not None:
+            entity_attribute_names[attribute.name] = {"type": attribute.get_type()}
     return entity_attribute_names
 
 
 def get_foreign_attributes(foreign_table):
     foreign_key = {
-        TABLE_ENTITY: foreign_table[TABLE_NAME],
+        TABLE_ENTITY: foreign_table.name,
         TABLE_REFERENCES: {}
     }
 
-    attributes_map = foreign_table[XML_ATTRIBUTES]
-    for key in foreign_table[TABLE_PRIMARY_KEY]:
-        new_key_name = format_foreign_key(foreign_table[TABLE_NAME], key)
+    attributes_map = foreign_table.attributes
+    for key in foreign_table.primary_key:
+        new_key_name = format_foreign_key(foreign_table.name, key)
         attribute = attributes_map[key]
         attr_type = attribute[XML_ATTRIBUTE_TYPE]
         if not attr_type:
@@ -583,7 +1257,7 @@ def get_foreign_attributes(foreign_table):
         foreign_key[TABLE_REFERENCES][new_key_name] = {
             "type": attr_type,
             "references": {
-                foreign_table[TABLE_NAME]: key
+                foreign_table.name: key
             }
         }
 
@@ -596,7 +1270,7 @@ def get_unique_attributes(primary_key, foreign_keys):
     """
     unique = []
     for foreign_key in foreign_keys:
-        print foreign_key
+        logger.debug('foreign key %s', foreign_key)
         for attr in foreign_key[TABLE_REFERENCES]:
             if attr not in primary_key:
                 unique.append(attr)
@@ -607,66 +1281,43 @@ def get_unique_key_options(entity, dominant_entity_table=None):
     """
     We use this function for both weak and strong entities. If weak entity, we MUST provide a dominant_entity_table
     """
-    print 'get unique key options for ' + entity[XML_NAME]
-    attributes = entity[XML_ATTRIBUTES]
-    options = []
-    for key in entity[XML_UNIQUE_KEYS]:
-        option = []
-        # print 'key ' + key
-        ids = key.split(",")  # [1] or [2, 3]
-        for id in ids:
-            if "name" in attributes[id]:
-                option.append(attributes[id]["name"])
-            else:  # if there's no "name" inside the attribute, it MUST have a relation_id
-                # assert (dominant_entity_table is not None)
-                assert (XML_RELATION_ID in attributes[id])
-                dominant_entity_table_name = dominant_entity_table[TABLE_NAME]
-                for key in dominant_entity_table[TABLE_PRIMARY_KEY]:
-                    option.append(format_foreign_key(dominant_entity_table_name, key))
-        options.append(option)
-    return options
+    logger.debug('get unique key options for %s', entity.name)
+    return get_key_options(entity.unique_keys, dominant_entity_table)
 
 
 def get_primary_key_options(entity, dominant_entity_table=None):
     """
     We use this function for both weak and strong entities. If weak entity, we MUST provide a dominant_entity_table
     """
-    # print 'get primary key options for ' + entity[XML_NAME]
-    attributes = entity[XML_ATTRIBUTES]
+    # print 'get primary key options for ' + entity.name
+    return get_key_options(entity.keys, dominant_entity_table)
+
+
+def get_key_options(keys, dominant_entity_table=None):
+    """
+    Column names of each key, the relation attribute of a weak entity stands for the dominant entity's primary key
+    """
     options = []
-    for key in entity[XML_KEYS]:
+    for key in keys:  # [1] or [2, 3]
         option = []
-        # print 'key ' + key
-        ids = key.split(",")  # [1] or [2, 3]
-        for id in ids:
-            if "name" in attributes[id]:
-                option.append(attributes[id]["name"])
+        for attribute in key:
+            if attribute.name is not None:
+                option.append(attribute.name)
             else:  # if there's no "name" inside the attribute, it MUST have a relation_id
                 # assert (dominant_entity_table is not None)
-                assert (XML_RELATION_ID in attributes[id])
-                dominant_entity_table_name = dominant_entity_table[TABLE_NAME]
-                for key in dominant_entity_table[TABLE_PRIMARY_KEY]:
-                    option.append(format_foreign_key(dominant_entity_table_name, key))
+                assert (attribute.relation_id is not None)
+                dominant_entity_table_name = dominant_entity_table.name
+                for key_name in dominant_entity_table.primary_key:
+                    option.append(format_foreign_key(dominant_entity_table_name, key_name))
         options.append(option)
     return options
 
 
-def get_primary_key_index(request, primary_key_options, table_name):
+def get_primary_key_index(primary_key_options, table_name):
     primary_key_index = 0
     num_options = len(primary_key_options)
     if num_options > 1:
-        xml_content = request.session.get('xmlContent')
-        options = []
-        current_index = 0  # For convenience sake, we just use zero-based indexing here for the options
-        for primary_key in primary_key_options:
-            options.append(get_primary_key_as_string(primary_key))
-            current_index += 1
-
-        return render(request, 'choose_key.html', {
-            'table_name': table_name,
-            'uploaded_file_content': xml_content,
-            'primaryKeyOptions': options
-        })
+        raise DecisionRequired([{'table_name': table_name, 'options': primary_key_options}], [])
 
     return primary_key_index
 
@@ -685,18 +1336,16 @@ def format_foreign_key(foreign_table_name, key):
 
 
 def get_primary_key_display_options(entity, relationships):
-    attributes = entity[XML_ATTRIBUTES]
     options = []
-    for key in entity[XML_KEYS]:
+    for key in entity.keys:  # [1] or [2, 3]
         option = []
-        ids = key.split(",")  # [1] or [2, 3]
-        for key_id in ids:
-            if "name" in attributes[key_id]:
-                option.append(attributes[key_id][XML_NAME])
+        for attribute in key:
+            if attribute.name is not None:
+                option.append(attribute.name)
             else:  # if there's no "name" inside the attribute, it MUST have a relation_id
-                assert (XML_RELATION_ID in attributes[key_id])
-                relationship = relationships[attributes[key_id][XML_RELATION_ID]]
-                option.append(relationship[XML_NAME])
+                assert (attribute.relation_id is not None)
+                relationship = relationships[attribute.relation_id]
+                option.append(relationship.name)
         options.append(option)
     return options
 
@@ -715,73 +1364,170 @@ def prompt_user_for_input(prompt):
     return user_input
 
 
-def prompt_choose_key_option(request, table_name, xml_content, options):
-    print "prompt_choose_key_option for table " + table_name
+def render_result(request, output_json, output_key):
+    workspace = get_session_workspace(request)
+    if workspace is not None and (workspace.output_key != output_key or workspace.base_key is not None):
+        workspace.output_key = output_key  # the schema itself stays in the conversion cache
+        if workspace.base_key is not None:
+            # first result of a new version, its tables are compared with the previous version's once
+            workspace.delta['tables'] = get_table_delta(get_cached_schema(workspace.base_key), output_json)
+            workspace.base_key = None
+            workspace.stale_names = []
+        save_workspace(workspace)
+    with timed('render'):
+        return render(request, 'display_result.html', {
+            'output_json': output_json,
+            'output_key': output_key,
+            'delta': workspace.delta if workspace is not None else None
+        })
 
-    return render(request, 'choose_key.html', {
-        'table_name': table_name,
-        'uploaded_file_content': xml_content,
-        'primaryKeyOptions': options
-    })
 
+def get_cached_schema(output_key):
+    """
+    :return: JSON Schema string of an earlier conversion, None when it is no longer cached
+    """
+    output_json = get_conversion_cache().get(output_key) or get_job_result(output_key)
+    if output_json is None:
+        processed_tables = get_table_cache().get(output_key)
+        if processed_tables is not None:
+            output_json = dumps_schema(processed_tables)
+    return output_json
+
+
+def start_conversion_job(request, tree, diagram):
+    job_id = submit_conversion_job(tree, diagram)
+    job_ids = [other_job_id for other_job_id in request.session.get(SESSION_JOB_IDS, []) if other_job_id != job_id]
+    request.session[SESSION_JOB_IDS] = (job_ids + [job_id])[-MAX_SESSION_JOBS:]
+    with timed('render'):
+        return render(request, 'conversion_job.html', {
+            'job_id': job_id
+        })
 
-def prompt_merge_option(request, merge_to, merge_from):
-    print "prompt_merge_option from " + merge_from + " to " + merge_to
 
-    xml_content = request.session.get('xmlContent')
-    return render(request, 'choose_merge.html', {
-        'uploaded_file_content': xml_content,
-        'merge_from': merge_from,
-        'merge_to': merge_to
-    })
+def prompt_decisions(request, key_choices, merge_choices, error=None):
+    logger.debug('prompt_decisions for %d keys and %d merges', len(key_choices), len(merge_choices))
 
+    with timed('render'):
+        return render(request, 'choose_decisions.html', {
+            'workspace_id': get_session_workspace(request).id,
+            'key_choices': key_choices,
+            'merge_choices': merge_choices,
+            'uploaded_file_error': error
+        })
 
-def update_primary_key_in_xml(tree, table_name, primary_key_option):
-    for node in tree:
-        if node.attrib[XML_NAME] != table_name:
-            continue
-        key_nodes = node.findall("key")
 
-        for i, key_node in enumerate(key_nodes):
-            if i != int(primary_key_option):
-                key_node.tag = XML_UNIQUE_KEY
+class TreeIndex(object):
+    """
+    Lookup of the object nodes of a tree by name, built in one pass so that each decision is applied
+    without scanning the tree again. The highest attribute id and the referenced relation ids of a node
+    are collected the first time a relationship is merged into it, then kept up to date.
+    """
+
+    def __init__(self, tree):
+        self.nodes = {}  # object name -> XML node
+        self.max_attribute_ids = {}  # object name -> highest numeric attribute id, as int
+        self.relation_ids = {}  # object name -> relation ids referenced by its attributes
+        for node in tree:
+            self.nodes[node.attrib[XML_NAME]] = node
+
+    def get_node(self, name):
+        node = self.nodes.get(name)
+        if node is None:
+            raise DiagramError('Unknown table [' + name + ']')
+        return node
+
+    def index_attributes(self, name):
+        if name in self.max_attribute_ids:
+            return
+        max_attribute_id = 0
+        relation_ids = set()
+        for attribute in self.get_node(name).iterchildren(XML_ATTRIBUTE):
+            # any id is allowed, a number above the numeric ones is free
+            if attribute.attrib[XML_ID].isdigit():
+                max_attribute_id = max(max_attribute_id, int(attribute.attrib[XML_ID]))
+            if XML_RELATION_ID in attribute.attrib:
+                relation_ids.add(attribute.attrib[XML_RELATION_ID])
+        self.max_attribute_ids[name] = max_attribute_id
+        self.relation_ids[name] = relation_ids
+
+    def add_relation_attribute(self, name, relation_id):
+        """
+        Add an attribute referencing a relationship to a node, unless it has one already
+        :return: whether an attribute was added
+        """
+        self.index_attributes(name)
+        if relation_id in self.relation_ids[name]:
+            return False
+        self.max_attribute_ids[name] += 1
+        relation_attribute = etree.SubElement(self.get_node(name), XML_ATTRIBUTE)
+        relation_attribute.set(XML_ID, str(self.max_attribute_ids[name]))
+        relation_attribute.set(XML_RELATION_ID, relation_id)
+        self.relation_ids[name].add(relation_id)
+        return True
+
+
+def update_primary_key_in_xml(tree, table_name, primary_key_option, index=None):
+    """
+    Keep the chosen key, the other candidate keys become unique keys
+    :param index: TreeIndex of the tree, built here when not given
+    """
+    index = index or TreeIndex(tree)
+    key_nodes = index.get_node(table_name).findall(XML_KEY)
+    for i, key_node in enumerate(key_nodes):
+        if i != int(primary_key_option):
+            key_node.tag = XML_UNIQUE_KEY
     return tree
 
 
-def merge_relationship_in_xml(tree, merge_table, merge_from, merge_to):
+def merge_relationship_in_xml(tree, merge_table, merge_from, merge_to, index=None):
     """
     # add relation attribute into merge_to table, mark as "to_be_merged"
     # delete relationship entry
+    :param index: TreeIndex of the tree, built here when not given
     """
+    index = index or TreeIndex(tree)
+    relation_node = index.get_node(merge_from)
+    relation_node.set("checked", "1")
     if merge_table == "0":
-        for node in tree:
-            if node.attrib[XML_NAME] == merge_from:
-                node.set("checked", "1")
-                node.set("merged", "0")
+        relation_node.set("merged", "0")
         return tree
 
-    base_node = None
-    relation_node = None
-    print 'merge_relationship from ' + merge_from + ' to ' + merge_to
-    for node in tree:
-        if node.attrib[XML_NAME] == merge_from:
-            relation_node = node
-            relation_node.set("checked", "1")
-            relation_node.set("merged", "1")
-        if node.attrib[XML_NAME] == merge_to:
-            base_node = node
-
-    next_id = 0
-    relation_id = relation_node.attrib[XML_ID]
-    for attribute in base_node.findall(XML_ATTRIBUTE):
-        if XML_RELATION_ID in attribute.attrib and relation_id == attribute.attrib[XML_RELATION_ID]:
-            print 'skip adding relation_id'
-            return tree  # relation_id already defined
-        if attribute.attrib[XML_ID] > next_id:
-            next_id = attribute.attrib[XML_ID]
-
-    relation_attribute = ET.SubElement(base_node, XML_ATTRIBUTE)
-    relation_attribute.set(XML_ID, str(int(next_id) + 1))
-    relation_attribute.set(XML_RELATION_ID, relation_id)
+    logger.debug('merge_relationship from %s to %s', merge_from, merge_to)
+    relation_node.set("merged", "1")
+    if not index.add_relation_attribute(merge_to, relation_node.attrib[XML_ID]):
+        logger.debug('skip adding relation_id')  # relation_id already defined
+    return tree
+
+
+@timed('decide')
+def apply_decisions_in_xml(tree, key_decisions, merge_decisions):
+    """
+    Apply all answers of the decisions form to the tree at once, the tree is only scanned to build its index
+    :param tree: XML parsed as ElementTree
+    :param key_decisions: dict of table name -> chosen primary key option
+    :param merge_decisions: list of (merge_table, merge_from, merge_to)
+    :return: updated tree
+    """
+    index = TreeIndex(tree)
+    for table_name, primary_key_option in key_decisions.items():
+        tree = update_primary_key_in_xml(tree, table_name, primary_key_option, index)
+    for merge_table, merge_from, merge_to in merge_decisions:
+        tree = merge_relationship_in_xml(tree, merge_table, merge_from, merge_to, index)
+    return tree
 
+
+@timed('decide')
+def apply_decision_log(tree, decision_log):
+    """
+    Replay logged decisions on a freshly parsed tree
+    :param tree: XML parsed as ElementTree
+    :param decision_log: list of operations, see workspace.py
+    :return: updated tree
+    """
+    index = TreeIndex(tree)
+    for operation in decision_log:
+        if operation[0] == OP_PRIMARY_KEY:
+            tree = update_primary_key_in_xml(tree, operation[1], operation[2], index)
+        elif operation[0] == OP_MERGE:
+            tree = merge_relationship_in_xml(tree, operation[1], operation[2], operation[3], index)
     return tree
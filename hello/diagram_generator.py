@@ -0,0 +1,108 @@
+import itertools
+
+import lxml.etree as etree
+
+from converter import XML_OBJ_ENTITY, XML_OBJ_RELATIONSHIP, XML_ATTRIBUTE, XML_KEY, XML_ID, XML_NAME
+from converter import XML_ATTRIBUTE_TYPE, XML_ENTITY_ID, XML_RELATION_ID, XML_MIN, XML_MAX
+
+"""
+diagram_generator.py
+synthetic ER diagrams of configurable shape, used to measure how the converter scales
+"""
+
+
+def generate_diagram(entities=100, attributes_per_entity=4, candidate_keys=1, weak_chains=0, weak_chain_depth=0,
+                     relationship_fan_out=1, relationship_nesting=0, merge_candidates=0):
+    """
+    Build an ER diagram as XML
+    :param entities: number of strong entities
+    :param attributes_per_entity: attributes of every entity, at least candidate_keys
+    :param candidate_keys: <key> elements per strong entity, more than one means a primary key decision
+    :param weak_chains: number of weak entity chains
+    :param weak_chain_depth: weak entities per chain, each one depending on the previous one
+    :param relationship_fan_out: relationships from every strong entity to the following entities
+    :param relationship_nesting: length of a chain of relationships each referencing the previous relationship
+    :param merge_candidates: relationships with a [1,1] participation, i.e. merge decisions
+    :return: XML root element
+    """
+    assert attributes_per_entity >= candidate_keys >= 1
+    root = etree.Element('data')
+    relationship_ids = itertools.count(1)
+    entity_ids = itertools.count(1)
+
+    strong_entity_ids = []
+    for i in range(entities):
+        entity_id = str(next(entity_ids))
+        entity = add_object(root, XML_OBJ_ENTITY, entity_id, 'Entity' + entity_id)
+        for attribute_index in range(1, attributes_per_entity + 1):
+            add_attribute(entity, attribute_index, name='attr' + str(attribute_index),
+                          type='number' if attribute_index % 2 == 0 else 'string')
+        for key_index in range(1, candidate_keys + 1):
+            add_key(entity, str(key_index))
+        strong_entity_ids.append(entity_id)
+
+    # weak entity chains: each weak entity is identified through a relationship with its owner
+    for chain in range(weak_chains if entities > 0 else 0):
+        owner_id = strong_entity_ids[chain % entities]
+        for depth in range(weak_chain_depth):
+            entity_id = str(next(entity_ids))
+            relationship_id = str(next(relationship_ids))
+            entity = add_object(root, XML_OBJ_ENTITY, entity_id, 'Weak' + entity_id)
+            add_attribute(entity, 1, name='partial', type='string')
+            add_attribute(entity, 2, relation_id=relationship_id)
+            add_key(entity, '1,2')
+            relationship = add_object(root, XML_OBJ_RELATIONSHIP, relationship_id, 'Owns' + relationship_id)
+            add_attribute(relationship, 1, entity_id=entity_id, min_participation='0', max_participation='N')
+            add_attribute(relationship, 2, entity_id=owner_id, min_participation='0', max_participation='N')
+            add_key(relationship, '1,2')
+            owner_id = entity_id
+
+    # relationships between strong entities, fanning out to the following entities
+    for i in range(entities if entities > 1 else 0):
+        for offset in range(1, relationship_fan_out + 1):
+            relationship_id = str(next(relationship_ids))
+            is_merge_candidate = merge_candidates > 0
+            merge_candidates -= 1
+            relationship = add_object(root, XML_OBJ_RELATIONSHIP, relationship_id, 'Rel' + relationship_id)
+            add_attribute(relationship, 1, name='since', type='string')
+            add_attribute(relationship, 2, entity_id=strong_entity_ids[i], min_participation='0',
+                          max_participation='N')
+            add_attribute(relationship, 3, entity_id=strong_entity_ids[(i + offset) % entities],
+                          min_participation='1' if is_merge_candidate else '0',
+                          max_participation='1' if is_merge_candidate else 'N')
+            add_key(relationship, '2,3')
+
+    # relationships on relationships
+    previous_id = None
+    for depth in range(relationship_nesting if entities > 1 else 0):
+        relationship_id = str(next(relationship_ids))
+        relationship = add_object(root, XML_OBJ_RELATIONSHIP, relationship_id, 'Nested' + relationship_id)
+        add_attribute(relationship, 1, entity_id=strong_entity_ids[depth % entities], min_participation='0',
+                      max_participation='N')
+        if previous_id is None:
+            add_attribute(relationship, 2, entity_id=strong_entity_ids[(depth + 1) % entities],
+                          min_participation='0', max_participation='N')
+        else:
+            add_attribute(relationship, 2, relation_id=previous_id, min_participation='0', max_participation='N')
+        add_key(relationship, '1,2')
+        previous_id = relationship_id
+
+    return root
+
+
+def add_object(root, tag, object_id, name):
+    return etree.SubElement(root, tag, {XML_ID: object_id, XML_NAME: name})
+
+
+def add_attribute(node, attribute_id, **attributes):
+    attribute = etree.SubElement(node, XML_ATTRIBUTE, {XML_ID: str(attribute_id)})
+    for attribute_name in [XML_NAME, XML_ATTRIBUTE_TYPE, XML_ENTITY_ID, XML_RELATION_ID, XML_MIN, XML_MAX]:
+        if attribute_name in attributes:
+            attribute.set(attribute_name, attributes[attribute_name])
+    return attribute
+
+
+def add_key(node, attribute_ids):
+    key = etree.SubElement(node, XML_KEY)
+    key.text = attribute_ids
+    return key
@@ -0,0 +1,113 @@
+"""
+graph.py
+dependency graph helpers used to order table conversion and detect circular references
+"""
+
+
+def strongly_connected_components(nodes, edges):
+    """
+    Tarjan's algorithm, written iteratively so that long dependency chains do not hit the recursion limit.
+    A component is only emitted after every component it has an edge to, so when edges point from an
+    object to the objects it references, the result is already in dependency-first order.
+    :param nodes: list of nodes, visited in the given order
+    :param edges: dict of node -> list of nodes it depends on
+    :return: list of components, each component being a list of nodes
+    """
+    index = {}
+    low_link = {}
+    on_stack = set()
+    stack = []
+    components = []
+
+    for root in nodes:
+        if root in index:
+            continue
+        index[root] = low_link[root] = len(index)
+        stack.append(root)
+        on_stack.add(root)
+        work = [(root, iter(edges.get(root, ())))]
+
+        while len(work) > 0:
+            node, successors = work[-1]
+            descended = False
+            for successor in successors:
+                if successor not in index:
+                    index[successor] = low_link[successor] = len(index)
+                    stack.append(successor)
+                    on_stack.add(successor)
+                    work.append((successor, iter(edges.get(successor, ()))))
+                    descended = True
+                    break
+                elif successor in on_stack:
+                    low_link[node] = min(low_link[node], index[successor])
+            if descended:
+                continue
+
+            work.pop()
+            if len(work) > 0:
+                parent = work[-1][0]
+                low_link[parent] = min(low_link[parent], low_link[node])
+
+            if low_link[node] == index[node]:
+                component = []
+                while True:
+                    member = stack.pop()
+                    on_stack.discard(member)
+                    component.append(member)
+                    if member == node:
+                        break
+                components.append(component)
+
+    return components
+
+
+def resolve_order(nodes, edges):
+    """
+    Compute a dependency-first ordering and every circular reference in one pass
+    :param nodes: list of nodes
+    :param edges: dict of node -> list of nodes it depends on
+    :return: (order, cycles) where cycles is a list of node lists, empty when the graph is acyclic
+    """
+    order = []
+    cycles = []
+    for component in strongly_connected_components(nodes, edges):
+        if len(component) > 1 or component[0] in edges.get(component[0], ()):
+            component.reverse()
+            cycles.append(component)
+        else:
+            order.append(component[0])
+    return order, cycles
+
+
+def connected_components(nodes, edges):
+    """
+    Groups of nodes linked by edges in either direction, found with union-find
+    :param nodes: list of nodes
+    :param edges: dict of node -> list of nodes it is linked to
+    :return: list of components, each a list of nodes in the given order; components are ordered by their first node
+    """
+    parents = dict((node, node) for node in nodes)
+
+    def find(node):
+        root = node
+        while parents[root] != root:
+            root = parents[root]
+        # path compression, so later lookups are almost constant time
+        while parents[node] != root:
+            parents[node], node = root, parents[node]
+        return root
+
+    for node in nodes:
+        for linked_node in edges.get(node, ()):
+            if linked_node in parents:
+                parents[find(linked_node)] = find(node)
+
+    components = []
+    component_of_root = {}
+    for node in nodes:
+        root = find(node)
+        if root not in component_of_root:
+            component_of_root[root] = []
+            components.append(component_of_root[root])
+        component_of_root[root].append(node)
+    return components
@@ -0,0 +1,138 @@
+import bisect
+import functools
+import threading
+import time
+from collections import OrderedDict
+
+"""
+instrumentation.py
+timing of the conversion stages: per request as a Server-Timing header, per process as histograms
+exposed in Prometheus text format by the metrics view
+"""
+
+# upper bounds of the histogram buckets in seconds
+BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+STAGE_TOTAL = 'total'
+
+
+class Histogram(object):
+    """
+    Cumulative distribution of durations, thread-safe
+    """
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)  # the last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, seconds):
+        with self.lock:
+            self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+            self.count += 1
+            self.sum += seconds
+
+    def snapshot(self):
+        with self.lock:
+            return list(self.counts), self.count, self.sum
+
+
+_histograms = {}
+_histograms_lock = threading.Lock()
+_local = threading.local()
+
+
+def get_histogram(stage):
+    histogram = _histograms.get(stage)
+    if histogram is None:
+        with _histograms_lock:
+            histogram = _histograms.setdefault(stage, Histogram())
+    return histogram
+
+
+def record(stage, seconds):
+    """
+    Add a duration to the histogram of the stage and to the timings of the current request, if any
+    """
+    get_histogram(stage).observe(seconds)
+    timings = getattr(_local, 'timings', None)
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + seconds
+
+
+class timed(object):
+    """
+    Time a stage, either as a context manager:
+        with timed('parse'):
+            ...
+    or as a function decorator:
+        @timed('compile')
+        def compile_diagram(tree):
+    """
+
+    def __init__(self, stage):
+        self.stage = stage
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        record(self.stage, time.time() - self.start)
+        return False
+
+    def __call__(self, function):
+        stage = self.stage
+
+        @functools.wraps(function)
+        def timed_function(*args, **kwargs):
+            start = time.time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                record(stage, time.time() - start)
+        return timed_function
+
+
+class ServerTimingMiddleware(object):
+    """
+    Collect the stage timings of each request and report them in the Server-Timing header,
+    e.g. Server-Timing: compile;dur=12.5, validate;dur=0.8, render;dur=3.1, total;dur=20.4
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        _local.timings = OrderedDict()
+        start = time.time()
+        try:
+            response = self.get_response(request)
+            record(STAGE_TOTAL, time.time() - start)
+            response['Server-Timing'] = format_server_timing(_local.timings)
+            return response
+        finally:
+            _local.timings = None
+
+
+def format_server_timing(timings):
+    return ', '.join('%s;dur=%.1f' % (stage, seconds * 1000) for stage, seconds in timings.items())
+
+
+def format_metrics():
+    """
+    Histograms of this worker process in Prometheus text format
+    """
+    lines = ['# HELP er_stage_seconds Time spent in each conversion stage',
+             '# TYPE er_stage_seconds histogram']
+    for stage in sorted(_histograms.keys()):
+        counts, count, total = _histograms[stage].snapshot()
+        cumulative = 0
+        for bound, bucket_count in zip(BUCKETS + ['+Inf'], counts):
+            cumulative += bucket_count
+            lines.append('er_stage_seconds_bucket{stage="%s",le="%s"} %d' % (stage, bound, cumulative))
+        lines.append('er_stage_seconds_sum{stage="%s"} %f' % (stage, total))
+        lines.append('er_stage_seconds_count{stage="%s"} %d' % (stage, count))
+    return '\n'.join(lines) + '\n'
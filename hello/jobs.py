@@ -0,0 +1,228 @@
+import json
+import logging
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+
+"""
+jobs.py
+background jobs, e.g. the conversion of large diagrams, in a pool of worker processes, so the request
+threads of mod_wsgi stay free. Job state and results are files in JOB_DIR, visible to every daemon
+process of the host. Requests also hand their conversion work to the pool and wait for it, see run_in_worker.
+"""
+
+logger = logging.getLogger(__name__)
+
+STATUS_QUEUED = 'queued'
+STATUS_RUNNING = 'running'
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+
+DEFAULT_WORKERS = 2
+DEFAULT_TIMEOUT = 10 * 60
+DEFAULT_TTL = 24 * 60 * 60
+GC_INTERVAL = 10 * 60
+# worker processes are replaced after this many jobs, so memory held by large diagrams is given back
+TASKS_PER_WORKER = 20
+
+_pool = None
+_pool_lock = threading.Lock()
+_last_collected = time.time()
+
+
+class JobError(Exception):
+    """
+    Raised by a job function, the message is shown to the user
+    """
+
+
+def get_worker_pool():
+    """
+    Worker processes of this web process, started on first use
+    """
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = multiprocessing.Pool(get_worker_count(), maxtasksperchild=TASKS_PER_WORKER)
+    return _pool
+
+
+def get_worker_count():
+    return getattr(settings, 'JOB_WORKERS', DEFAULT_WORKERS)
+
+
+def submit_job(job_id, function, args):
+    """
+    Queue a job unless it is already queued, running or done
+    :param job_id: identifies the result, e.g. the cache key of the tree
+    :param function: module level function returning the result as string, called in a worker process
+    :param args: arguments of the function, they are pickled
+    :return: job id
+    """
+    job_dir = get_job_dir()
+    state = get_job_state(job_id)
+    if state is not None and state['status'] != STATUS_FAILED:
+        return job_id
+
+    write_state(job_dir, job_id, {'status': STATUS_QUEUED, 'submitted': time.time()})
+    get_worker_pool().apply_async(run_job, (job_dir, job_id, function, args))
+    maybe_collect_garbage(job_dir)
+    return job_id
+
+
+def submit_split_job(job_id, function, parts, merge, merge_args=()):
+    """
+    Queue a job made of independent parts, which the worker processes work on at the same time.
+    A thread of this process waits for them and merges their results, see run_split_job.
+    :param job_id: see submit_job
+    :param function: module level function called with each part in a worker process
+    :param parts: arguments of the function, one per call, they are pickled
+    :param merge: function called with the list of results in the order of the parts, returns the job's result
+    :param merge_args: further arguments of merge
+    :return: job id
+    """
+    job_dir = get_job_dir()
+    state = get_job_state(job_id)
+    if state is not None and state['status'] != STATUS_FAILED:
+        return job_id
+
+    write_state(job_dir, job_id, {'status': STATUS_QUEUED, 'submitted': time.time()})
+    # one part per task, so the workers take the next part as soon as they are done with one
+    async_result = get_worker_pool().map_async(function, parts, chunksize=1)
+    merge_thread = threading.Thread(target=run_split_job, args=(job_dir, job_id, async_result, merge, merge_args))
+    merge_thread.daemon = True
+    merge_thread.start()
+    maybe_collect_garbage(job_dir)
+    return job_id
+
+
+def run_in_worker(function, args):
+    """
+    Call a function in a worker process and wait for its result, for the CPU heavy part of a request.
+    The calling thread does not hold the GIL while it waits, so the other threads of this process
+    keep serving requests in the meantime.
+    :param function: module level function, exceptions it raises are raised here and have to be picklable
+    :param args: arguments of the function, they are pickled
+    :return: result of the function, it is pickled
+    """
+    return get_worker_pool().apply_async(function, args).get(getattr(settings, 'JOB_TIMEOUT', DEFAULT_TIMEOUT))
+
+
+def get_job_state(job_id):
+    """
+    :return: dict with status, submitted, started, finished and error, or None for an unknown job
+    """
+    try:
+        with open(get_path(get_job_dir(), job_id, '.state'), 'rb') as state_file:
+            state = json.loads(state_file.read())
+    except (IOError, ValueError):
+        return None
+    # a worker that crashed never reports back
+    if state['status'] in [STATUS_QUEUED, STATUS_RUNNING] and \
+            time.time() - state['submitted'] > getattr(settings, 'JOB_TIMEOUT', DEFAULT_TIMEOUT):
+        state['status'] = STATUS_FAILED
+        state['error'] = 'The job did not finish in time.'
+    return state
+
+
+def get_job_result(job_id):
+    """
+    :return: result string of a finished job, or None
+    """
+    try:
+        with open(get_path(get_job_dir(), job_id, '.json'), 'rb') as result_file:
+            return result_file.read()
+    except IOError:
+        return None
+
+
+def run_job(job_dir, job_id, function, args):
+    """
+    Run a job in a worker process and record its result
+    """
+    record_job(job_dir, job_id, lambda: function(*args))
+
+
+def run_split_job(job_dir, job_id, async_result, merge, merge_args):
+    """
+    Wait for the parts of a job, merge their results and record it, runs in a thread of the submitting process
+    """
+    # a worker that crashed never delivers its part, give up once the job has timed out anyway
+    timeout = getattr(settings, 'JOB_TIMEOUT', DEFAULT_TIMEOUT)
+    record_job(job_dir, job_id, lambda: merge(async_result.get(timeout), *merge_args))
+
+
+def record_job(job_dir, job_id, get_result):
+    """
+    Mark a job as running, then as done with the string returned by get_result or as failed
+    """
+    state = {'status': STATUS_RUNNING, 'submitted': time.time(), 'started': time.time()}
+    try:
+        with open(get_path(job_dir, job_id, '.state'), 'rb') as state_file:
+            state['submitted'] = json.loads(state_file.read())['submitted']
+    except (IOError, ValueError, KeyError):
+        pass
+    write_state(job_dir, job_id, state)
+
+    try:
+        write_file(job_dir, get_path(job_dir, job_id, '.json'), get_result())
+        state['status'] = STATUS_DONE
+    except JobError as e:
+        state['status'] = STATUS_FAILED
+        state['error'] = str(e)
+    except Exception:
+        logger.exception('job %s failed', job_id)
+        state['status'] = STATUS_FAILED
+        state['error'] = 'Unexpected error occurred!'
+    state['finished'] = time.time()
+    write_state(job_dir, job_id, state)
+
+
+def get_job_dir():
+    job_dir = settings.JOB_DIR
+    if not os.path.isdir(job_dir):
+        try:
+            os.makedirs(job_dir)
+        except OSError:
+            pass  # created by another process in the meantime
+    return job_dir
+
+
+def get_path(job_dir, job_id, extension):
+    return os.path.join(job_dir, job_id + extension)
+
+
+def write_state(job_dir, job_id, state):
+    write_file(job_dir, get_path(job_dir, job_id, '.state'), json.dumps(state))
+
+
+def write_file(job_dir, path, content):
+    # write to a temporary file first, so other processes never read a partial file
+    fd, temp_path = tempfile.mkstemp(dir=job_dir)
+    with os.fdopen(fd, 'wb') as temp_file:
+        temp_file.write(content)
+    os.rename(temp_path, path)
+
+
+def maybe_collect_garbage(job_dir):
+    """
+    Remove jobs submitted more than JOB_TTL seconds ago, at most once every GC_INTERVAL
+    """
+    global _last_collected
+    now = time.time()
+    if now - _last_collected < GC_INTERVAL:
+        return
+    _last_collected = now
+    expired_before = now - getattr(settings, 'JOB_TTL', DEFAULT_TTL)
+    for file_name in os.listdir(job_dir):
+        path = os.path.join(job_dir, file_name)
+        try:
+            if os.path.getmtime(path) < expired_before:
+                os.remove(path)
+        except OSError:
+            pass  # removed by another process in the meantime
@@ -0,0 +1,48 @@
+import json
+
+"""
+json_writer.py
+serializes converted tables one at a time, so a schema can be sent without ever being held as one string
+"""
+
+INDENT = 4
+
+
+def iter_schema_json(processed_tables, compact=False):
+    """
+    JSON of the tables in chunks of one table each. The indented output is the same as json.dumps
+    with indent=4 of all tables' JSON Schema at once, the compact one has no whitespace at all.
+    :param processed_tables: dict of table name -> Table, as returned by convert_diagram
+    :param compact: leave out indentation and spaces
+    :return: generator of strings
+    """
+    return join_schema_json(((table_name, dumps_table(table.to_json(), compact))
+                             for table_name, table in processed_tables.items()), compact)
+
+
+def join_schema_json(serialized_tables, compact=False):
+    """
+    Join tables serialized one by one with dumps_table into the JSON of the whole schema
+    :param serialized_tables: iterable of (table name, JSON of the table)
+    :param compact: whether the tables were serialized compact
+    :return: generator of strings
+    """
+    if compact:
+        item_separator, key_separator, newline_indent, end = ',', ':', '', '}'
+    else:
+        item_separator, key_separator, newline_indent, end = ', ', ': ', '\n' + ' ' * INDENT, '\n}'
+
+    separator = '{' + newline_indent
+    empty = True
+    for table_name, table_json in serialized_tables:
+        yield separator + json.dumps(table_name) + key_separator + table_json
+        separator = item_separator + newline_indent
+        empty = False
+    yield '{}' if empty else end
+
+
+def dumps_table(table, compact):
+    if compact:
+        return json.dumps(table, separators=(',', ':'))
+    # nested one level deeper than a table serialized on its own
+    return json.dumps(table, indent=INDENT).replace('\n', '\n' + ' ' * INDENT)
@@ -0,0 +1,171 @@
+import json
+import math
+import time
+
+import lxml.etree as etree
+from django.core.management.base import BaseCommand, CommandError
+
+from hello.converter import compile_diagram, discover_decisions, apply_decisions_in_xml
+from hello.converter import sort_entities_into_weak_and_strong, process_strong_entities, process_weak_entities
+from hello.converter import process_relationships, dumps_schema, parse_xml, validate_tree, TYPE_STRONG, TYPE_WEAK
+from hello.diagram_generator import generate_diagram
+
+"""
+benchmark_converter.py
+times every stage of the conversion on synthetic diagrams of growing size and reports the scaling curves,
+e.g. python manage.py benchmark_converter --sizes 100,200,400,800 --max-exponent 1.5
+"""
+
+STAGES = ['parse', 'compile', 'validate', 'decide', 'strong', 'weak', 'relationships', 'serialize', 'total']
+
+# stages faster than this are dominated by noise, their exponent is not checked
+MIN_CHECKED_SECONDS = 0.005
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the ER to JSON Schema conversion on synthetic diagrams'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='100,200,400,800',
+                            help='comma separated numbers of strong entities')
+        parser.add_argument('--attributes', type=int, default=4, help='attributes per entity')
+        parser.add_argument('--candidate-keys', type=int, default=2, help='candidate keys per strong entity')
+        parser.add_argument('--weak-chains', type=float, default=0.1,
+                            help='weak entity chains per strong entity')
+        parser.add_argument('--weak-chain-depth', type=int, default=3)
+        parser.add_argument('--fan-out', type=int, default=2, help='relationships per strong entity')
+        parser.add_argument('--nesting', type=int, default=10, help='depth of relationships on relationships')
+        parser.add_argument('--merge-candidates', type=float, default=0.1,
+                            help='1-1 relationships per strong entity')
+        parser.add_argument('--repeat', type=int, default=3, help='runs per size, the fastest one is reported')
+        parser.add_argument('--max-exponent', type=float, default=None,
+                            help='fail when a stage grows faster than size ** max-exponent')
+
+    def handle(self, *args, **options):
+        sizes = [int(size) for size in options['sizes'].split(',')]
+        results = []
+        for size in sizes:
+            root = generate_diagram(entities=size,
+                                    attributes_per_entity=options['attributes'],
+                                    candidate_keys=options['candidate_keys'],
+                                    weak_chains=int(size * options['weak_chains']),
+                                    weak_chain_depth=options['weak_chain_depth'],
+                                    relationship_fan_out=options['fan_out'],
+                                    relationship_nesting=options['nesting'],
+                                    merge_candidates=int(size * options['merge_candidates']))
+            content = etree.tostring(root)
+            timings = [run_stages(content) for i in range(options['repeat'])]
+            best = dict((stage, min(timing[stage] for timing in timings)) for stage in STAGES)
+            results.append((size, len(root), len(content), best))
+
+        self.print_timings(results)
+        exponents = get_exponents(results)
+        self.print_exponents(results, exponents)
+
+        if options['max_exponent'] is not None:
+            slow_stages = [stage for stage in STAGES
+                           if any(exponent > options['max_exponent'] for exponent in exponents[stage]
+                                  if exponent is not None)]
+            if len(slow_stages) > 0:
+                raise CommandError('Stages growing faster than size ** ' + str(options['max_exponent']) + ': ' +
+                                   ', '.join(slow_stages))
+
+    def print_timings(self, results):
+        self.stdout.write('Time per stage in ms')
+        self.stdout.write(format_row(['entities', 'objects', 'bytes'] + STAGES))
+        for size, objects, content_length, timing in results:
+            self.stdout.write(format_row([size, objects, content_length] +
+                                         ['%.1f' % (timing[stage] * 1000) for stage in STAGES]))
+
+    def print_exponents(self, results, exponents):
+        if len(results) < 2:
+            return
+        self.stdout.write('')
+        self.stdout.write('Growth exponent between consecutive sizes, 1.0 is linear and 2.0 quadratic')
+        self.stdout.write(format_row(['entities', '', ''] + STAGES))
+        for i in range(1, len(results)):
+            self.stdout.write(format_row([str(results[i - 1][0]) + '-' + str(results[i][0]), '', ''] +
+                                         [format_exponent(exponents[stage][i - 1]) for stage in STAGES]))
+
+
+def run_stages(content):
+    """
+    Convert a diagram once, taking the first primary key and declining every merge
+    :param content: ER XML
+    :return: dict of stage -> seconds
+    """
+    timing = {}
+    start = time.time()
+    tree = parse_xml(content)
+    timing['parse'] = lap(start)
+
+    # the XML Schema is checked before compiling, the references after
+    start = time.time()
+    validate_tree(tree)
+    schema_seconds = lap(start)
+
+    start = time.time()
+    diagram = compile_diagram(tree)
+    timing['compile'] = lap(start)
+
+    start = time.time()
+    key_choices, merge_choices = discover_decisions(diagram)
+    timing['validate'] = schema_seconds + lap(start)
+
+    start = time.time()
+    key_decisions = dict((choice['table_name'], '0') for choice in key_choices)
+    merge_decisions = [('0', choice['merge_from'], choice['merge_to']) for choice in merge_choices]
+    tree = apply_decisions_in_xml(tree, key_decisions, merge_decisions)
+    diagram = compile_diagram(tree)
+    timing['decide'] = lap(start)
+
+    # same steps as convert_diagram, timed one by one
+    start = time.time()
+    entities_list = sort_entities_into_weak_and_strong(diagram.entities)
+    processed_tables = process_strong_entities(entities_list[TYPE_STRONG], {})
+    timing['strong'] = lap(start)
+
+    start = time.time()
+    processed_tables = process_weak_entities(entities_list[TYPE_WEAK], diagram, processed_tables)
+    timing['weak'] = lap(start)
+
+    start = time.time()
+    processed_tables = process_relationships(diagram, processed_tables)
+    timing['relationships'] = lap(start)
+
+    start = time.time()
+    dumps_schema(processed_tables)
+    timing['serialize'] = lap(start)
+
+    timing['total'] = sum(timing.values())
+    return timing
+
+
+def lap(start):
+    return time.time() - start
+
+
+def get_exponents(results):
+    """
+    Fit t = c * n ** k between each pair of consecutive sizes
+    :return: dict of stage -> list of k, None where the stage is too fast to tell
+    """
+    exponents = dict((stage, []) for stage in STAGES)
+    for i in range(1, len(results)):
+        previous_size, previous_timing = results[i - 1][0], results[i - 1][3]
+        size, timing = results[i][0], results[i][3]
+        for stage in STAGES:
+            if min(previous_timing[stage], timing[stage]) < MIN_CHECKED_SECONDS:
+                exponents[stage].append(None)
+            else:
+                exponents[stage].append(math.log(timing[stage] / previous_timing[stage]) /
+                                        math.log(float(size) / previous_size))
+    return exponents
+
+
+def format_row(columns):
+    return ''.join(str(column).rjust(14) for column in columns)
+
+
+def format_exponent(exponent):
+    return '-' if exponent is None else '%.2f' % exponent
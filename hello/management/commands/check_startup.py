@@ -0,0 +1,82 @@
+import json
+import os
+import subprocess
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from hello.warmup import get_budgets
+
+"""
+check_startup.py
+starts a new process the way cs4221/wsgi.py does, reports the time of each warm-up stage against its budget
+and compares the first request's work after the warm-up with the steady state, e.g.
+python manage.py check_startup --repeat 20 --max-first-ratio 1.5
+"""
+
+# run in the new process, prints the warm-up timings and the times of the request work after it as JSON
+PROCESS_SCRIPT = '''
+import json, sys, time
+started = time.time()
+import django
+from django.core.wsgi import get_wsgi_application
+get_wsgi_application()
+from hello.warmup import warm_up, compile_templates, run_canary
+
+timings = warm_up(started)
+request_times = []
+for i in range(int(sys.argv[1]) + 1):
+    start = time.time()
+    compile_templates()
+    run_canary()
+    request_times.append(time.time() - start)
+sys.stdout.write(json.dumps({'timings': timings.items(), 'request_times': request_times}))
+'''
+
+
+class Command(BaseCommand):
+    help = 'Measure the start of a web process against WARMUP_IMPORT_BUDGET and WARMUP_STARTUP_BUDGET'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=20,
+                            help='runs of the request work after the first one, their median is the steady state')
+        parser.add_argument('--max-first-ratio', type=float, default=None,
+                            help='fail when the first request work after the warm-up is slower than '
+                                 'the steady state times this')
+
+    def handle(self, *args, **options):
+        process = subprocess.Popen([sys.executable, '-c', PROCESS_SCRIPT, str(options['repeat'])],
+                                   cwd=settings.BASE_DIR, env=dict(os.environ), stdout=subprocess.PIPE)
+        output = process.communicate()[0]
+        if process.returncode != 0:
+            raise CommandError('The new process failed with exit code ' + str(process.returncode))
+        result = json.loads(output)
+
+        budgets = get_budgets()
+        over_budget = []
+        self.stdout.write('%-12s%12s%12s' % ('stage', 'seconds', 'budget'))
+        for stage, seconds in result['timings']:
+            budget = budgets.get(stage)
+            self.stdout.write('%-12s%12.3f%12s' % (stage, seconds, '-' if budget is None else '%.3f' % budget))
+            if budget is not None and seconds > budget:
+                over_budget.append(stage)
+
+        first = result['request_times'][0]
+        steady = get_median(result['request_times'][1:])
+        self.stdout.write('')
+        self.stdout.write('request work after the warm-up: first %.1f ms, steady state %.1f ms (median of %d)' % (
+            first * 1000, steady * 1000, len(result['request_times']) - 1))
+
+        if len(over_budget) > 0:
+            raise CommandError('Over budget: ' + ', '.join(over_budget))
+        if options['max_first_ratio'] is not None and first > steady * options['max_first_ratio']:
+            raise CommandError('The first request work is %.1f times the steady state' % (first / steady))
+
+
+def get_median(values):
+    values = sorted(values)
+    if len(values) == 0:
+        return float('nan')
+    middle = len(values) // 2
+    return values[middle] if len(values) % 2 == 1 else (values[middle - 1] + values[middle]) / 2.0
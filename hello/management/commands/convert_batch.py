@@ -0,0 +1,149 @@
+import json
+import multiprocessing
+import os
+import time
+
+import lxml.etree as etree
+from django.core.management.base import BaseCommand, CommandError
+
+from hello.converter import compile_diagram, discover_decisions, apply_decision_map, convert_diagram, DiagramError
+from hello.converter import dumps_schema, parse_xml, validate_tree
+
+"""
+convert_batch.py
+converts many ER XML files offline on all cores, answering key and merge choices by policy, e.g.
+python manage.py convert_batch hello/data --output-dir /tmp/schemas --key-policy first --merge-policy never
+"""
+
+KEY_POLICY_FIRST = 'first'
+KEY_POLICY_FAIL = 'fail'
+MERGE_POLICY_NEVER = 'never'
+MERGE_POLICY_ALWAYS = 'always'
+MERGE_POLICY_FAIL = 'fail'
+
+SUMMARY_FILE_NAME = 'summary.json'
+
+
+class Command(BaseCommand):
+    help = 'Convert ER XML files or directories of them to JSON Schema in parallel'
+
+    def add_arguments(self, parser):
+        parser.add_argument('inputs', nargs='+', help='ER XML files or directories containing *.xml')
+        parser.add_argument('--output-dir', required=True, help='one <name>.json per input is written here')
+        parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(),
+                            help='processes to convert with, 1 converts in this process')
+        parser.add_argument('--key-policy', choices=[KEY_POLICY_FIRST, KEY_POLICY_FAIL], default=KEY_POLICY_FIRST,
+                            help='take the first candidate key as primary key, or fail the file')
+        parser.add_argument('--merge-policy', choices=[MERGE_POLICY_NEVER, MERGE_POLICY_ALWAYS, MERGE_POLICY_FAIL],
+                            default=MERGE_POLICY_NEVER, help='what to do with relationships that can be merged')
+
+    def handle(self, *args, **options):
+        paths = get_input_paths(options['inputs'])
+        output_dir = options['output_dir']
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+
+        tasks = [(path, get_output_path(path, output_dir), options['key_policy'], options['merge_policy'])
+                 for path in paths]
+        start = time.time()
+        if options['workers'] == 1:
+            results = [convert_file(task) for task in tasks]
+        else:
+            pool = multiprocessing.Pool(options['workers'])
+            try:
+                # one file per task, so a big diagram does not hold back a batch of small ones
+                results = pool.map(convert_file, tasks, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+        elapsed = time.time() - start
+
+        failed = [result for result in results if result['status'] != 'ok']
+        with open(os.path.join(output_dir, SUMMARY_FILE_NAME), 'w') as summary_file:
+            json.dump({'seconds': elapsed, 'converted': len(results) - len(failed), 'failed': len(failed),
+                       'files': results}, summary_file, indent=4)
+
+        for result in results:
+            self.stdout.write('%-8s %10.1f ms  %s%s' % (result['status'], result['seconds'] * 1000, result['input'],
+                                                       ': ' + result['error'] if result['error'] else ''))
+        self.stdout.write('%d converted, %d failed in %.1f s, summary in %s' % (
+            len(results) - len(failed), len(failed), elapsed, os.path.join(output_dir, SUMMARY_FILE_NAME)))
+        if len(failed) > 0:
+            raise CommandError(str(len(failed)) + ' of ' + str(len(results)) + ' files could not be converted')
+
+
+def get_input_paths(inputs):
+    paths = []
+    for input_path in inputs:
+        if os.path.isdir(input_path):
+            paths.extend(os.path.join(input_path, file_name) for file_name in sorted(os.listdir(input_path))
+                         if file_name.lower().endswith('.xml'))
+        elif os.path.isfile(input_path):
+            paths.append(input_path)
+        else:
+            raise CommandError(input_path + ' does not exist')
+
+    file_names = [os.path.basename(path) for path in paths]
+    duplicates = sorted(set(file_name for file_name in file_names if file_names.count(file_name) > 1))
+    if len(duplicates) > 0:
+        raise CommandError('Inputs with the same file name would overwrite each other: ' + ', '.join(duplicates))
+    return paths
+
+
+def get_output_path(path, output_dir):
+    return os.path.join(output_dir, os.path.splitext(os.path.basename(path))[0] + '.json')
+
+
+def convert_file(task):
+    """
+    Convert one file, runs in a worker process
+    :param task: (input path, output path, key policy, merge policy)
+    :return: summary entry of the file
+    """
+    path, output_path, key_policy, merge_policy = task
+    result = {'input': path, 'output': None, 'status': 'ok', 'error': None}
+    start = time.time()
+    try:
+        with open(path, 'rb') as input_file:
+            tree = parse_xml(input_file.read())
+        validate_tree(tree)
+        tree = decide_by_policy(tree, key_policy, merge_policy)
+        output_json = dumps_schema(convert_diagram(compile_diagram(tree)))
+        with open(output_path, 'w') as output_file:
+            output_file.write(output_json)
+        result['output'] = output_path
+    except DiagramError as e:
+        result['status'] = 'invalid'
+        result['error'] = str(e)
+    except etree.XMLSyntaxError as e:
+        result['status'] = 'invalid'
+        result['error'] = 'The xml is malformed: ' + str(e)
+    except Exception as e:
+        result['status'] = 'error'
+        result['error'] = 'Unexpected error: ' + repr(e)
+    result['seconds'] = time.time() - start
+    return result
+
+
+def decide_by_policy(tree, key_policy, merge_policy):
+    """
+    Answer every key and merge choice of the diagram without asking, like the decisions form would
+    :return: tree with all decisions applied, raises DiagramError when a policy is to fail
+    """
+    diagram = compile_diagram(tree)
+    key_choices, merge_choices = discover_decisions(diagram)
+    # a merge adds a relation attribute to its target, so look again until nothing is left to decide
+    while len(key_choices) > 0 or len(merge_choices) > 0:
+        if len(key_choices) > 0 and key_policy == KEY_POLICY_FAIL:
+            raise DiagramError('Primary key has to be chosen for ' +
+                               ', '.join(choice['table_name'] for choice in key_choices))
+        if len(merge_choices) > 0 and merge_policy == MERGE_POLICY_FAIL:
+            raise DiagramError('Merge has to be decided for ' +
+                               ', '.join(choice['merge_from'] for choice in merge_choices))
+        tree = apply_decision_map(tree, diagram, {
+            'primary_keys': dict((choice['table_name'], 0) for choice in key_choices),
+            'merges': dict((choice['merge_from'], merge_policy == MERGE_POLICY_ALWAYS) for choice in merge_choices)
+        })
+        diagram = compile_diagram(tree)
+        key_choices, merge_choices = discover_decisions(diagram)
+    return tree
@@ -0,0 +1,409 @@
+import json
+import math
+import random
+import re
+import threading
+import time
+import urllib
+import urllib2
+from cookielib import CookieJar
+from urlparse import urljoin
+
+import lxml.etree as etree
+import lxml.html
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management.base import BaseCommand, CommandError
+from django.test.client import encode_multipart, BOUNDARY, MULTIPART_CONTENT
+
+from hello.converter import XML_NAME
+from hello.diagram_generator import generate_diagram
+
+"""
+load_test.py
+drives the whole UI flow (upload, choose_key, proceed_next, choose_merge, download) with many concurrent
+sessions against a running server and reports latency percentiles and throughput per endpoint, e.g.
+python manage.py load_test --url http://localhost:8888/hello/ --users 10 --sessions 200 \
+    --mix hello/data/full_sample.xml=3,synthetic:200=1
+"""
+
+SYNTHETIC_PREFIX = 'synthetic:'
+# a diagram needs at most one decisions page per round of merges, more rounds mean the flow is stuck
+MAX_DECISION_ROUNDS = 20
+PERCENTILES = [50, 95, 99]
+SESSION = 'session'
+
+UPLOADED_FILE_PATTERN = re.compile(r"'(/hello/uploaded_file/[0-9a-f]{32})\?page=")
+JOB_ID_PATTERN = re.compile(r'/hello/jobs/([0-9a-f]{40})')
+
+
+class FlowError(Exception):
+    """
+    A page of the flow is not what a browser would get, the session is given up
+    """
+
+
+class Command(BaseCommand):
+    help = 'Load test the upload to download flow of a running server'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='http://localhost:8000/hello/', help='base URL of the hello app')
+        parser.add_argument('--users', type=int, default=4, help='concurrent sessions')
+        parser.add_argument('--sessions', type=int, default=100, help='sessions to run in total')
+        parser.add_argument('--duration', type=float, default=None,
+                            help='stop starting sessions after this many seconds')
+        parser.add_argument('--warmup', type=int, default=1, help='sessions run one by one first, not reported')
+        parser.add_argument('--mix', default='hello/data/full_sample.xml',
+                            help='comma separated diagrams with optional weights, a diagram is an XML file or '
+                                 'synthetic:<entities>, e.g. hello/data/full_sample.xml=3,synthetic:200=1')
+        parser.add_argument('--distinct', action='store_true',
+                            help='rename the tables of every upload, so no session hits the conversion cache')
+        parser.add_argument('--compact', action='store_true', help='download the schema without indentation')
+        parser.add_argument('--think-time', type=float, default=0, help='seconds between the steps of a session')
+        parser.add_argument('--poll-interval', type=float, default=0.5,
+                            help='seconds between status requests while a large diagram is converted')
+        parser.add_argument('--timeout', type=float, default=120, help='seconds to wait for a response')
+        parser.add_argument('--seed', type=int, default=0, help='seed of the choice of diagrams')
+        parser.add_argument('--output', default=None, help='also write the report to this JSON file')
+        parser.add_argument('--max-p95', type=float, default=None,
+                            help='fail when the p95 latency of an endpoint is above this many ms')
+        parser.add_argument('--max-error-rate', type=float, default=0.0,
+                            help='fail when more than this fraction of sessions fail')
+
+    def handle(self, *args, **options):
+        diagrams = get_diagrams(options['mix'])
+        load_test = LoadTest(options['url'], diagrams, options)
+
+        for number in range(options['warmup']):
+            load_test.run_session(-1 - number, Recorder())
+        recorder = Recorder()
+        elapsed = load_test.run(recorder, options['users'], options['sessions'], options['duration'])
+
+        report = get_report(recorder, elapsed, options['users'])
+        self.print_report(report)
+        if options['output'] is not None:
+            with open(options['output'], 'w') as output_file:
+                json.dump(report, output_file, indent=4)
+
+        sessions = report['endpoints'][-1]
+        if sessions['requests'] > 0 and sessions['errors'] > options['max_error_rate'] * sessions['requests']:
+            raise CommandError(str(sessions['errors']) + ' of ' + str(sessions['requests']) + ' sessions failed')
+        if options['max_p95'] is not None:
+            slow_endpoints = [endpoint['endpoint'] for endpoint in report['endpoints'][:-1]
+                              if endpoint['p95'] is not None and endpoint['p95'] > options['max_p95']]
+            if len(slow_endpoints) > 0:
+                raise CommandError('p95 latency above ' + str(options['max_p95']) + ' ms: ' + ', '.join(slow_endpoints))
+
+    def print_report(self, report):
+        self.stdout.write('%d sessions of %d concurrent users in %.1f s' % (
+            report['endpoints'][-1]['requests'], report['users'], report['seconds']))
+        self.stdout.write(format_row(['endpoint', 'requests', 'errors', 'req/s'] +
+                                     ['p' + str(percentile) + ' ms' for percentile in PERCENTILES] + ['max ms']))
+        for endpoint in report['endpoints']:
+            self.stdout.write(format_row([endpoint['endpoint'], endpoint['requests'], endpoint['errors'],
+                                          '%.2f' % endpoint['throughput']] +
+                                         [format_milliseconds(endpoint['p' + str(percentile)])
+                                          for percentile in PERCENTILES] +
+                                         [format_milliseconds(endpoint['max'])]))
+        for error, count in sorted(report['errors'].items(), key=lambda item: -item[1]):
+            self.stdout.write('%6d x %s' % (count, error))
+
+
+class Recorder(object):
+    """
+    Latencies and errors of all sessions, in the order the endpoints were first requested
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.endpoints = []
+        self.latencies = {}  # endpoint -> list of seconds
+        self.errors = {}  # endpoint -> number of failed requests
+        self.messages = {}  # error message -> count
+
+    def record(self, endpoint, seconds, error=None):
+        with self.lock:
+            if endpoint not in self.latencies:
+                self.endpoints.append(endpoint)
+                self.latencies[endpoint] = []
+                self.errors[endpoint] = 0
+            self.latencies[endpoint].append(seconds)
+            if error is not None:
+                self.errors[endpoint] += 1
+                message = endpoint + ': ' + error
+                self.messages[message] = self.messages.get(message, 0) + 1
+
+
+class LoadTest(object):
+
+    def __init__(self, base_url, diagrams, options):
+        self.base_url = base_url if base_url.endswith('/') else base_url + '/'
+        self.diagrams = diagrams  # list of (name, XML, weight)
+        self.options = options
+
+    def run(self, recorder, users, sessions, duration):
+        """
+        Run sessions in users threads until sessions have been started or duration has passed
+        :return: seconds it took
+        """
+        numbers = iter(range(sessions))
+        numbers_lock = threading.Lock()
+        start = time.time()
+
+        def run_user():
+            while duration is None or time.time() - start < duration:
+                with numbers_lock:
+                    number = next(numbers, None)
+                if number is None:
+                    return
+                self.run_session(number, recorder)
+
+        threads = [threading.Thread(target=run_user) for i in range(users)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            # join with a timeout, so Ctrl+C still stops the main thread
+            while thread.is_alive():
+                thread.join(1)
+        return time.time() - start
+
+    def run_session(self, number, recorder):
+        start = time.time()
+        try:
+            name, content = self.choose_diagram(number)
+            Session(self, recorder).run(name, content)
+        except FlowError as e:
+            recorder.record(SESSION, time.time() - start, str(e))
+        else:
+            recorder.record(SESSION, time.time() - start)
+
+    def choose_diagram(self, number):
+        # the same seed and session number always upload the same diagram
+        chooser = random.Random(self.options['seed'] * 1000003 + number)
+        position = chooser.uniform(0, sum(weight for name, content, weight in self.diagrams))
+        for name, content, weight in self.diagrams:
+            position -= weight
+            if position <= 0:
+                break
+        if self.options['distinct']:
+            content = make_distinct(content, number)
+        return name, content
+
+
+class Session(object):
+    """
+    One user going through the flow like the browser does, with its own session and CSRF cookies
+    """
+
+    def __init__(self, load_test, recorder):
+        self.load_test = load_test
+        self.recorder = recorder
+        self.opener = urllib2.build_opener(urllib2.HTTPCookieProcessor(CookieJar()))
+        self.csrf_token = None
+
+    def run(self, name, content):
+        options = self.load_test.options
+        page = self.request('GET upload', 'upload')
+        page = self.request('POST upload', 'upload', {'er_file': SimpleUploadedFile(
+            name, content, content_type='application/xml')}, multipart=True)
+        self.get_form(page, 'choose_key')
+
+        # the XML viewer of the page loads the upload by itself
+        match = UPLOADED_FILE_PATTERN.search(get_scripts(page))
+        if match is not None:
+            self.request('GET uploaded_file', match.group(1) + '?page=0', parse=False)
+
+        page = self.submit('POST choose_key', page, 'choose_key')
+        for i in range(MAX_DECISION_ROUNDS):
+            page = self.wait_for_job(page)
+            if self.find_form(page, 'proceed_next') is None:
+                break
+            page = self.submit('POST proceed_next', page, 'proceed_next')
+        else:
+            raise FlowError('decisions are still asked for after ' + str(MAX_DECISION_ROUNDS) + ' rounds')
+
+        # the diagram has no decisions left, choose_merge converts it again
+        self.get_form(page, 'download')
+        page = self.wait_for_job(self.request('POST choose_merge', 'choose_merge', {}))
+        self.get_form(page, 'download')
+        data = {'compact': '1'} if options['compact'] else {}
+        self.request('POST download', 'download', data, multipart=True, parse=False)
+
+    def wait_for_job(self, page):
+        """
+        Poll the job of a large diagram like the conversion page does, then load the result page
+        """
+        if page.find('.//title') is None or page.findtext('.//title').strip() != 'Converting':
+            return page
+        match = JOB_ID_PATTERN.search(get_scripts(page))
+        if match is None:
+            raise FlowError('the conversion page has no job')
+        job_id = match.group(1)
+        while True:
+            status = json.loads(self.request('GET jobs/<id>', 'jobs/' + job_id, parse=False))['status']
+            if status not in ['queued', 'running']:
+                return self.request('GET jobs/<id>/view', 'jobs/' + job_id + '/view')
+            time.sleep(self.load_test.options['poll_interval'])
+
+    def submit(self, endpoint, page, action):
+        """
+        Submit a form with its default answers: the first key, no merge
+        """
+        form = self.get_form(page, action)
+        return self.request(endpoint, urljoin(self.load_test.base_url, form.action), form.form_values(),
+                            multipart=True)
+
+    def get_form(self, page, action):
+        form = self.find_form(page, action)
+        if form is None:
+            raise FlowError(get_page_error(page) or 'the page has no ' + action + ' form')
+        return form
+
+    def find_form(self, page, action):
+        for form in page.forms:
+            if form.action is not None and form.action.rstrip('/').endswith(action):
+                return form
+        return None
+
+    def request(self, endpoint, url, data=None, multipart=False, parse=True):
+        """
+        Send a request and record its latency
+        :param endpoint: name of the endpoint in the report
+        :param url: relative to the base URL
+        :param data: dict or list of pairs to POST, None to GET
+        :param multipart: send data as multipart/form-data, the way the forms of the UI do
+        :param parse: return the page as lxml.html document instead of the body
+        :return: body or document
+        """
+        if self.load_test.options['think_time'] > 0:
+            time.sleep(self.load_test.options['think_time'])
+        headers = {}
+        body = None
+        if data is not None:
+            data = list(data.items() if isinstance(data, dict) else data)
+            if self.csrf_token is not None and 'csrfmiddlewaretoken' not in dict(data):
+                data.append(('csrfmiddlewaretoken', self.csrf_token))
+            if multipart:
+                body = encode_multipart(BOUNDARY, dict(data))
+                headers['Content-Type'] = MULTIPART_CONTENT
+            else:
+                body = urllib.urlencode(data)
+        url = urljoin(self.load_test.base_url, url)
+
+        start = time.time()
+        try:
+            response = self.opener.open(urllib2.Request(url, body, headers), timeout=self.load_test.options['timeout'])
+            content = response.read()
+        except urllib2.HTTPError as e:
+            self.recorder.record(endpoint, time.time() - start, 'HTTP ' + str(e.code))
+            raise FlowError(endpoint + ' returned HTTP ' + str(e.code))
+        except Exception as e:
+            self.recorder.record(endpoint, time.time() - start, e.__class__.__name__)
+            raise FlowError(endpoint + ' failed: ' + str(e))
+        seconds = time.time() - start
+
+        if not parse:
+            self.recorder.record(endpoint, seconds)
+            return content
+        page = lxml.html.document_fromstring(content, base_url=url)
+        self.recorder.record(endpoint, seconds, get_page_error(page))
+        token = page.xpath('//input[@name="csrfmiddlewaretoken"]/@value')
+        if len(token) > 0:
+            self.csrf_token = token[0]
+        return page
+
+
+def get_scripts(page):
+    return ''.join(script.text or '' for script in page.iter('script'))
+
+
+def get_page_error(page):
+    """
+    :return: error message shown by the page, e.g. "Error occurs: The uploaded xml is invalid.", or None
+    """
+    alerts = page.find_class('alert-danger')
+    if len(alerts) == 0:
+        return None
+    return ' '.join(alerts[0].text_content().split())
+
+
+def get_diagrams(mix):
+    """
+    Read the diagrams of a mix
+    :param mix: see --mix
+    :return: list of (file name, XML, weight)
+    """
+    diagrams = []
+    for item in mix.split(','):
+        source, separator, weight = item.strip().partition('=')
+        try:
+            weight = float(weight) if separator else 1.0
+        except ValueError:
+            raise CommandError('The weight of ' + source + ' is not a number')
+        if source.startswith(SYNTHETIC_PREFIX):
+            entities = source[len(SYNTHETIC_PREFIX):]
+            if not entities.isdigit():
+                raise CommandError(source + ' should be ' + SYNTHETIC_PREFIX + '<entities>')
+            diagrams.append(('synthetic_' + entities + '.xml',
+                             etree.tostring(generate_diagram(entities=int(entities))), weight))
+        else:
+            try:
+                with open(source, 'rb') as diagram_file:
+                    diagrams.append((source.replace('\\', '/').split('/')[-1], diagram_file.read(), weight))
+            except IOError as e:
+                raise CommandError('Unable to read ' + source + ': ' + str(e))
+    if sum(weight for name, content, weight in diagrams) <= 0:
+        raise CommandError('The mix needs a diagram with a positive weight')
+    return diagrams
+
+
+def make_distinct(content, number):
+    """
+    Suffix the name of every entity and relationship with the session number, which changes the cache key
+    of the diagram but not how it is converted. Invalid XML is sent as it is.
+    """
+    try:
+        root = etree.fromstring(content)
+    except etree.XMLSyntaxError:
+        return content
+    for node in root:
+        if isinstance(node.tag, basestring) and XML_NAME in node.attrib:
+            node.attrib[XML_NAME] += '_' + str(number)
+    return etree.tostring(root)
+
+
+def get_report(recorder, elapsed, users):
+    endpoints = []
+    for endpoint in [name for name in recorder.endpoints if name != SESSION] + [SESSION]:
+        latencies = sorted(recorder.latencies.get(endpoint, []))
+        summary = {
+            'endpoint': endpoint,
+            'requests': len(latencies),
+            'errors': recorder.errors.get(endpoint, 0),
+            'throughput': len(latencies) / elapsed if elapsed > 0 else 0.0,
+            'max': latencies[-1] * 1000 if latencies else None
+        }
+        for percentile in PERCENTILES:
+            summary['p' + str(percentile)] = get_percentile(latencies, percentile)
+        endpoints.append(summary)
+    return {'seconds': elapsed, 'users': users, 'endpoints': endpoints, 'errors': recorder.messages}
+
+
+def get_percentile(latencies, percentile):
+    """
+    Nearest rank percentile
+    :param latencies: sorted seconds
+    :return: milliseconds, None without latencies
+    """
+    if len(latencies) == 0:
+        return None
+    rank = int(math.ceil(percentile / 100.0 * len(latencies)))
+    return latencies[max(rank, 1) - 1] * 1000
+
+
+def format_row(columns):
+    return str(columns[0]).ljust(22) + ''.join(str(column).rjust(11) for column in columns[1:])
+
+
+def format_milliseconds(milliseconds):
+    return '-' if milliseconds is None else '%.1f' % milliseconds
@@ -0,0 +1,85 @@
+"""
+model.py
+compact intermediate representation of an ER diagram and of the tables converted from it.
+Only the fields the conversion needs are copied out of the parsed XML, so the tree can be freed
+as soon as a diagram is compiled. Strings repeated across the diagram (ids, types, participations)
+are interned so every object shares one copy.
+"""
+
+
+def intern_string(value):
+    # intern() only accepts byte strings, lxml returns unicode for non-ASCII values
+    return intern(value) if isinstance(value, str) else value
+
+
+class Attribute(object):
+    """
+    <attribute> of an entity or relationship: a named column, or a reference to another object
+    """
+    __slots__ = ('id', 'name', 'type', 'entity_id', 'relation_id', 'min_participation', 'max_participation')
+
+    def __init__(self, attribute_id, name=None, type=None, entity_id=None, relation_id=None,
+                 min_participation=None, max_participation=None):
+        self.id = intern_string(attribute_id)
+        self.name = name
+        self.type = intern_string(type)
+        self.entity_id = intern_string(entity_id)
+        self.relation_id = intern_string(relation_id)
+        self.min_participation = intern_string(min_participation)
+        self.max_participation = intern_string(max_participation)
+
+    def get_type(self):
+        return self.type if self.type is not None else "string"
+
+
+class Key(tuple):
+    """
+    Candidate or unique key, the Attributes it consists of in key order
+    """
+    __slots__ = ()
+
+
+class DiagramObject(object):
+    """
+    Entity or relationship
+    """
+    __slots__ = ('id', 'name', 'checked', 'merged', 'attributes', 'keys', 'unique_keys', 'relation_id')
+
+    def __init__(self, object_id, name, checked, merged, attributes, keys, unique_keys, relation_id):
+        self.id = intern_string(object_id)
+        self.name = name
+        self.checked = intern_string(checked)
+        self.merged = intern_string(merged)
+        self.attributes = attributes  # attribute id -> Attribute
+        self.keys = keys  # list of Key, the primary key once decided
+        self.unique_keys = unique_keys  # list of Key
+        self.relation_id = relation_id  # first relation_id among the attributes, set for weak entities
+
+
+class Entity(DiagramObject):
+    __slots__ = ()
+
+
+class Relationship(DiagramObject):
+    __slots__ = ()
+
+
+class Table(object):
+    """
+    Table converted from an entity or relationship, see to_json for its JSON Schema
+    """
+    __slots__ = ('name', 'attributes', 'primary_key', 'unique')
+
+    def __init__(self, name, attributes, primary_key, unique):
+        self.name = name
+        self.attributes = attributes  # column name -> JSON Schema of the column
+        self.primary_key = primary_key  # column names
+        self.unique = unique  # list of lists of column names
+
+    def to_json(self):
+        return {
+            "attributes": self.attributes,
+            "primary_key": self.primary_key,
+            "unique": self.unique,
+            "type": "object"
+        }
@@ -0,0 +1,57 @@
+import gzip
+import logging
+import os
+from urllib import unquote
+from urlparse import urlsplit
+
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage
+
+"""
+storage.py
+static files storage for deployment: collectstatic copies every asset to STATIC_ROOT under a name
+carrying a hash of its content (bootstrap.css -> bootstrap.2f3e21c3b5a1.css), writes a gzip copy
+next to the text ones and records the names in staticfiles.json, which {% static %} looks them up in.
+A hashed name never changes its content, so Apache can let browsers keep it forever, see conf/httpd-app.conf.
+"""
+
+logger = logging.getLogger(__name__)
+
+# images are compressed already
+COMPRESSED_EXTENSIONS = ['.css', '.js', '.svg', '.json', '.txt', '.html', '.xml']
+# smaller files are not worth the extra request header
+MIN_COMPRESSED_SIZE = 1024
+
+
+class CompressedManifestStaticFilesStorage(ManifestStaticFilesStorage):
+
+    def hashed_name(self, name, content=None):
+        # bootstrap.css refers to glyphicon fonts that are not shipped, keep such references as they are
+        # instead of failing collectstatic. The same keeps {% static %} working before collectstatic has run.
+        if content is None and not self.exists(urlsplit(unquote(name)).path.strip()):
+            logger.warning('static file %s not found, it is not fingerprinted', name)
+            return name
+        return super(CompressedManifestStaticFilesStorage, self).hashed_name(name, content)
+
+    def post_process(self, paths, dry_run=False, **options):
+        hashed_names = []
+        for name, hashed_name, processed in super(CompressedManifestStaticFilesStorage, self).post_process(
+                paths, dry_run, **options):
+            if hashed_name is not None and not isinstance(processed, Exception):
+                hashed_names.append(hashed_name)
+            yield name, hashed_name, processed
+
+        # compressed once all files are final, css is rewritten to the hashed names of what it refers to
+        if not dry_run:
+            for hashed_name in hashed_names:
+                if os.path.splitext(hashed_name)[1].lower() in COMPRESSED_EXTENSIONS:
+                    self.write_compressed(hashed_name)
+
+    def write_compressed(self, name):
+        with self.open(name) as original:
+            content = original.read()
+        if len(content) < MIN_COMPRESSED_SIZE:
+            return
+        # no file name and time in the header, so the same file always compresses to the same bytes
+        with open(self.path(name) + '.gz', 'wb') as compressed_file:
+            with gzip.GzipFile(filename='', mode='wb', fileobj=compressed_file, compresslevel=9, mtime=0) as gzip_file:
+                gzip_file.write(content)
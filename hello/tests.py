@@ -1,3 +1,430 @@
-from django.test import TestCase
+import json
+import os
+import shutil
+import tempfile
+import time
 
-# Create your tests here.
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.urlresolvers import reverse
+from django.test import Client, TestCase, override_settings
+
+import lxml.etree as etree
+
+from hello.cache import ConversionCache, get_conversion_cache, get_table_cache
+from hello.converter import parse_xml, compile_diagram, convert_diagram, dumps_schema, apply_decision_log
+from hello.converter import apply_decisions_in_xml, split_diagram, convert_part_job, merge_part_tables
+from hello.converter import get_table_order, convert_job, discover_decisions
+from hello.diagram_generator import generate_diagram
+from hello.instrumentation import get_histogram
+from hello.management.commands.convert_batch import decide_by_policy
+from hello.views import UPLOADED_FILE_PAGE_BYTES
+from hello.workspace import Workspace, WorkspaceStore, MemoryWorkspaceStore, get_workspace_store
+from hello.workspace import OP_PRIMARY_KEY, OP_MERGE
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+
+def read_sample(file_name):
+    with open(os.path.join(DATA_DIR, file_name), 'rb') as sample_file:
+        return sample_file.read()
+
+
+def get_template_names(response):
+    return [template.name for template in response.templates]
+
+
+@override_settings(CONVERSION_CACHE_DIR=None)
+class ConversionFlowTestCase(TestCase):
+    """
+    Base class driving the upload, decisions and result pages with the test client.
+    The conversion cache stays in memory, so no test finds the results of an earlier run.
+    """
+
+    def upload(self, content, file_name='diagram.xml'):
+        return self.client.post('/hello/upload', {
+            'er_file': SimpleUploadedFile(file_name, content, content_type='text/xml')
+        })
+
+    def get_decisions_post(self, response, key_option='0', merge='0'):
+        post = {'decisions': '1'}
+        for key_choice in response.context['key_choices']:
+            post['primaryKeyOption_' + key_choice['table_name']] = key_option
+        for merge_choice in response.context['merge_choices']:
+            post['merge_table_' + merge_choice['merge_from']] = merge
+        return post
+
+    def answer_decisions(self, response, key_option='0', merge='0'):
+        """
+        Answer every decisions form the same way until the result is shown
+        """
+        while 'choose_decisions.html' in get_template_names(response):
+            response = self.client.post('/hello/proceed_next', self.get_decisions_post(response, key_option, merge))
+        return response
+
+    def convert(self, content, key_option='0', merge='0'):
+        self.upload(content)
+        return self.answer_decisions(self.client.post('/hello/choose_key'), key_option, merge)
+
+    def get_workspace(self):
+        return get_workspace_store().get(self.client.session['workspace_id'])
+
+    def assertResult(self, response):
+        self.assertIn('display_result.html', get_template_names(response))
+        return json.loads(response.context['output_json'])
+
+
+class ConversionFlowTest(ConversionFlowTestCase):
+    """
+    The UI flow gives the same JSON Schema as before the decisions were collected on one page
+    """
+
+    def check_flow(self, key_option, merge, expected_file_name):
+        self.upload(read_sample('full_sample.xml'))
+        form = self.client.post('/hello/choose_key')
+        self.assertEqual([choice['table_name'] for choice in form.context['key_choices']], ['Office', 'Consultant'])
+        self.assertEqual([(choice['merge_from'], choice['merge_to']) for choice in form.context['merge_choices']],
+                         [('WorkIn', 'Consultant'), ('Propose', 'Project')])
+        expected = json.loads(read_sample(expected_file_name))
+        self.assertEqual(self.assertResult(self.answer_decisions(form, key_option, merge)), expected)
+
+        # nothing is left to decide, so choosing merges goes straight to the result
+        self.assertEqual(self.assertResult(self.client.post('/hello/choose_merge')), expected)
+        download = self.client.post('/hello/download')
+        self.assertEqual(json.loads(''.join(download.streaming_content) if download.streaming else download.content),
+                         expected)
+
+    def test_first_choices(self):
+        self.check_flow('0', '0', 'full_sample_first_choices.json')
+
+    def test_second_choices(self):
+        self.check_flow('1', '1', 'full_sample_second_choices.json')
+
+    def test_invalid_upload(self):
+        response = self.upload(read_sample('sample_missing_key.xml'))
+        self.assertIn('upload.html', get_template_names(response))
+        self.assertIn('Office has no primary key', response.context['uploaded_file_error'])
+
+
+class DecisionLogTest(ConversionFlowTestCase):
+
+    def test_replay_gives_the_decided_tree(self):
+        key_decisions = {'Office': 1, 'Consultant': 0}
+        merge_decisions = [('1', 'WorkIn', 'Consultant'), ('0', 'Propose', 'Project')]
+        decided = apply_decisions_in_xml(parse_xml(read_sample('full_sample.xml')), key_decisions, merge_decisions)
+
+        workspace = Workspace('test', '')
+        workspace.record_decisions(key_decisions, merge_decisions)
+        replayed = apply_decision_log(parse_xml(read_sample('full_sample.xml')), workspace.decision_log)
+        self.assertEqual(etree.tostring(replayed, method='c14n'), etree.tostring(decided, method='c14n'))
+
+    def test_resubmitted_decision_replaces_the_earlier_one(self):
+        self.upload(read_sample('full_sample.xml'))
+        form = self.client.post('/hello/choose_key')
+        self.assertResult(self.answer_decisions(form, key_option='0'))
+
+        # back to the decisions form and submitted again with the other key
+        schema = self.assertResult(self.answer_decisions(form, key_option='1'))
+        self.assertEqual(schema['Office']['primary_key'], ['Country', 'Zip'])
+        office_decisions = [operation for operation in self.get_workspace().decision_log
+                            if operation[0] == OP_PRIMARY_KEY and operation[1] == 'Office']
+        self.assertEqual(office_decisions, [[OP_PRIMARY_KEY, 'Office', '1']])
+
+
+class DecisionsFormTest(ConversionFlowTestCase):
+
+    def setUp(self):
+        self.upload(read_sample('full_sample.xml'))
+        self.form = self.client.post('/hello/choose_key')
+
+    def assertFormError(self, post, error):
+        response = self.client.post('/hello/proceed_next', post)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('choose_decisions.html', get_template_names(response))
+        self.assertIn(error, response.context['uploaded_file_error'])
+        self.assertEqual(self.get_workspace().decision_log, [])
+
+    def test_unknown_table(self):
+        post = self.get_decisions_post(self.form)
+        post['primaryKeyOption_Nope'] = '0'
+        self.assertFormError(post, 'Unknown table [Nope]')
+
+    def test_key_option_not_a_number(self):
+        post = self.get_decisions_post(self.form)
+        post['primaryKeyOption_Office'] = 'first'
+        self.assertFormError(post, 'Invalid primary key option for [Office]')
+
+    def test_merge_target_is_worked_out_on_the_server(self):
+        post = self.get_decisions_post(self.form, merge='1')
+        post['merge_to_WorkIn'] = 'Office'
+        self.assertResult(self.answer_decisions(self.client.post('/hello/proceed_next', post)))
+        self.assertIn([OP_MERGE, '1', 'WorkIn', 'Consultant'], self.get_workspace().decision_log)
+
+
+@override_settings(CONVERSION_CACHE_DIR=None)
+class ApiRequestTest(TestCase):
+    """
+    Malformed API requests are answered with a JSON error naming the problem
+    """
+
+    def post(self, body):
+        response = self.client.post('/hello/api/convert', json.dumps(body), content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        return json.loads(response.content)['errors']
+
+    def post_decisions(self, decisions):
+        return self.post({'xml': read_sample('full_sample.xml'), 'decisions': decisions})
+
+    def test_value_types(self):
+        self.assertEqual(self.post(['xml']), ['The request has to be a JSON object.'])
+        self.assertEqual(self.post({'xml': 123}), ['The xml has to be a string.'])
+        self.assertEqual(self.post_decisions(['Office']), ['The decisions have to be an object.'])
+        self.assertEqual(self.post_decisions('Office'), ['The decisions have to be an object.'])
+        self.assertEqual(self.post_decisions({'primary_keys': [0], 'merges': [True]}),
+                         ['The primary_keys of the decisions have to be an object.',
+                          'The merges of the decisions have to be an object.'])
+
+    def test_invalid_decisions(self):
+        for option in [1.7, True, '1.7', -1, None]:
+            self.assertEqual(self.post_decisions({'primary_keys': {'Office': option}}),
+                             ['Invalid primary key option for [Office]'])
+        for merge in ['maybe', 2, 1.0, None, 'true']:
+            self.assertEqual(self.post_decisions({'merges': {'WorkIn': merge}}),
+                             ['Invalid merge decision for [WorkIn]'])
+
+
+class AttributeIdTest(ConversionFlowTestCase):
+    """
+    The XML Schema allows any attribute id, not only numbers
+    """
+
+    def get_diagram(self):
+        return read_sample('full_sample.xml').replace(
+            '<attribute id="1" name="PassportNumber" type="string"/>',
+            '<attribute id="p" name="PassportNumber" type="string"/>').replace('<key>1</key>\n\t\t<key>3,4</key>',
+                                                                              '<key>p</key>\n\t\t<key>3,4</key>')
+
+    def test_merge_into_entity_with_named_ids(self):
+        response = self.client.post('/hello/api/convert', json.dumps({
+            'xml': self.get_diagram(),
+            'decisions': {'primary_keys': {'Office': 0, 'Consultant': 0}, 'merges': {'WorkIn': True, 'Propose': False}}
+        }), content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)['status'], 'ok')
+
+    def test_version_with_named_ids(self):
+        self.convert(read_sample('full_sample.xml'))
+        response = self.client.post('/hello/upload_version', {
+            'er_file': SimpleUploadedFile('diagram.xml', self.get_diagram(), content_type='text/xml')
+        })
+        response = self.answer_decisions(response)
+        self.assertResult(response)
+        self.assertEqual(response.context['delta']['changed'], [])
+
+
+class WorkspaceStoreTest(TestCase):
+
+    def test_stores_implement_the_interface(self):
+        self.assertRaises(TypeError, WorkspaceStore)
+
+        class IncompleteStore(WorkspaceStore):
+            def get(self, workspace_id):
+                return None
+        self.assertRaises(TypeError, IncompleteStore)
+
+        store = MemoryWorkspaceStore(2)
+        workspace = store.create([read_sample('full_sample.xml')])
+        self.assertEqual(store.get(workspace.id).get_content(), read_sample('full_sample.xml'))
+
+
+class ChangeDecisionsTest(ConversionFlowTestCase):
+
+    def test_unaffected_tables_are_reused(self):
+        first = self.convert(read_sample('full_sample.xml'))
+        self.assertResult(first)
+        previous_tables = get_table_cache().get(first.context['output_key'])
+
+        form = self.client.get('/hello/change_decisions')
+        self.assertIn('choose_decisions.html', get_template_names(form))
+        post = self.get_decisions_post(form)
+        post['primaryKeyOption_Office'] = '1'
+        response = self.client.post('/hello/change_decisions', post)
+        schema = self.assertResult(response)
+        self.assertEqual(schema['Office']['primary_key'], ['Country', 'Zip'])
+
+        tables = get_table_cache().get(response.context['output_key'])
+        reused = sorted(name for name in tables if tables[name] is previous_tables.get(name))
+        # Consultant is weak through WorkIn, which refers to Office, and the relationships referring to it follow
+        self.assertEqual(reused, ['Customer', 'From', 'Pool', 'Project', 'Propose', 'Resource'])
+        # byte for byte, since both are served under the same key
+        self.assertEqual(response.context['output_json'], dumps_schema(convert_diagram(compile_diagram(
+            apply_decision_log(parse_xml(read_sample('full_sample.xml')), self.get_workspace().decision_log)))))
+
+
+class SplitJobTest(TestCase):
+
+    def test_parts_merge_into_the_same_schema(self):
+        # copies of the full sample with renamed objects have no references between them
+        sample = parse_xml(read_sample('full_sample.xml'))
+        tree = etree.Element(sample.tag)
+        for copy in range(4):
+            for child in sample:
+                node = etree.fromstring(etree.tostring(child))
+                node.attrib['name'] += str(copy)
+                node.attrib['id'] = str(copy * 100 + int(node.attrib['id']))
+                for attribute in node.iter('attribute'):
+                    for reference in ['entity_id', 'relation_id']:
+                        if reference in attribute.attrib:
+                            attribute.attrib[reference] = str(copy * 100 + int(attribute.attrib[reference]))
+                tree.append(node)
+        tree = decide_by_policy(tree, 'first', 'never')
+        diagram = compile_diagram(tree)
+
+        parts = split_diagram(tree, diagram, 4)
+        self.assertEqual(len(parts), 4)
+        merged = merge_part_tables([convert_part_job(part) for part in parts], get_table_order(diagram))
+        self.assertEqual(merged, convert_job(etree.tostring(tree)))
+
+
+class VersionTest(ConversionFlowTestCase):
+
+    def upload_version(self, content):
+        return self.client.post('/hello/upload_version', {
+            'er_file': SimpleUploadedFile('diagram.xml', content, content_type='text/xml')
+        })
+
+    def test_delta_and_carried_decisions(self):
+        self.convert(read_sample('full_sample.xml'), key_option='1', merge='1')
+        response = self.answer_decisions(self.upload_version(read_sample('full_sample.xml').replace(
+            '<attribute id="2" name="Description" type="string"/>',
+            '<attribute id="2" name="Description" type="string"/><attribute id="3" name="Budget" type="number"/>')),
+            key_option='1', merge='1')
+        schema = self.assertResult(response)
+
+        delta = response.context['delta']
+        self.assertEqual(delta['added'], [])
+        self.assertEqual(delta['removed'], [])
+        self.assertEqual(delta['changed'], [{'name': 'Project', 'changes': ['attribute Budget added']}])
+        # the merge into the changed table is asked again, the other decisions carry over
+        self.assertEqual(delta['dropped_decisions'], ['Propose: merged into Project'])
+        self.assertEqual(len(delta['carried_decisions']), 3)
+        self.assertEqual(delta['tables'], {'added': [], 'removed': [], 'changed': ['Project'], 'unchanged': 8})
+
+        expected = json.loads(read_sample('full_sample_second_choices.json'))
+        expected['Project']['attributes']['Budget'] = {'type': 'number'}
+        self.assertEqual(schema, expected)
+        self.assertEqual(json.loads(self.client.get('/hello/delta').content), delta)
+
+
+@override_settings(JOB_MIN_OBJECTS=5, OFFLOAD_MIN_BYTES=None)
+class ConversionJobTest(ConversionFlowTestCase):
+
+    def test_job_result_is_only_shown_to_its_session(self):
+        # a renamed object, so the conversion is not already cached by another test
+        content = read_sample('full_sample.xml').replace('name="Customer"', 'name="Client"')
+        response = self.convert(content)
+        self.assertIn('conversion_job.html', get_template_names(response))
+        job_id = response.context['job_id']
+        self.assertIn(reverse('job_status', args=[job_id]), response.content)
+        self.assertIn(reverse('job_display', args=[job_id]), response.content)
+        for i in range(100):
+            if json.loads(self.client.get('/hello/jobs/' + job_id).content)['status'] in ['done', 'failed']:
+                break
+            time.sleep(0.1)
+
+        other_client = Client()
+        other_client.post('/hello/upload', {
+            'er_file': SimpleUploadedFile('diagram.xml', content, content_type='text/xml')
+        })
+        response = other_client.get('/hello/jobs/' + job_id + '/view')
+        self.assertIn('upload.html', get_template_names(response))
+        self.assertEqual(response.context['uploaded_file_error'], 'The conversion is not found.')
+        self.assertIsNone(get_workspace_store().get(other_client.session['workspace_id']).output_key)
+
+        self.assertIn('Client', self.assertResult(self.client.get('/hello/jobs/' + job_id + '/view')))
+        self.assertEqual(self.get_workspace().output_key, job_id)
+
+
+@override_settings(OFFLOAD_MIN_BYTES=None)
+class UploadedFileTest(ConversionFlowTestCase):
+
+    def test_single_line_upload_is_paged(self):
+        # serialized without line breaks, with names of two byte characters so pages may end inside one
+        content = etree.tostring(generate_diagram(entities=300), encoding='utf-8').replace('Entity', 'Entit\xc3\xa9')
+        self.assertNotIn('\n', content)
+        self.assertGreater(len(content), 2 * UPLOADED_FILE_PAGE_BYTES)
+        self.upload(content)
+
+        url = '/hello/uploaded_file/' + self.client.session['workspace_id']
+        page_count = int(self.client.get(url, {'page': '0'})['X-Page-Count'])
+        self.assertEqual(page_count, (len(content) + UPLOADED_FILE_PAGE_BYTES - 1) // UPLOADED_FILE_PAGE_BYTES)
+        pages = [self.client.get(url, {'page': str(page)}).content for page in range(page_count)]
+        for page in pages:
+            self.assertLessEqual(len(page), UPLOADED_FILE_PAGE_BYTES)
+            page.decode('utf-8')
+        self.assertEqual(''.join(pages), content)
+        self.assertEqual(self.client.get(url, {'page': str(page_count)}).status_code, 404)
+
+
+class SchemaPermalinkTest(ConversionFlowTestCase):
+
+    def test_compressed_schema_and_not_modified(self):
+        output_key = self.convert(read_sample('full_sample.xml')).context['output_key']
+        url = '/hello/schemas/' + output_key + '.json'
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertIsNone(get_conversion_cache().get(output_key + '.gzip'))
+
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_schema_is_found_by_other_processes(self):
+        cache_dir = tempfile.mkdtemp()
+        try:
+            with self.settings(CONVERSION_CACHE_DIR=cache_dir):
+                response = self.convert(read_sample('full_sample.xml'))
+                # a process with nothing in memory reads the conversion from the shared directory
+                self.assertEqual(ConversionCache(directory=cache_dir).get(response.context['output_key']),
+                                 response.context['output_json'])
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_unknown_schema_is_not_found_with_its_etag(self):
+        output_key = '0' * 40
+        response = self.client.get('/hello/schemas/' + output_key + '.json', HTTP_IF_NONE_MATCH='"' + output_key + '"')
+        self.assertEqual(response.status_code, 404)
+
+
+class InstrumentationTest(TestCase):
+
+    def test_validation_is_timed_once(self):
+        diagram = compile_diagram(parse_xml(read_sample('full_sample.xml')))
+        count = get_histogram('validate').snapshot()[1]
+        discover_decisions(diagram)
+        self.assertEqual(get_histogram('validate').snapshot()[1], count + 1)
+
+
+class OffloadedUploadTest(ConversionFlowTestCase):
+    """
+    Uploads checked in a worker process, which reads them from a file
+    """
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def check_uploads(self):
+        response = self.upload(read_sample('full_sample.xml'))
+        self.assertIn('display_uploaded_file.html', get_template_names(response))
+        response = self.upload(read_sample('sample_missing_key.xml'))
+        self.assertIn('Office has no primary key', response.context['uploaded_file_error'])
+        self.assertEqual(os.listdir(self.temp_dir), [])
+
+    def test_upload_in_memory(self):
+        with self.settings(OFFLOAD_MIN_BYTES=0, FILE_UPLOAD_TEMP_DIR=self.temp_dir):
+            self.check_uploads()
+
+    def test_upload_in_temporary_file(self):
+        with self.settings(OFFLOAD_MIN_BYTES=0, FILE_UPLOAD_TEMP_DIR=self.temp_dir, FILE_UPLOAD_MAX_MEMORY_SIZE=0):
+            self.check_uploads()
@@ -8,9 +8,20 @@ urlpatterns = [
     url(r'^user_manual$', views.user_manual, name='user_manual'),
     url(r'^documentation$', views.documentation, name='documentation'),
     url(r'^upload$', views.upload, name='upload'),
+    url(r'^upload_version$', views.upload_version, name='upload_version'),
+    url(r'^delta$', views.version_delta, name='version_delta'),
     url(r'^generate$', views.generate, name='generate'),
+    url(r'^uploaded_file/(?P<workspace_id>[0-9a-f]{32})$', views.uploaded_file, name='uploaded_file'),
     url(r'^choose_key$', views.choose_key, name='choose_key'),
     url(r'^choose_merge$', views.choose_merge, name='choose_merge'),
     url(r'^proceed_next$', views.proceed_next, name='proceed_next'),
+    url(r'^change_decisions$', views.change_decisions, name='change_decisions'),
     url(r'^download$', views.download, name='download'),
+    url(r'^schemas/(?P<output_key>[0-9a-f]{40})\.json$', views.schema, name='schema'),
+    url(r'^api/convert$', views.api_convert, name='api_convert'),
+    url(r'^metrics$', views.metrics, name='metrics'),
+    url(r'^api/jobs$', views.api_submit_job, name='api_submit_job'),
+    url(r'^jobs/(?P<job_id>[0-9a-f]{40})$', views.job_status, name='job_status'),
+    url(r'^jobs/(?P<job_id>[0-9a-f]{40})/result$', views.job_result, name='job_result'),
+    url(r'^jobs/(?P<job_id>[0-9a-f]{40})/view$', views.job_display, name='job_display'),
 ]
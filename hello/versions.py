@@ -0,0 +1,226 @@
+import json
+
+from model import Entity
+from workspace import create_session_workspace, save_workspace, OP_PRIMARY_KEY, OP_MERGE
+
+"""
+versions.py
+new versions of an uploaded diagram: the objects of the new upload are compared with the previous one by name,
+the decisions on unchanged objects carry over and only the tables affected by the changes are converted again
+(see get_previous_tables in converter.py). Attributes are compared by name, references by the name of the object
+they refer to, so renumbered ids are no change.
+"""
+
+
+def diff_diagrams(previous_diagram, diagram):
+    """
+    Structural difference of two compiled diagrams
+    :param previous_diagram: Diagram of the previous version
+    :param diagram: Diagram of the new version
+    :return: dict with the names of the added and removed objects, the changed ones each with its changes
+    in words, and the number of unchanged objects
+    """
+    previous_descriptions = describe_objects(previous_diagram)
+    descriptions = describe_objects(diagram)
+    changed = []
+    for name in diagram.names:
+        if name in previous_descriptions:
+            changes = get_object_changes(previous_descriptions[name], descriptions[name])
+            if len(changes) > 0:
+                changed.append({'name': name, 'changes': changes})
+
+    added = [name for name in diagram.names if name not in previous_descriptions]
+    return {
+        'added': added,
+        'removed': [name for name in previous_diagram.names if name not in descriptions],
+        'changed': changed,
+        'unchanged': len(diagram.names) - len(added) - len(changed)
+    }
+
+
+def describe_objects(diagram):
+    """
+    :return: dict of object name -> description of everything its table is converted from, ids left out
+    """
+    descriptions = {}
+    for name, diagram_object in diagram.objects.items():
+        labels = get_attribute_labels(diagram_object, diagram)
+        descriptions[name] = {
+            'kind': 'entity' if isinstance(diagram_object, Entity) else 'relationship',
+            'attributes': dict((labels[attribute.id], (attribute.type, attribute.min_participation,
+                                                       attribute.max_participation))
+                               for attribute in diagram_object.attributes.values()),
+            'keys': [tuple(labels[attribute.id] for attribute in key) for key in diagram_object.keys],
+            'unique_keys': [tuple(labels[attribute.id] for attribute in key) for key in diagram_object.unique_keys],
+            'decided': (diagram_object.checked, diagram_object.merged)
+        }
+    return descriptions
+
+
+def get_attribute_labels(diagram_object, diagram):
+    """
+    Name attributes independently of their ids: a column by its name, a reference by the object it refers to
+    :return: dict of attribute id -> label, unique within the object
+    """
+    labels = {}
+    for attribute in sorted(diagram_object.attributes.values(), key=get_attribute_order):
+        if attribute.name is not None:
+            label = attribute.name
+        elif attribute.entity_id in diagram.entities:
+            label = diagram.entities[attribute.entity_id].name + ' (reference)'
+        elif attribute.relation_id in diagram.relationships:
+            label = diagram.relationships[attribute.relation_id].name + ' (reference)'
+        else:
+            label = '#' + attribute.id
+        # e.g. both ends of a recursive relationship refer to the same entity
+        unique_label = label
+        count = 1
+        while unique_label in labels.values():
+            count += 1
+            unique_label = label + ' ' + str(count)
+        labels[attribute.id] = unique_label
+    return labels
+
+
+def get_attribute_order(attribute):
+    # numeric ids in numeric order, then any others
+    return (0, int(attribute.id), '') if attribute.id.isdigit() else (1, 0, attribute.id)
+
+
+def get_object_changes(previous, description):
+    """
+    Changes between two descriptions of the same object, see describe_objects
+    :return: list of changes in words, empty when the object is unchanged
+    """
+    changes = []
+    if previous['kind'] != description['kind']:
+        changes.append('changed from ' + previous['kind'] + ' to ' + description['kind'])
+
+    previous_attributes = previous['attributes']
+    attributes = description['attributes']
+    for label in sorted(attributes):
+        if label not in previous_attributes:
+            changes.append('attribute ' + label + ' added')
+        elif attributes[label] != previous_attributes[label]:
+            changes.append('attribute ' + label + ' changed')
+    for label in sorted(previous_attributes):
+        if label not in attributes:
+            changes.append('attribute ' + label + ' removed')
+
+    for field, kind in [('keys', 'key'), ('unique_keys', 'unique key')]:
+        for key in description[field]:
+            if key not in previous[field]:
+                changes.append(kind + ' ' + format_key(key) + ' added')
+        for key in previous[field]:
+            if key not in description[field]:
+                changes.append(kind + ' ' + format_key(key) + ' removed')
+    # a primary key decision is the position of the chosen key
+    if len(changes) == 0 and previous['keys'] != description['keys']:
+        changes.append('keys reordered')
+
+    if previous['decided'] != description['decided']:
+        changes.append('merge decision of the upload changed')
+    return changes
+
+
+def format_key(key):
+    return '(' + ', '.join(key) + ')'
+
+
+def get_changed_names(delta):
+    """
+    :return: set of names of the objects added, removed or changed by a new version
+    """
+    return set(delta['added']) | set(delta['removed']) | set(change['name'] for change in delta['changed'])
+
+
+def get_decision_names(operation):
+    """
+    :return: names of the objects a logged decision applies to, see workspace.py
+    """
+    if operation[0] == OP_PRIMARY_KEY:
+        return {operation[1]}
+    elif operation[0] == OP_MERGE:
+        return {operation[2], operation[3]}
+    return set()
+
+
+def split_decision_log(decision_log, changed_names):
+    """
+    Split the decision log of the previous version into the decisions on unchanged objects only,
+    replayed on the new version in the same order, and the others, which have to be made again
+    :return: (carried decision log, dropped decision log)
+    """
+    carried = []
+    dropped = []
+    for operation in decision_log:
+        if len(get_decision_names(operation) & changed_names) > 0:
+            dropped.append(operation)
+        else:
+            carried.append(operation)
+    return carried, dropped
+
+
+def describe_decision(operation, diagram):
+    """
+    A logged decision in words, e.g. "Office: primary key (Name, Address)"
+    :param diagram: Diagram of the version the decision was made on
+    """
+    if operation[0] == OP_PRIMARY_KEY:
+        keys = diagram.objects[operation[1]].keys if operation[1] in diagram.objects else []
+        option = int(operation[2])
+        if option < len(keys):
+            labels = get_attribute_labels(diagram.objects[operation[1]], diagram)
+            return operation[1] + ': primary key ' + format_key([labels[attribute.id] for attribute in keys[option]])
+        return operation[1] + ': primary key option ' + operation[2]
+    if operation[1] == '0':
+        return operation[2] + ': not merged'
+    return operation[2] + ': merged into ' + operation[3]
+
+
+def create_version_workspace(request, previous_workspace, content, previous_diagram, diagram):
+    """
+    Start the workspace of a new version of the session's diagram, with the decisions that carry over
+    :param previous_workspace: workspace of the previous version
+    :param content: uploaded XML of the new version
+    :param previous_diagram: Diagram of the previous upload, before any decision
+    :param diagram: Diagram of the new upload
+    :return: Workspace, now the current one of the session
+    """
+    delta = diff_diagrams(previous_diagram, diagram)
+    changed_names = get_changed_names(delta)
+    carried, dropped = split_decision_log(previous_workspace.decision_log, changed_names)
+    delta['carried_decisions'] = [describe_decision(operation, previous_diagram) for operation in carried]
+    delta['dropped_decisions'] = [describe_decision(operation, previous_diagram) for operation in dropped]
+
+    # a table decided differently than before is as stale as a changed one
+    for operation in dropped:
+        changed_names |= get_decision_names(operation)
+
+    workspace = create_session_workspace(request, [content])
+    workspace.decision_log = carried
+    workspace.base_key = previous_workspace.output_key
+    workspace.stale_names = sorted(changed_names)
+    workspace.delta = delta
+    save_workspace(workspace)
+    return workspace
+
+
+def get_table_delta(previous_json, output_json):
+    """
+    Compare the tables of the previous version's JSON Schema with the new one
+    :return: dict with the names of the added, removed and changed tables and the number of unchanged ones,
+    None when the previous schema is not known
+    """
+    if previous_json is None:
+        return None
+    previous_tables = json.loads(previous_json)
+    tables = json.loads(output_json)
+    changed = sorted(name for name in tables if name in previous_tables and tables[name] != previous_tables[name])
+    added = sorted(name for name in tables if name not in previous_tables)
+    return {
+        'added': added,
+        'removed': sorted(name for name in previous_tables if name not in tables),
+        'changed': changed,
+        'unchanged': len(tables) - len(added) - len(changed)
+    }
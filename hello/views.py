@@ -1,14 +1,50 @@
 from django.shortcuts import render, redirect
 from django.conf import settings
+import json
+import logging
+import re
 import textwrap
-
-from converter import convert_xml_to_json
-from converter import update_primary_key_in_xml, merge_relationship_in_xml, validate_xml
+import zlib
+
+from converter import convert_xml_to_json, convert_diagram, compile_diagram, discover_decisions
+from converter import validate_xml, apply_decision_map, check_decision_map
+from converter import DiagramError, compile_diagram_from_stream, convert_tree, apply_decision_log
+from converter import parse_xml, validate_tree, check_diagram
+from converter import is_large_diagram, submit_conversion_job, render_result, render_error_message, dumps_schema
+from converter import prompt_decisions, SESSION_JOB_IDS
+from converter import get_offloaded_content, is_offloaded_upload, convert_in_worker, check_upload_in_worker
+from cache import get_conversion_cache, get_table_cache, get_diagram_cache, get_encoded_schema_cache, get_cache_key
+from workspace import create_session_workspace, get_session_workspace, save_workspace, get_decided_name
+from workspace import OP_PRIMARY_KEY, OP_MERGE
+from versions import create_version_workspace
+from instrumentation import timed, format_metrics
+from json_writer import iter_schema_json
+from jobs import get_job_state, get_job_result, STATUS_DONE, STATUS_FAILED
 
 import lxml.etree as etree
-from django.http import HttpResponse
+from django.core.urlresolvers import reverse
+from django.http import HttpResponse, HttpResponseNotModified, JsonResponse, StreamingHttpResponse, Http404
+from django.utils.cache import patch_vary_headers
+from django.utils.text import compress_string
+from django.views.decorators.cache import cache_control
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import etag, require_GET, require_safe
 from django.views.generic.base import View
 
+logger = logging.getLogger(__name__)
+
+# bytes of the uploaded XML sent per page of the viewer, the XML may well be a single line
+UPLOADED_FILE_PAGE_BYTES = 64 * 1024
+# an upload never changes once stored in its workspace, so it can be cached for as long as the workspace lives
+UPLOADED_FILE_MAX_AGE = 24 * 60 * 60
+# a schema permalink is named by the hash of the decided diagram, so its content never changes
+SCHEMA_MAX_AGE = 365 * 24 * 60 * 60
+# content encodings of schema permalinks, in order of preference
+SCHEMA_ENCODINGS = [
+    ('gzip', re.compile(r'\bgzip\b'), compress_string),
+    ('deflate', re.compile(r'\bdeflate\b'), zlib.compress),
+]
+
 
 class HomePageView(View):
     # TODO: allow user to edit XML raw file
@@ -39,13 +75,40 @@ def documentation(request):
     return render(request, 'documentation.html', {})
 
 def download(request):
-    if request.method == 'POST' and request.session.get('output_json'):
-        output_json = request.session.get('output_json')
-        response = HttpResponse(output_json, content_type='application/json')
+    workspace = get_session_workspace(request)
+    if request.method == 'POST' and workspace is not None and workspace.output_key is not None:
+        compact = request.POST.get('compact', None) == '1'
+        output_json = None if compact else get_conversion_cache().get(workspace.output_key)
+        processed_tables = None
+        if output_json is None:
+            processed_tables = get_table_cache().get(workspace.output_key)
+        if output_json is None and processed_tables is None:
+            # evicted from the cache or converted in a worker process,
+            # convert again from the upload and the decision log
+            try:
+                tree = get_current_tree(workspace)
+                content = get_offloaded_content(tree)
+                if content is not None:
+                    output_json = convert_in_worker(content, compact)[2]
+                else:
+                    processed_tables = convert_diagram(compile_diagram(tree))
+            except Exception:
+                output_json = processed_tables = None
+            if output_json is None and processed_tables is None:
+                return render(request, 'upload.html', {
+                    'uploaded_file_error': "Unable to regenerate the JSON Schema."
+                })
+
+        if output_json is not None:
+            response = HttpResponse(output_json, content_type='application/json')
+        else:
+            # stream table by table, the schema is never built as one string
+            response = StreamingHttpResponse(iter_schema_json(processed_tables, compact),
+                                             content_type='application/json')
         response['Content-Disposition'] = 'attachment; filename=export.json'
         return response
     else:
-        print "invalid request"
+        logger.info("invalid download request")
         uploaded_file_error = "Invalid Request!"
         return render(request, 'upload.html', {
             'uploaded_file_error': uploaded_file_error
@@ -60,66 +123,195 @@ def upload(request):
     """
     if request.method == 'POST' and request.FILES['er_file']:
         er_file = request.FILES['er_file']
-        filetypes = er_file.content_type.split('/')
-        filetype = '';
-        if len(filetypes) == 2:
-            filetype = filetypes[1]
-
-        print filetype
-        if  not filetype or "XML" != filetype.upper():
-            uploaded_file_error = "Uploaded file type is not supported."
+        diagram, uploaded_file_error = check_uploaded_file(er_file)
+        if uploaded_file_error is not None:
             return render(request, 'upload.html', {
                 'uploaded_file_error': uploaded_file_error
             })
 
-        try: 
-            er_tree = etree.parse(er_file)
-            file_content = etree.tostring(er_tree, pretty_print=True)
+        er_file.seek(0)
+        workspace = create_session_workspace(request, er_file.chunks())
+        if diagram is not None:
+            get_diagram_cache().set(workspace.id, diagram)
 
-        except Exception:
-           return render(request, 'upload.html', {
-                'uploaded_file_error': "The uploaded xml is invalid."
-            }) 
-
-        request.session['xmlContent'] = file_content
-        request.session.save()
-
-        print "upload successful >>>"
+        logger.info("upload successful, %d bytes", er_file.size)
         return render(request, 'display_uploaded_file.html', {
-            'uploaded_file_content': file_content
+            'workspace_id': workspace.id
         })
     return render(request, 'upload.html')
 
 
+def check_uploaded_file(er_file):
+    """
+    Check the type and size of an uploaded ER diagram and whether it is valid
+    :param er_file: UploadedFile
+    :return: (Diagram compiled while streaming or None when checked in a worker process,
+    error message or None when the upload can be converted)
+    """
+    filetypes = er_file.content_type.split('/')
+    filetype = '';
+    if len(filetypes) == 2:
+        filetype = filetypes[1]
+
+    logger.debug("uploaded file type %s", filetype)
+    if  not filetype or "XML" != filetype.upper():
+        return None, "Uploaded file type is not supported."
+
+    if er_file.size > settings.ER_MAX_UPLOAD_SIZE:
+        return None, "Uploaded file is larger than " + str(settings.ER_MAX_UPLOAD_SIZE) + " bytes."
+
+    diagram = None
+    try:
+        if is_offloaded_upload(er_file.size):
+            # validated in a worker process, this thread waits without holding the GIL
+            check_upload_in_worker(er_file)
+        else:
+            # validate while streaming, the tree is never held in memory as a whole
+            diagram = compile_diagram_from_stream(er_file)
+            check_diagram(diagram)
+    except DiagramError as e:
+        return None, str(e)
+    except Exception:
+        return None, "The uploaded xml is invalid."
+    return diagram, None
+
+
+def upload_version(request):
+    """
+    Upload a new version of the session's diagram. It is compared with the previous version, decisions on
+    unchanged tables carry over and only the tables affected by the changes are converted again.
+    :param request:
+    :return: result with the differences from the previous version, or the decisions still to make
+    """
+    previous_workspace = get_session_workspace(request)
+    if request.method != 'POST' or previous_workspace is None or not request.FILES.get('er_file'):
+        return render(request, 'upload.html', {
+            'uploaded_file_error': "The previous version is not found."
+        })
+
+    er_file = request.FILES['er_file']
+    uploaded_file_error = check_uploaded_file(er_file)[1]
+    if uploaded_file_error is not None:
+        return render(request, 'upload.html', {
+            'uploaded_file_error': uploaded_file_error
+        })
+
+    er_file.seek(0)
+    file_content = er_file.read()
+    try:
+        with timed('parse'):
+            previous_tree = parse_xml(previous_workspace.get_content())
+            tree = parse_xml(file_content)
+        workspace = create_version_workspace(request, previous_workspace, file_content,
+                                             compile_diagram(previous_tree), compile_diagram(tree))
+    except DiagramError as e:
+        return render_error_message(request, str(e))
+    except Exception:
+        return render_error_message(request, 'Unexpected error occurred!')
+
+    logger.info("version uploaded, %d bytes, %d decisions carried over", len(file_content),
+                len(workspace.decision_log))
+    # the tables of the previous version are reused for the unchanged objects, see get_previous_tables
+    return validate_xml(request, get_current_tree(workspace), set())
+
+
+def version_delta(request):
+    """
+    Differences of the session's diagram from its previous version as JSON, see versions.py
+    :param request:
+    :return:
+    """
+    workspace = get_session_workspace(request)
+    if workspace is None or workspace.delta is None:
+        return JsonResponse({'status': 'error', 'errors': ['The diagram has no previous version.']}, status=404)
+    response = JsonResponse(workspace.delta)
+    response['Content-Disposition'] = 'attachment; filename=delta.json'
+    return response
+
+
 def generate(request):
     """
     User click generate button
     :param request:
     :return:
     """
-    if request.method == 'POST' and request.session.get('xmlContent'):
-        xml_content = request.session.get('xmlContent')
+    workspace = get_session_workspace(request)
+    if request.method == 'POST' and workspace is not None:
         return render(request, 'display_uploaded_file.html', {
-            'uploaded_file_content': xml_content
+            'workspace_id': workspace.id
         })
     else:
-        print "generate failed >>>"
+        logger.info("generate failed, no upload in session")
         uploaded_file_error = "Uploaded file is not found."
         return render(request, 'upload.html', {
             'uploaded_file_error': uploaded_file_error
         })
 
 
+def get_uploaded_file_etag(request, workspace_id):
+    # the page size is part of the tag, so pages cached with another size are not taken for these
+    return workspace_id + '-' + request.GET.get('page', 'all') + '-' + str(UPLOADED_FILE_PAGE_BYTES)
+
+
+@require_GET
+@cache_control(private=True, max_age=UPLOADED_FILE_MAX_AGE)
+@etag(get_uploaded_file_etag)
+def uploaded_file(request, workspace_id):
+    """
+    Uploaded XML of the session's workspace, either whole or one page of about UPLOADED_FILE_PAGE_BYTES
+    at a time (?page=0, 1, ...) with the number of pages in the X-Page-Count header. The workspace id is
+    in the URL and the upload never changes, so the ETag needs no hash of the content.
+    :param request:
+    :param workspace_id:
+    :return:
+    """
+    workspace = get_session_workspace(request)
+    if workspace is None or workspace.id != workspace_id:
+        raise Http404
+    content = workspace.get_content()
+    page = request.GET.get('page', None)
+    if page is None:
+        return HttpResponse(content, content_type='application/xml')
+
+    page_count = max(1, (len(content) + UPLOADED_FILE_PAGE_BYTES - 1) // UPLOADED_FILE_PAGE_BYTES)
+    if not page.isdigit() or int(page) >= page_count:
+        raise Http404
+    start = get_page_offset(content, int(page) * UPLOADED_FILE_PAGE_BYTES)
+    end = get_page_offset(content, (int(page) + 1) * UPLOADED_FILE_PAGE_BYTES)
+    response = HttpResponse(content[start:end], content_type='text/plain; charset=utf-8')
+    response['X-Page-Count'] = str(page_count)
+    return response
+
+
+def get_page_offset(content, offset):
+    """
+    Byte offset where a page of the uploaded XML starts, moved back so a UTF-8 character is not split
+    between two pages
+    """
+    while 0 < offset < len(content) and ord(content[offset]) & 0xC0 == 0x80:
+        offset -= 1
+    return offset
+
+
 def choose_key(request):
     """
     Prompt user to choose primary key
     :param request:
     :return:
     """
-    if request.method == 'POST' and request.session.get('xmlContent'):
-        xml_content = request.session.get('xmlContent')
-        xml_file = etree.fromstring(xml_content)
-        return validate_xml(request, xml_file)
+    workspace = get_session_workspace(request)
+    if request.method == 'POST' and workspace is not None:
+        # nothing has been decided yet, so the diagram compiled while the upload was streamed is still current
+        # and the decisions are found without parsing the upload
+        diagram = get_diagram_cache().get(workspace.id) if len(workspace.decision_log) == 0 else None
+        if diagram is not None:
+            try:
+                key_choices, merge_choices = discover_decisions(diagram)
+            except DiagramError as e:
+                return render_error_message(request, str(e))
+            if len(key_choices) > 0 or len(merge_choices) > 0:
+                return prompt_decisions(request, key_choices, merge_choices)
+        return validate_xml(request, get_current_tree(workspace))
 
         # return render(request, 'choose_key.html', {
         #     'uploaded_file_content': "test" + etree.tostring(xmlFile, pretty_print = True)
@@ -137,10 +329,9 @@ def choose_merge(request):
     :param request:
     :return:
     """
-    if request.method == 'POST' and request.session.get('xmlContent'):
-        xml_content = request.session.get('xmlContent')
-        xml_file = etree.fromstring(xml_content)
-        return convert_xml_to_json(request, xml_file)
+    workspace = get_session_workspace(request)
+    if request.method == 'POST' and workspace is not None:
+        return convert_xml_to_json(request, get_current_tree(workspace))
 
         # return render(request, 'choose_key.html', {
         #     'uploaded_file_content': "test" + etree.tostring(xmlFile, pretty_print = True)
@@ -159,38 +350,25 @@ def proceed_next(request):
     :param request:
     :return:
     """
-    if request.method == 'POST' and request.session.get('xmlContent'):
-        xml_content = request.session.get('xmlContent')
-        tree = etree.fromstring(xml_content)
-
-        table_name = request.POST.get('tableName', None)
-        table_primary_key = request.POST.get('primaryKeyOption', -1)
-
-        merge_table = request.POST.get('merge_table', -1)
-        merge_from = request.POST.get('merge_from', None)
-        merge_to = request.POST.get('merge_to', None)
-
-        if table_primary_key != -1 and table_name is not None:
+    workspace = get_session_workspace(request)
+    if request.method == 'POST' and workspace is not None:
+        if request.POST.get('decisions', None) is not None:
             """
-            update primary keys in xml
+            apply all key and merge decisions in xml at once
             """
-            tree = update_primary_key_in_xml(tree, table_name, table_primary_key)
-            file_content = etree.tostring(tree, pretty_print=True)
-
-            request.session['xmlContent'] = file_content
-            request.session.save()
-            return validate_xml(request, tree)
-
-        elif merge_table != -1 and merge_from is not None and merge_to is not None:
-            """
-            merge relationship in xml
-            """
-            tree = merge_relationship_in_xml(tree, merge_table, merge_from, merge_to)
-            file_content = etree.tostring(tree, pretty_print=True)
-
-            request.session['xmlContent'] = file_content
-            request.session.save()
-            return validate_xml(request, tree)
+            try:
+                # checked against the upload, the log is replayed on it
+                key_decisions, merge_decisions = check_decision_map(get_upload_diagram(workspace),
+                                                                    get_decisions_from_post(request.POST))
+            except DiagramError as e:
+                return prompt_decisions_again(request, workspace, str(e))
+            # replayed from the upload, so a decision made again replaces the earlier one instead of adding to it
+            changed_names = record_changed_decisions(workspace, key_decisions, merge_decisions)
+            try:
+                tree = get_current_tree(workspace)
+            except (DiagramError, ValueError) as e:
+                return render_error_message(request, str(e))
+            return validate_xml(request, tree, changed_names)
 
         else:
             # TODO(UI): add an error page and allow restart
@@ -206,3 +384,435 @@ def proceed_next(request):
         return render(request, 'upload.html', {
             "uploaded_file_error": "Unable to update primary key"
         })
+
+
+def change_decisions(request):
+    """
+    Change the key and merge decisions of a converted diagram. The form shows every choice of the upload with
+    the current answers; only the tables of the changed decisions and the tables depending on them are
+    converted again, the others are reused from the last result.
+    :param request:
+    :return:
+    """
+    workspace = get_session_workspace(request)
+    if workspace is None or workspace.output_key is None:
+        return render(request, 'upload.html', {
+            'uploaded_file_error': "The converted diagram is not found."
+        })
+
+    diagram = get_upload_diagram(workspace)
+    if request.method != 'POST':
+        try:
+            key_choices, merge_choices = discover_decisions(diagram)
+        except DiagramError as e:
+            return render_error_message(request, str(e))
+        logged = dict(((operation[0], get_decided_name(operation)), operation) for operation in workspace.decision_log)
+        for key_choice in key_choices:
+            operation = logged.get((OP_PRIMARY_KEY, key_choice['table_name']))
+            key_choice['chosen'] = int(operation[2]) if operation is not None else 0
+        for merge_choice in merge_choices:
+            operation = logged.get((OP_MERGE, merge_choice['merge_from']))
+            merge_choice['merged'] = operation is not None and operation[1] == '1'
+        return render(request, 'choose_decisions.html', {
+            'workspace_id': workspace.id,
+            'key_choices': key_choices,
+            'merge_choices': merge_choices,
+            'form_action': 'change_decisions'
+        })
+
+    try:
+        key_decisions, merge_decisions = check_decision_map(diagram, get_decisions_from_post(request.POST))
+    except DiagramError as e:
+        return render_error_message(request, str(e))
+    changed_names = record_changed_decisions(workspace, key_decisions, merge_decisions)
+    try:
+        tree = get_current_tree(workspace)
+    except (DiagramError, ValueError) as e:
+        return render_error_message(request, str(e))
+    return validate_xml(request, tree, changed_names)
+
+
+def record_changed_decisions(workspace, key_decisions, merge_decisions):
+    """
+    Log and save the decisions that differ from the logged ones
+    :param key_decisions: see Workspace.record_decisions
+    :param merge_decisions: see Workspace.record_decisions
+    :return: names of the tables they change, only these and the tables depending on them are converted again
+    """
+    key_decisions = dict((table_name, primary_key_option) for table_name, primary_key_option in key_decisions.items()
+                         if [OP_PRIMARY_KEY, table_name, str(primary_key_option)] not in workspace.decision_log)
+    merge_decisions = [merge_decision for merge_decision in merge_decisions
+                       if [OP_MERGE] + list(merge_decision) not in workspace.decision_log]
+    workspace.record_decisions(key_decisions, merge_decisions)
+    save_workspace(workspace)
+
+    changed_names = set(key_decisions.keys())
+    for merge_table, merge_from, merge_to in merge_decisions:
+        changed_names.add(merge_from)
+        changed_names.add(merge_to)
+    return changed_names
+
+
+def get_current_tree(workspace):
+    """
+    Rebuild the diagram of a workspace: the upload with every logged decision applied
+    """
+    with timed('parse'):
+        tree = parse_xml(workspace.get_content())
+    return apply_decision_log(tree, workspace.decision_log)
+
+
+def get_upload_diagram(workspace):
+    """
+    Diagram of a workspace's upload before any decision, the one compiled while it was streamed when still cached
+    """
+    diagram = get_diagram_cache().get(workspace.id)
+    if diagram is None:
+        with timed('parse'):
+            tree = parse_xml(workspace.get_content())
+        diagram = compile_diagram(tree)
+    return diagram
+
+
+def prompt_decisions_again(request, workspace, error):
+    """
+    Show the decisions form of the current diagram again with an error message
+    """
+    try:
+        key_choices, merge_choices = discover_decisions(compile_diagram(get_current_tree(workspace)))
+    except (DiagramError, ValueError) as e:
+        return render_error_message(request, str(e))
+    return prompt_decisions(request, key_choices, merge_choices, error)
+
+
+def get_decisions_from_post(post):
+    """
+    Read the answers of the decisions form. The table a relationship is merged into is not part of the form,
+    it is worked out from the diagram, see check_decision_map.
+    :param post: request.POST
+    :return: decision map, see apply_decision_map
+    """
+    decision_map = {'primary_keys': {}, 'merges': {}}
+    for field, value in post.items():
+        if field.startswith('primaryKeyOption_'):
+            decision_map['primary_keys'][field[len('primaryKeyOption_'):]] = value
+        elif field.startswith('merge_table_'):
+            decision_map['merges'][field[len('merge_table_'):]] = value
+    return decision_map
+
+
+@csrf_exempt
+def api_convert(request):
+    """
+    Stateless conversion for scripts: POST the ER XML with an optional decision map, get the JSON Schema back.
+    Accepts either a JSON body {"xml": "...", "decisions": {...}} or a form with er_file (or xml) and decisions.
+    Decisions look like {"primary_keys": {"Office": 1}, "merges": {"WorkIn": true}}.
+    :param request:
+    :return: JSON with status "ok" and the schema, "unresolved" and the pending decisions, or "error"
+    """
+    if request.method != 'POST':
+        return JsonResponse({'status': 'error', 'errors': ['Only POST is supported.']}, status=405)
+    tree, decision_map, error_response = read_api_request(request)
+    if error_response is not None:
+        return error_response
+
+    try:
+        if len(decision_map) > 0:
+            tree = apply_decision_map(tree, compile_diagram(tree), decision_map)
+        cache_key = get_cache_key(tree)
+        output_json = get_conversion_cache().get(cache_key)
+        if output_json is None:
+            content = get_offloaded_content(tree)
+            if content is not None:
+                key_choices, merge_choices, output_json = convert_in_worker(content)
+            else:
+                diagram = compile_diagram(tree)
+                key_choices, merge_choices = discover_decisions(diagram)
+            if len(key_choices) > 0 or len(merge_choices) > 0:
+                return JsonResponse({
+                    'status': 'unresolved',
+                    'decisions': get_api_decisions(key_choices, merge_choices)
+                })
+            if output_json is None:
+                processed_tables = convert_diagram(diagram)
+                with timed('serialize'):
+                    output_json = dumps_schema(processed_tables)
+            get_conversion_cache().set(cache_key, output_json)
+    except DiagramError as e:
+        return JsonResponse({'status': 'error', 'errors': e.problems}, status=400)
+    except Exception:
+        return JsonResponse({'status': 'error', 'errors': ['Unexpected error occurred!']}, status=500)
+
+    # the cached schema is already serialized, so it is embedded as is
+    return HttpResponse('{"status": "ok", "schema_url": ' + json.dumps(reverse('schema', args=[cache_key])) +
+                        ', "schema": ' + output_json + '}', content_type='application/json')
+
+
+def read_api_request(request):
+    """
+    Read the ER XML and the decision map of an API request
+    :return: (tree, decision map, None), or (None, None, error response)
+    """
+    try:
+        if request.content_type == 'application/json':
+            body = json.loads(request.body)
+            if not isinstance(body, dict):
+                return None, None, JsonResponse({'status': 'error', 'errors': ['The request has to be a JSON object.']},
+                                                status=400)
+            xml_content = body.get('xml', None)
+            decision_map = body.get('decisions', None) or {}
+        else:
+            xml_content = request.FILES['er_file'].read() if 'er_file' in request.FILES else request.POST.get('xml')
+            decision_map = json.loads(request.POST.get('decisions', None) or '{}')
+        if not xml_content:
+            return None, None, JsonResponse({'status': 'error', 'errors': ['No ER XML is provided.']}, status=400)
+        errors = get_request_errors(xml_content, decision_map)
+        if len(errors) > 0:
+            return None, None, JsonResponse({'status': 'error', 'errors': errors}, status=400)
+        if len(xml_content) > settings.ER_MAX_UPLOAD_SIZE:
+            return None, None, JsonResponse({'status': 'error', 'errors': ['The uploaded xml is too large.']},
+                                            status=413)
+        if isinstance(xml_content, unicode):
+            xml_content = xml_content.encode('utf-8')
+        with timed('parse'):
+            tree = parse_xml(xml_content)
+        with timed('validate'):
+            validate_tree(tree)
+    except DiagramError as e:
+        return None, None, JsonResponse({'status': 'error', 'errors': e.problems}, status=400)
+    except (ValueError, AttributeError, etree.XMLSyntaxError):
+        return None, None, JsonResponse({'status': 'error', 'errors': ['The request or the uploaded xml is invalid.']},
+                                        status=400)
+    return tree, decision_map, None
+
+
+def get_request_errors(xml_content, decision_map):
+    """
+    Check the types of the values of an API request, the decisions themselves are checked against the diagram
+    :return: list of problems, empty when the request is well formed
+    """
+    errors = []
+    if not isinstance(xml_content, basestring):
+        errors.append('The xml has to be a string.')
+    if not isinstance(decision_map, dict):
+        errors.append('The decisions have to be an object.')
+    else:
+        for field in ['primary_keys', 'merges']:
+            if not isinstance(decision_map.get(field, {}), dict):
+                errors.append('The ' + field + ' of the decisions have to be an object.')
+    return errors
+
+
+def get_api_decisions(key_choices, merge_choices):
+    """
+    Machine readable list of the decisions the caller still has to make
+    """
+    decisions = []
+    for key_choice in key_choices:
+        decisions.append({
+            'type': 'primary_key',
+            'table': key_choice['table_name'],
+            'options': key_choice['options']
+        })
+    for merge_choice in merge_choices:
+        decisions.append({
+            'type': 'merge',
+            'relationship': merge_choice['merge_from'],
+            'merge_to': merge_choice['merge_to']
+        })
+    return decisions
+
+
+def metrics(request):
+    """
+    Stage timing histograms of this worker process in Prometheus text format, only served to METRICS_ALLOWED_IPS
+    :param request:
+    :return:
+    """
+    if request.META.get('REMOTE_ADDR') not in settings.METRICS_ALLOWED_IPS:
+        raise Http404
+    return HttpResponse(format_metrics(), content_type='text/plain; version=0.0.4')
+
+
+@csrf_exempt
+def api_submit_job(request):
+    """
+    Queue the conversion of a large diagram, same input as api_convert. Small diagrams are converted right away.
+    :param request:
+    :return: JSON with the job_id and its status, "unresolved" and the pending decisions, or "error"
+    """
+    if request.method != 'POST':
+        return JsonResponse({'status': 'error', 'errors': ['Only POST is supported.']}, status=405)
+    tree, decision_map, error_response = read_api_request(request)
+    if error_response is not None:
+        return error_response
+
+    try:
+        if len(decision_map) > 0:
+            tree = apply_decision_map(tree, compile_diagram(tree), decision_map)
+        job_id = get_cache_key(tree)
+        if get_conversion_cache().get(job_id) is None:
+            diagram = compile_diagram(tree)
+            key_choices, merge_choices = discover_decisions(diagram)
+            if len(key_choices) > 0 or len(merge_choices) > 0:
+                return JsonResponse({
+                    'status': 'unresolved',
+                    'decisions': get_api_decisions(key_choices, merge_choices)
+                })
+            if is_large_diagram(diagram):
+                submit_conversion_job(tree, diagram)
+                return JsonResponse(get_job_response(job_id), status=202)
+            convert_tree(tree, diagram)
+    except DiagramError as e:
+        return JsonResponse({'status': 'error', 'errors': e.problems}, status=400)
+    except Exception:
+        return JsonResponse({'status': 'error', 'errors': ['Unexpected error occurred!']}, status=500)
+    return JsonResponse(get_job_response(job_id))
+
+
+def job_status(request, job_id):
+    """
+    Status of a conversion job, polled by the UI and API clients
+    :param request:
+    :param job_id: see api_submit_job
+    :return: JSON with status queued, running, done or failed
+    """
+    response = get_job_response(job_id)
+    if response is None:
+        return JsonResponse({'status': 'error', 'errors': ['Unknown job.']}, status=404)
+    return JsonResponse(response)
+
+
+def job_result(request, job_id):
+    """
+    Download the JSON Schema of a finished job
+    :param request:
+    :param job_id: see api_submit_job
+    :return:
+    """
+    output_json = get_job_output(job_id)
+    if output_json is None:
+        return JsonResponse({'status': 'error', 'errors': ['The job has no result.']}, status=404)
+    response = HttpResponse(output_json, content_type='application/json')
+    response['Content-Disposition'] = 'attachment; filename=export.json'
+    return response
+
+
+def job_display(request, job_id):
+    """
+    Show the result of a job the UI has been waiting for
+    :param request:
+    :param job_id: cache key of the converted tree
+    :return:
+    """
+    # the result becomes the session's, so only jobs the session started itself are shown
+    if job_id not in request.session.get(SESSION_JOB_IDS, []):
+        return render_error_message(request, 'The conversion is not found.')
+    response = get_job_response(job_id)
+    if response is None:
+        return render_error_message(request, 'The conversion is not found.')
+    if response['status'] == STATUS_FAILED:
+        return render_error_message(request, response['error'])
+    if response['status'] != STATUS_DONE:
+        return render(request, 'conversion_job.html', {'job_id': job_id})
+    return render_result(request, get_job_output(job_id), job_id)
+
+
+@require_safe
+def schema(request, output_key):
+    """
+    Permalink of a generated JSON Schema, cacheable by browsers and proxies. The ETag is the key plus the
+    content encoding, so a repeat request with If-None-Match is answered with 304 once the schema is known to
+    exist, without compressing it again.
+    :param request:
+    :param output_key: cache key of the converted tree, see get_cache_key
+    :return:
+    """
+    encoding, compress = get_schema_encoding(request)
+    schema_etag = '"' + output_key + ('-' + encoding if encoding is not None else '') + '"'
+
+    if schema_etag in [tag.strip() for tag in request.META.get('HTTP_IF_NONE_MATCH', '').split(',')] and \
+            has_schema(output_key, encoding):
+        response = HttpResponseNotModified()
+    else:
+        output_json = get_schema_output(output_key, encoding, compress)
+        if output_json is None:
+            return JsonResponse({'status': 'error', 'errors': ['The schema is not found.']}, status=404)
+        response = HttpResponse(output_json, content_type='application/json')
+        if encoding is not None:
+            response['Content-Encoding'] = encoding
+    response['ETag'] = schema_etag
+    response['Cache-Control'] = 'public, max-age=%d, immutable' % SCHEMA_MAX_AGE
+    patch_vary_headers(response, ['Accept-Encoding'])
+    return response
+
+
+def get_schema_encoding(request):
+    accept_encoding = request.META.get('HTTP_ACCEPT_ENCODING', '')
+    for encoding, pattern, compress in SCHEMA_ENCODINGS:
+        if pattern.search(accept_encoding):
+            return encoding, compress
+    return None, None
+
+
+def get_schema_output(output_key, encoding, compress):
+    """
+    JSON Schema of a conversion, compressed once per encoding and kept in the encoded schema cache
+    """
+    if encoding is None:
+        return get_schema_json(output_key)
+    encoded_key = output_key + '.' + encoding
+    encoded_json = get_encoded_schema_cache().get(encoded_key)
+    if encoded_json is None:
+        output_json = get_schema_json(output_key)
+        if output_json is None:
+            return None
+        encoded_json = compress(output_json)
+        get_encoded_schema_cache().set(encoded_key, encoded_json)
+    return encoded_json
+
+
+def has_schema(output_key, encoding):
+    if encoding is not None and get_encoded_schema_cache().get(output_key + '.' + encoding) is not None:
+        return True
+    return get_schema_json(output_key) is not None
+
+
+def get_schema_json(output_key):
+    output_json = get_job_output(output_key)
+    if output_json is None:
+        # the tables may outlive their string in the conversion cache
+        processed_tables = get_table_cache().get(output_key)
+        if processed_tables is not None:
+            output_json = dumps_schema(processed_tables)
+            get_conversion_cache().set(output_key, output_json)
+    return output_json
+
+
+def get_job_response(job_id):
+    """
+    Job status for clients, a conversion found in the cache is done without ever having been a job
+    """
+    if get_conversion_cache().get(job_id) is not None:
+        return {'job_id': job_id, 'status': STATUS_DONE, 'schema_url': reverse('schema', args=[job_id])}
+    state = get_job_state(job_id)
+    if state is None:
+        return None
+    response = {'job_id': job_id, 'status': state['status']}
+    if state['status'] == STATUS_DONE:
+        response['schema_url'] = reverse('schema', args=[job_id])
+    if state['status'] == STATUS_FAILED:
+        response['error'] = state['error']
+    return response
+
+
+def get_job_output(job_id):
+    """
+    JSON Schema of a conversion, moved into the conversion cache once its job is done
+    """
+    output_json = get_conversion_cache().get(job_id)
+    if output_json is None:
+        output_json = get_job_result(job_id)
+        if output_json is not None:
+            get_conversion_cache().set(job_id, output_json)
+    return output_json
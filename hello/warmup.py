@@ -0,0 +1,171 @@
+import imp
+import logging
+import os
+import time
+from collections import OrderedDict
+
+import lxml.etree as etree
+from django.conf import settings
+from django.http import HttpRequest
+from django.template import engines
+from django.template.loader import get_template
+from django.urls import get_resolver
+
+from converter import parse_xml, validate_tree, compile_diagram, check_diagram, discover_decisions
+from converter import apply_decision_map, convert_diagram, convert_offloaded_job, get_xml_schema, DiagramError
+from instrumentation import record
+from jobs import run_in_worker, JobError
+from json_writer import iter_schema_json
+
+"""
+warmup.py
+work a fresh web process would otherwise do on its first requests: importing the views, compiling the templates
+and the XML Schema, running every conversion stage once and starting the worker processes. cs4221/wsgi.py
+calls warm_up before the process takes requests, and the time it took is checked against a budget.
+"""
+
+logger = logging.getLogger(__name__)
+
+CANARY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'full_sample.xml')
+# pages that render without a context, the other templates are only compiled
+PAGES = ['index.html', 'user_manual.html', 'documentation.html', 'upload.html']
+# rounds of decisions the canary may take, a merge can lead to another choice
+MAX_CANARY_ROUNDS = 10
+
+STAGE_IMPORT = 'import'
+STAGE_TOTAL = 'total'
+
+DEFAULT_IMPORT_BUDGET = 2.0
+DEFAULT_STARTUP_BUDGET = 5.0
+
+_startup_timings = None
+
+
+def warm_up(started):
+    """
+    Warm up this process, once
+    :param started: time.time() when the WSGI script started, so the imports before are counted too
+    :return: OrderedDict of stage -> seconds, see get_startup_timings
+    """
+    global _startup_timings
+    if _startup_timings is not None:
+        return _startup_timings
+
+    timings = OrderedDict()
+    # the URLconf imports the views and with them lxml and the converter
+    get_resolver().url_patterns
+    timings[STAGE_IMPORT] = time.time() - started
+
+    run_stage(timings, 'templates', compile_templates)
+    run_stage(timings, 'schema', get_xml_schema)
+    canary = run_stage(timings, 'canary', run_canary)
+    # a pool started while a module is being imported never runs a task under Python 2, e.g. when runserver
+    # imports wsgi.py; mod_wsgi executes the script without the import lock. Otherwise they start on first use.
+    if canary is not None and not imp.lock_held():
+        run_stage(timings, 'workers', start_workers, *canary)
+    timings[STAGE_TOTAL] = time.time() - started
+
+    for stage, seconds in timings.items():
+        record('startup_' + stage, seconds)
+    logger.info('process %d warmed up in %.2f s (%s)', os.getpid(), timings[STAGE_TOTAL],
+                ', '.join('%s %.0f ms' % (stage, seconds * 1000) for stage, seconds in timings.items()
+                          if stage != STAGE_TOTAL))
+    for stage, budget in get_budgets().items():
+        if timings[stage] > budget:
+            logger.warning('warm-up stage %s took %.2f s, more than its budget of %.2f s',
+                           stage, timings[stage], budget)
+
+    _startup_timings = timings
+    return timings
+
+
+def run_stage(timings, stage, function, *args):
+    """
+    Call a stage of the warm-up and add its time to timings
+    :return: what the function returns, None if it failed
+    """
+    start = time.time()
+    try:
+        return function(*args)
+    except Exception:
+        # a process that is not warm still serves requests, only slower
+        logger.exception('warm-up stage %s failed', stage)
+        return None
+    finally:
+        timings[stage] = time.time() - start
+
+
+def get_startup_timings():
+    """
+    :return: timings of warm_up in this process, None if it has not run
+    """
+    return _startup_timings
+
+
+def get_budgets():
+    """
+    :return: dict of stage -> most seconds it should take, see WARMUP_IMPORT_BUDGET and WARMUP_STARTUP_BUDGET
+    """
+    return {
+        STAGE_IMPORT: getattr(settings, 'WARMUP_IMPORT_BUDGET', DEFAULT_IMPORT_BUDGET),
+        STAGE_TOTAL: getattr(settings, 'WARMUP_STARTUP_BUDGET', DEFAULT_STARTUP_BUDGET)
+    }
+
+
+def compile_templates():
+    """
+    Compile every template of the template directories, kept in memory when the cached loader is configured,
+    and render the pages that need no context, which also loads the tag libraries and the static files manifest
+    """
+    # the directories of TEMPLATES only, the admin's templates are not used by the pages
+    for directory in engines['django'].dirs:
+        for root, directory_names, file_names in os.walk(directory):
+            for file_name in file_names:
+                if file_name.endswith('.html'):
+                    get_template(os.path.relpath(os.path.join(root, file_name), directory).replace(os.sep, '/'))
+
+    request = HttpRequest()
+    request.method = 'GET'
+    request.META['SERVER_NAME'] = 'localhost'
+    request.META['SERVER_PORT'] = '80'
+    for page in PAGES:
+        get_template(page).render({}, request)
+
+
+def run_canary():
+    """
+    Convert the full sample through every stage, answering its choices with the first key and no merge
+    :return: (XML with the decisions applied, its JSON Schema string)
+    """
+    with open(CANARY_PATH, 'rb') as canary_file:
+        tree = parse_xml(canary_file.read())
+    validate_tree(tree)
+    diagram = compile_diagram(tree)
+    check_diagram(diagram)
+    key_choices, merge_choices = discover_decisions(diagram)
+    for i in range(MAX_CANARY_ROUNDS):
+        if len(key_choices) == 0 and len(merge_choices) == 0:
+            break
+        tree = apply_decision_map(tree, diagram, {
+            'primary_keys': dict((choice['table_name'], 0) for choice in key_choices),
+            'merges': dict((choice['merge_from'], False) for choice in merge_choices)
+        })
+        diagram = compile_diagram(tree)
+        key_choices, merge_choices = discover_decisions(diagram)
+    else:
+        raise DiagramError('The canary diagram still has decisions open')
+
+    processed_tables = convert_diagram(diagram)
+    ''.join(iter_schema_json(processed_tables, compact=True))  # as the compact download does
+    return etree.tostring(tree), ''.join(iter_schema_json(processed_tables))
+
+
+def start_workers(content, output_json):
+    """
+    Start the worker processes of jobs.py, forked from this process once it is warm, and have one of them
+    convert the canary, which has to give the same schema as in this process
+    :param content: see run_canary
+    :param output_json: see run_canary
+    """
+    if run_in_worker(convert_offloaded_job, (content,))[2] != output_json:
+        raise JobError('The worker processes convert the canary diagram differently')
@@ -0,0 +1,345 @@
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+import zlib
+from abc import ABCMeta, abstractmethod
+from collections import OrderedDict
+
+from django.conf import settings
+
+"""
+workspace.py
+state of one diagram being converted: the upload (kept once, compressed), an ordered log of the user's
+key/merge decisions and the cache key of the last result. The current diagram is rebuilt by replaying
+the log (see apply_decision_log in converter.py). Only the workspace id is kept in the Django session.
+A new version of a diagram gets a workspace of its own, see versions.py.
+"""
+
+# key used in the session
+SESSION_WORKSPACE_ID = 'workspace_id'
+
+# operations recorded in the decision log
+OP_PRIMARY_KEY = 'key'
+OP_MERGE = 'merge'
+
+STORE_MEMORY = 'memory'
+STORE_FILE = 'file'
+STORE_SQLITE = 'sqlite'
+
+DEFAULT_TTL = 24 * 60 * 60
+GC_INTERVAL = 10 * 60
+
+
+class Workspace(object):
+
+    def __init__(self, workspace_id, upload, decision_log=None, output_key=None, updated=None):
+        self.id = workspace_id
+        self.upload = upload  # zlib compressed XML
+        self.decision_log = decision_log or []
+        self.output_key = output_key
+        self.updated = updated or time.time()
+        self.base_key = None  # output key of the previous version, until the first result of this one
+        self.stale_names = []  # objects whose tables differ from the previous version's
+        self.delta = None  # differences from the previous version, see versions.py
+
+    def get_content(self):
+        return zlib.decompress(self.upload)
+
+    def get_state(self):
+        return json.dumps({'decision_log': self.decision_log, 'output_key': self.output_key,
+                           'base_key': self.base_key, 'stale_names': self.stale_names, 'delta': self.delta})
+
+    def set_state(self, state):
+        state = json.loads(state)
+        self.decision_log = state['decision_log']
+        self.output_key = state['output_key']
+        # workspaces saved before versions were uploaded have none of these
+        self.base_key = state.get('base_key')
+        self.stale_names = state.get('stale_names', [])
+        self.delta = state.get('delta')
+
+    def record_decisions(self, key_decisions, merge_decisions):
+        """
+        Append decisions to the log, in the order they are applied to the tree. A decision replaces an earlier one
+        on the same table or relationship, e.g. when the decisions form is submitted again, so replaying the log
+        never applies two of them.
+        :param key_decisions: dict of table name -> primary key option
+        :param merge_decisions: list of (merge_table, merge_from, merge_to)
+        """
+        decided = set((OP_PRIMARY_KEY, table_name) for table_name in key_decisions)
+        decided.update((OP_MERGE, merge_from) for merge_table, merge_from, merge_to in merge_decisions)
+        self.decision_log = [operation for operation in self.decision_log
+                             if (operation[0], get_decided_name(operation)) not in decided]
+        for table_name, primary_key_option in sorted(key_decisions.items()):
+            self.decision_log.append([OP_PRIMARY_KEY, table_name, str(primary_key_option)])
+        for merge_table, merge_from, merge_to in merge_decisions:
+            self.decision_log.append([OP_MERGE, merge_table, merge_from, merge_to])
+
+
+def get_decided_name(operation):
+    """
+    :return: name of the table or relationship a logged decision is about
+    """
+    return operation[1] if operation[0] == OP_PRIMARY_KEY else operation[2]
+
+
+class WorkspaceStore(object):
+    """
+    Abstract base class of the workspace stores, a store implements get, add, update and collect_garbage.
+    Abandoned workspaces are removed once they have not been saved for ttl seconds; collection runs at most
+    once every GC_INTERVAL, piggybacking on saves.
+    """
+    __metaclass__ = ABCMeta
+
+    def __init__(self, ttl=DEFAULT_TTL):
+        self.ttl = ttl
+        self.last_collected = time.time()
+        self.gc_lock = threading.Lock()
+
+    def create(self, chunks):
+        """
+        :param chunks: the uploaded XML as an iterable of strings, e.g. UploadedFile.chunks(), compressed
+        one at a time so the upload is never held uncompressed as a whole
+        """
+        compressor = zlib.compressobj()
+        upload = ''.join([compressor.compress(chunk) for chunk in chunks] + [compressor.flush()])
+        workspace = Workspace(uuid.uuid4().hex, upload)
+        self.add(workspace)
+        self.maybe_collect_garbage()
+        return workspace
+
+    def save(self, workspace):
+        workspace.updated = time.time()
+        self.update(workspace)
+        self.maybe_collect_garbage()
+
+    def maybe_collect_garbage(self):
+        now = time.time()
+        if now - self.last_collected < GC_INTERVAL or not self.gc_lock.acquire(False):
+            return
+        try:
+            self.last_collected = now
+            self.collect_garbage(now - self.ttl)
+        finally:
+            self.gc_lock.release()
+
+    @abstractmethod
+    def get(self, workspace_id):
+        """
+        :return: Workspace, None when it is not found
+        """
+
+    @abstractmethod
+    def add(self, workspace):
+        """
+        Store a new workspace, its upload and its state
+        """
+
+    @abstractmethod
+    def update(self, workspace):
+        """
+        Store the state of a workspace, the upload never changes
+        """
+
+    @abstractmethod
+    def collect_garbage(self, expired_before):
+        """
+        Remove the workspaces last saved before the time expired_before
+        """
+
+
+class MemoryWorkspaceStore(WorkspaceStore):
+    """
+    LRU of workspaces inside the worker process. Only suitable when every request of a user reaches the
+    same process, e.g. the development server.
+    """
+
+    def __init__(self, max_entries, ttl=DEFAULT_TTL):
+        super(MemoryWorkspaceStore, self).__init__(ttl)
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, workspace_id):
+        with self.lock:
+            workspace = self.entries.pop(workspace_id, None)
+            if workspace is not None:
+                self.entries[workspace_id] = workspace
+            return workspace
+
+    def add(self, workspace):
+        with self.lock:
+            self.entries[workspace.id] = workspace
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def update(self, workspace):
+        self.add(workspace)
+
+    def collect_garbage(self, expired_before):
+        with self.lock:
+            for workspace_id, workspace in self.entries.items():
+                if workspace.updated < expired_before:
+                    del self.entries[workspace_id]
+
+
+class FileWorkspaceStore(WorkspaceStore):
+    """
+    One directory entry per workspace on local disk, shared by all worker processes of the host.
+    The upload is written once, each decision only rewrites the small state file.
+    """
+
+    def __init__(self, directory, ttl=DEFAULT_TTL):
+        super(FileWorkspaceStore, self).__init__(ttl)
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def get_path(self, workspace_id, extension):
+        return os.path.join(self.directory, workspace_id + extension)
+
+    def get(self, workspace_id):
+        try:
+            with open(self.get_path(workspace_id, '.xml.z'), 'rb') as upload_file:
+                upload = upload_file.read()
+            with open(self.get_path(workspace_id, '.json'), 'rb') as state_file:
+                state = state_file.read()
+            updated = os.path.getmtime(self.get_path(workspace_id, '.json'))
+        except (IOError, OSError):
+            return None
+        workspace = Workspace(workspace_id, upload, updated=updated)
+        workspace.set_state(state)
+        return workspace
+
+    def write(self, path, content):
+        # write to a temporary file first, so other processes never read a partial file
+        fd, temp_path = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, 'wb') as temp_file:
+            temp_file.write(content)
+        os.rename(temp_path, path)
+
+    def add(self, workspace):
+        self.write(self.get_path(workspace.id, '.xml.z'), workspace.upload)
+        self.update(workspace)
+
+    def update(self, workspace):
+        self.write(self.get_path(workspace.id, '.json'), workspace.get_state())
+
+    def collect_garbage(self, expired_before):
+        for file_name in os.listdir(self.directory):
+            if not file_name.endswith('.json'):
+                continue
+            workspace_id = file_name[:-len('.json')]
+            try:
+                if os.path.getmtime(self.get_path(workspace_id, '.json')) < expired_before:
+                    os.remove(self.get_path(workspace_id, '.json'))
+                    os.remove(self.get_path(workspace_id, '.xml.z'))
+            except OSError:
+                pass  # removed by another process in the meantime
+
+
+class SQLiteWorkspaceStore(WorkspaceStore):
+    """
+    Workspaces in a SQLite database, standing in for storage shared between hosts.
+    """
+
+    def __init__(self, path, ttl=DEFAULT_TTL):
+        super(SQLiteWorkspaceStore, self).__init__(ttl)
+        self.path = path
+        self.local = threading.local()
+        with self.get_connection() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS workspace ('
+                               'id TEXT PRIMARY KEY, upload BLOB, state TEXT, updated REAL)')
+            connection.execute('CREATE INDEX IF NOT EXISTS workspace_updated ON workspace (updated)')
+
+    def get_connection(self):
+        # sqlite3 connections cannot be shared between threads
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            self.local.connection = connection
+        return connection
+
+    def get(self, workspace_id):
+        row = self.get_connection().execute('SELECT upload, state, updated FROM workspace WHERE id = ?',
+                                            (workspace_id,)).fetchone()
+        if row is None:
+            return None
+        workspace = Workspace(workspace_id, str(row[0]), updated=row[2])
+        workspace.set_state(row[1])
+        return workspace
+
+    def add(self, workspace):
+        with self.get_connection() as connection:
+            connection.execute('INSERT INTO workspace (id, upload, state, updated) VALUES (?, ?, ?, ?)',
+                               (workspace.id, sqlite3.Binary(workspace.upload), workspace.get_state(),
+                                workspace.updated))
+
+    def update(self, workspace):
+        with self.get_connection() as connection:
+            connection.execute('UPDATE workspace SET state = ?, updated = ? WHERE id = ?',
+                               (workspace.get_state(), workspace.updated, workspace.id))
+
+    def collect_garbage(self, expired_before):
+        with self.get_connection() as connection:
+            connection.execute('DELETE FROM workspace WHERE updated < ?', (expired_before,))
+
+
+_workspace_store = None
+_workspace_store_lock = threading.Lock()
+
+
+def get_workspace_store():
+    """
+    Workspace store of this worker, selected by WORKSPACE_STORE
+    """
+    global _workspace_store
+    if _workspace_store is None:
+        with _workspace_store_lock:
+            if _workspace_store is None:
+                _workspace_store = create_workspace_store()
+    return _workspace_store
+
+
+def create_workspace_store():
+    store_type = getattr(settings, 'WORKSPACE_STORE', STORE_FILE)
+    ttl = getattr(settings, 'WORKSPACE_TTL', DEFAULT_TTL)
+    if store_type == STORE_MEMORY:
+        return MemoryWorkspaceStore(getattr(settings, 'WORKSPACE_MEMORY_ENTRIES', 256), ttl)
+    elif store_type == STORE_FILE:
+        return FileWorkspaceStore(settings.WORKSPACE_DIR, ttl)
+    elif store_type == STORE_SQLITE:
+        return SQLiteWorkspaceStore(settings.WORKSPACE_SQLITE_PATH, ttl)
+    raise ValueError('Unknown WORKSPACE_STORE ' + str(store_type))
+
+
+def create_session_workspace(request, chunks):
+    """
+    Start a new workspace for an upload and make it the current one of the session
+    :param chunks: see WorkspaceStore.create
+    """
+    workspace = get_workspace_store().create(chunks)
+    request.session[SESSION_WORKSPACE_ID] = workspace.id
+    request.workspace = workspace
+    return workspace
+
+
+def get_session_workspace(request):
+    """
+    Current workspace of the session, loaded at most once per request
+    :return: Workspace, or None when there is no upload or it has expired
+    """
+    if getattr(request, 'workspace', None) is None:
+        workspace_id = request.session.get(SESSION_WORKSPACE_ID)
+        if workspace_id is None:
+            return None
+        request.workspace = get_workspace_store().get(workspace_id)
+    return request.workspace
+
+
+def save_workspace(workspace):
+    get_workspace_store().save(workspace)